@@ -0,0 +1,184 @@
+import os
+import time
+import math
+import logging
+import threading
+from collections import OrderedDict, deque
+import metrics
+
+
+class Rejected(Exception):
+    """raised when a request cannot be admitted"""
+
+    def __init__(self, status_code, reason, retry_after):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionPool():
+    """Limits the number of concurrently executing requests.
+    Requests over the limit wait in a bounded queue that is drained
+    round robin across users, so a single heavy user cannot starve
+    everyone else. Requests that can't be queued are rejected immediately."""
+
+    def __init__(self, name, limit, max_queue, max_queue_per_user, max_wait):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.max_wait = max_wait
+        self.active = 0
+        self.queued = 0
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()  # user id -> deque of waiting events
+
+        metrics.gauge("admission_active", fn=lambda: self.active, pool=name)
+        metrics.gauge("admission_queue_depth",
+                      fn=lambda: self.queued, pool=name)
+        metrics.gauge("admission_limit", fn=lambda: self.limit, pool=name)
+        self._wait_time = metrics.histogram(
+            "admission_wait_seconds", pool=name)
+        self._service_time = metrics.histogram(
+            "admission_service_seconds", pool=name)
+
+    def retry_after(self):
+        """estimates how many seconds until capacity frees up"""
+        service_time = self._service_time.percentile(50) or 1
+        backlog = (self.queued + 1) / max(self.limit, 1)
+        return max(1, math.ceil(service_time * backlog))
+
+    def _reject(self, status_code, reason):
+        metrics.counter("admission_rejected",
+                        pool=self.name, reason=reason).inc()
+        logging.warning(f"admission pool {self.name} rejected request: {reason}")
+        raise Rejected(status_code, reason, self.retry_after())
+
+    def acquire(self, user_id, timeout=None):
+        """blocks until the request is admitted, or raises Rejected.
+        waits at most max_wait seconds, or timeout if it is shorter"""
+
+        start = time.monotonic()
+        with self._lock:
+            if self.active < self.limit and self.queued == 0:
+                self.active += 1
+                self._wait_time.observe(0)
+                return
+            if self.queued >= self.max_queue:
+                self._reject(503, "queue_full")
+            queue = self._queues.setdefault(user_id, deque())
+            if len(queue) >= self.max_queue_per_user:
+                if not queue:
+                    del self._queues[user_id]
+                self._reject(429, "user_queue_full")
+            waiter = threading.Event()
+            queue.append(waiter)
+            self.queued += 1
+
+        max_wait = self.max_wait if timeout is None else min(self.max_wait, timeout)
+        waiter.wait(max_wait)
+
+        with self._lock:
+            # release() hands the slot over by setting the event
+            # after removing it from the queue
+            if not waiter.is_set():
+                queue.remove(waiter)
+                self.queued -= 1
+                if not queue and self._queues.get(user_id) is queue:
+                    del self._queues[user_id]
+                self._reject(503, "wait_timeout")
+
+        self._wait_time.observe(time.monotonic() - start)
+
+    def acquire_within(self, user_id, deadline):
+        """like acquire, but when rejected keeps retrying (after the
+        suggested Retry-After) for as long as the deadline allows.
+        for background work that would rather wait than fail"""
+        while True:
+            try:
+                return self.acquire(user_id, deadline.remaining())
+            except Rejected as e:
+                if deadline.remaining() <= e.retry_after:
+                    raise
+                time.sleep(e.retry_after)
+
+    def release(self, service_time=None):
+        """frees a slot, handing it to the next user in line"""
+
+        if service_time is not None:
+            self._service_time.observe(service_time)
+        with self._lock:
+            if self.queued == 0:
+                self.active -= 1
+                return
+            user_id, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            self.queued -= 1
+            if queue:
+                # move to the back of the line
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            waiter.set()
+
+
+def _env_int(name, default):
+    return int(os.getenv(name, default))
+
+
+# endpoints that call the agent runtime
+AGENT_ENDPOINTS = {"ask", "ask_api_new", "ask_api"}
+
+# endpoints that bypass admission control
+# (profiling needs to work when the server is overloaded,
+# batches admit each of their questions individually,
+# job long polls are limited separately, and prefetch
+# requests only schedule work within the prefetch budget)
+EXEMPT_ENDPOINTS = {"health_check", "debug_profile", "ask_api_batch", "get_job",
+                    "prefetch_conversation"}
+
+
+# each pool's limits, overridden with ADMISSION_<POOL>_<SETTING>
+POOL_DEFAULTS = {
+    "agent": {"concurrency": 4, "queue": 8, "queue_per_user": 2, "max_wait": 30},
+    "default": {"concurrency": 4, "queue": 16, "queue_per_user": 8, "max_wait": 5},
+}
+
+
+def pool_settings(name):
+    """a pool's limits, from the environment or the defaults"""
+    return {k: _env_int(f"ADMISSION_{name.upper()}_{k.upper()}", v)
+            for k, v in POOL_DEFAULTS[name].items()}
+
+
+def threads_needed():
+    """gunicorn threads a worker process needs so that every request
+    admission control lets in has one: both pools' concurrency limits,
+    plus the agent queue (waiting requests hold a thread too)"""
+    agent, default = pool_settings("agent"), pool_settings("default")
+    return agent["concurrency"] + agent["queue"] + default["concurrency"]
+
+
+class AdmissionController():
+    """routes requests to the agent or default admission pool"""
+
+    def __init__(self):
+        self.pools = {}
+        for name in POOL_DEFAULTS:
+            settings = pool_settings(name)
+            self.pools[name] = AdmissionPool(
+                name,
+                limit=settings["concurrency"],
+                max_queue=settings["queue"],
+                max_queue_per_user=settings["queue_per_user"],
+                max_wait=settings["max_wait"],
+            )
+
+    def pool_for(self, endpoint):
+        """returns the pool for a flask endpoint, or None if exempt"""
+        if endpoint in EXEMPT_ENDPOINTS:
+            return None
+        if endpoint in AGENT_ENDPOINTS:
+            return self.pools["agent"]
+        return self.pools["default"]
@@ -1,38 +1,328 @@
 import boto3
 import json
+import math
+import time
+import random
 import argparse
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
 
-parser = argparse.ArgumentParser(description="Create an agent runtime")
-parser.add_argument("--agent_runtime_arn", required=True, help="Agent runtime arn")
+parser = argparse.ArgumentParser(
+    description="Invoke the agent, or generate load against it")
+parser.add_argument("--agent_runtime_arn", default="",
+                    help="Agent runtime arn (required for --target=runtime)")
+parser.add_argument("--target", default="runtime", choices=["runtime", "agent", "web"],
+                    help="runtime: the AgentCore runtime (via boto3), "
+                    "agent: a local agent's /invocations, web: the web app's /api/ask")
+parser.add_argument("--url", default="http://localhost:8080",
+                    help="base url for --target=agent or --target=web")
+parser.add_argument("--endpoint_url", default=None,
+                    help="override the bedrock-agentcore endpoint (e.g. a local emulator)")
+parser.add_argument("--mode", default="closed", choices=["closed", "open"],
+                    help="closed: each worker starts a new session when the last one finishes, "
+                    "open: sessions arrive at --rate regardless of how fast they complete")
+parser.add_argument("--concurrency", type=int, default=1,
+                    help="number of workers (closed) or maximum sessions in flight (open)")
+parser.add_argument("--rate", type=float, default=1,
+                    help="new sessions per second (open loop, poisson arrivals)")
+parser.add_argument("--sessions", type=int, default=None,
+                    help="number of sessions to run (default 1, or unlimited with --duration)")
+parser.add_argument("--duration", type=float, default=None,
+                    help="seconds to generate load for")
+parser.add_argument("--turns", type=int, default=1,
+                    help="questions per session, sent in order with the same session id")
+parser.add_argument("--think", type=float, default=0,
+                    help="seconds to wait between turns")
+parser.add_argument("--corpus", default=None,
+                    help="file with one prompt per line (picked at random)")
+parser.add_argument("--prompt", default="Who are you and what can you do?")
+parser.add_argument("--user_id", default="6886c5c5ced611f1af8885b941a07a61")
+parser.add_argument("--timeout", type=float, default=300, help="per request timeout")
+parser.add_argument("--histogram_out", default=None,
+                    help="write the total latency percentile distribution to this file "
+                    "(HdrHistogram text format, can be plotted with its plotter)")
+parser.add_argument("--verbose", action="store_true", help="print every response")
 args = parser.parse_args()
-agent_runtime_arn = args.agent_runtime_arn
-if len(agent_runtime_arn) == 0:
+
+if args.target == "runtime" and len(args.agent_runtime_arn) == 0:
     raise Exception("--agent_runtime_arn is missing")
+if args.sessions is None and args.duration is None:
+    args.sessions = 1
+
+
+class Histogram():
+    """HDR style latency histogram. values are recorded into logarithmic
+    buckets with ~1% relative precision, so memory use is bounded and
+    percentiles are accurate across several orders of magnitude"""
+
+    def __init__(self, precision=0.01, lowest=1e-6):
+        self.base = math.log(1 + precision)
+        self.lowest = lowest
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        index = int(math.log(max(value, self.lowest) / self.lowest) / self.base)
+        with self._lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.count += 1
+            self.total += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+
+    def _value(self, index):
+        # upper bound of the bucket
+        return self.lowest * math.exp((index + 1) * self.base)
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        target = max(1, math.ceil(p / 100 * self.count))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._value(index), self.max)
+        return self.max
+
+    def summary(self):
+        if self.count == 0:
+            return "no samples"
+        ms = [f"{name}={self.percentile(p) * 1000:.0f}ms"
+              for name, p in [("p50", 50), ("p90", 90), ("p99", 99), ("p99.9", 99.9)]]
+        return (f"n={self.count} min={self.min * 1000:.0f}ms "
+                f"mean={self.total / self.count * 1000:.0f}ms "
+                f"{' '.join(ms)} max={self.max * 1000:.0f}ms")
+
+    def write(self, f):
+        """writes the percentile distribution in the HdrHistogram text format (ms)"""
+        f.write(f"{'Value':>12} {'Percentile':>14} {'TotalCount':>10} {'1/(1-Percentile)':>14}\n\n")
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            percentile = seen / self.count
+            inverse = f"{1 / (1 - percentile):14.2f}" if percentile < 1 else f"{'inf':>14}"
+            value = min(self._value(index), self.max) * 1000
+            f.write(f"{value:12.3f} {percentile:14.12f} {seen:10d} {inverse}\n")
+        f.write(f"#[Mean    = {self.total / self.count * 1000:12.3f}, Max = {self.max * 1000:12.3f}]\n")
+        f.write(f"#[Total count    = {self.count:12d}]\n")
+
+
+class Stats():
+    """latencies and outcomes across all requests"""
+
+    def __init__(self):
+        self.ttfb = Histogram()
+        self.total = Histogram()
+        self.errors = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def success(self, ttfb, total):
+        self.ttfb.record(ttfb)
+        self.total.record(total)
+        with self._lock:
+            self.requests += 1
+
+    def error(self, reason):
+        with self._lock:
+            self.requests += 1
+            self.errors[reason] = self.errors.get(reason, 0) + 1
+
+
+class RuntimeTarget():
+    """invokes the agent through the AgentCore runtime api"""
+
+    def __init__(self):
+        self.client = boto3.client(
+            "bedrock-agentcore",
+            endpoint_url=args.endpoint_url,
+            config=Config(
+                read_timeout=args.timeout,
+                max_pool_connections=max(10, args.concurrency),
+                retries={"total_max_attempts": 1},
+            ),
+        )
+
+    def ask(self, session, prompt):
+        response = self.client.invoke_agent_runtime(
+            agentRuntimeArn=args.agent_runtime_arn,
+            runtimeSessionId=session["id"],
+            payload=json.dumps({
+                "input": {"user_id": args.user_id, "prompt": prompt}
+            }),
+        )
+        body = response["response"]
+        first = body.read(1)
+        ttfb = time.monotonic()
+        return ttfb, json.loads(first + body.read())
+
+
+class HttpTarget():
+    """invokes a local agent's /invocations, or the web app's /api/ask"""
+
+    def __init__(self):
+        import httpx
+        self.client = httpx.Client(
+            base_url=args.url, timeout=args.timeout,
+            limits=httpx.Limits(max_connections=max(10, args.concurrency)))
+
+    def ask(self, session, prompt):
+        if args.target == "agent":
+            request = self.client.build_request(
+                "POST", "/invocations",
+                headers={"X-Amzn-Bedrock-AgentCore-Runtime-Session-Id": session["id"]},
+                json={"input": {"user_id": args.user_id, "prompt": prompt}})
+        else:
+            # the web app assigns the conversation id on the first question
+            path = "/api/ask"
+            if session.get("conversation_id"):
+                path += f"/{session['conversation_id']}"
+            request = self.client.build_request(
+                "POST", path, json={"question": prompt})
+
+        response = self.client.send(request, stream=True)
+        try:
+            chunks = response.iter_bytes()
+            first = next(chunks, b"")
+            ttfb = time.monotonic()
+            body = first + b"".join(chunks)
+        finally:
+            response.close()
+        if response.status_code != 200:
+            raise HttpError(response.status_code)
+        data = json.loads(body)
+        if args.target == "web":
+            session["conversation_id"] = data["conversationId"]
+        return ttfb, data
+
+
+class HttpError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"http {status_code}")
+        self.status_code = status_code
+
+
+def error_reason(e):
+    """a short label for grouping errors"""
+    if isinstance(e, HttpError):
+        return str(e)
+    response = getattr(e, "response", None)
+    if isinstance(response, dict):
+        return response.get("Error", {}).get("Code", type(e).__name__)
+    return type(e).__name__
+
+
+def load_prompts():
+    if not args.corpus:
+        return [args.prompt]
+    with open(args.corpus) as f:
+        prompts = [line.strip() for line in f
+                   if line.strip() and not line.startswith("#")]
+    if not prompts:
+        raise Exception(f"no prompts in {args.corpus}")
+    return prompts
+
+
+def run_session(target, prompts, stats, scheduled=None):
+    """runs one multi-turn session. in open loop mode the first turn is
+    timed from when the session was scheduled to arrive, so that time spent
+    waiting for a free worker counts (avoids coordinated omission)"""
+    session = {"id": str(uuid.uuid4())}
+    for turn in range(args.turns):
+        if turn > 0 and args.think:
+            time.sleep(args.think)
+        prompt = random.choice(prompts)
+        start = scheduled if turn == 0 and scheduled else time.monotonic()
+        try:
+            ttfb, data = target.ask(session, prompt)
+        except Exception as e:
+            stats.error(error_reason(e))
+            if args.verbose:
+                print(f"{session['id']} turn {turn + 1}: error: {e}")
+            # later turns depend on this one
+            return
+        end = time.monotonic()
+        stats.success(ttfb - start, end - start)
+        if args.verbose:
+            print(f"{session['id']} turn {turn + 1} ({end - start:.2f}s): {json.dumps(data)}")
+
+
+def closed_loop(target, prompts, stats, until):
+    remaining = [args.sessions]
+    lock = threading.Lock()
+
+    def worker():
+        while until is None or time.monotonic() < until:
+            if remaining[0] is not None:
+                with lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+            run_session(target, prompts, stats)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for _ in range(args.concurrency):
+            executor.submit(worker)
+
+
+def open_loop(target, prompts, stats, until):
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        started = 0
+        next_arrival = time.monotonic()
+        while ((args.sessions is None or started < args.sessions)
+               and (until is None or next_arrival < until)):
+            delay = next_arrival - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(run_session, target, prompts, stats, next_arrival)
+            started += 1
+            next_arrival += random.expovariate(args.rate)
+
+
+def main():
+    prompts = load_prompts()
+    target = RuntimeTarget() if args.target == "runtime" else HttpTarget()
+    stats = Stats()
+
+    single = args.sessions == 1 and args.turns == 1
+    if single:
+        args.verbose = True
+    else:
+        load = (f"{args.concurrency} workers" if args.mode == "closed"
+                else f"{args.rate} sessions/s (max {args.concurrency} in flight)")
+        print(f"{args.mode} loop against {args.target}: {load}, {args.turns} turns per session\n")
 
-# Get AWS account ID and region
-sts_client = boto3.client("sts")
-region = boto3.session.Session().region_name
-account = sts_client.get_caller_identity()["Account"]
+    start = time.monotonic()
+    until = start + args.duration if args.duration else None
+    if args.mode == "closed":
+        closed_loop(target, prompts, stats, until)
+    else:
+        open_loop(target, prompts, stats, until)
+    elapsed = time.monotonic() - start
 
-agent_core_client = boto3.client("bedrock-agentcore")
+    if single:
+        return
 
-payload = json.dumps({
-    "input": {
-        "user_id": "6886c5c5ced611f1af8885b941a07a61",
-        "prompt": "Who are you and what can you do?"
-    }
-})
+    errors = sum(stats.errors.values())
+    print()
+    print(f"requests:   {stats.requests} in {elapsed:.1f}s "
+          f"({stats.total.count / elapsed:.2f} successful/s)")
+    print(f"errors:     {errors} ({errors / max(1, stats.requests):.1%}) {stats.errors or ''}")
+    print(f"ttfb:       {stats.ttfb.summary()}")
+    print(f"total:      {stats.total.summary()}")
 
-session_id = str(uuid.uuid4())
+    if args.histogram_out and stats.total.count:
+        with open(args.histogram_out, "w") as f:
+            stats.total.write(f)
+        print(f"\nwrote latency distribution to {args.histogram_out}")
 
-print(f"invoking agent with session id: {session_id}")
-response = agent_core_client.invoke_agent_runtime(
-    agentRuntimeArn=agent_runtime_arn,
-    runtimeSessionId=session_id,
-    payload=payload,
-)
 
-response_body = response["response"].read()
-response_data = json.loads(response_body)
-print("Agent Response:", response_data)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import time
+import logging
+from strands.hooks import HookProvider, HookRegistry
+from strands.experimental.hooks import BeforeToolInvocationEvent, AfterToolInvocationEvent
+
+
+def expired(invocation_state):
+    """returns true if the invocation's deadline (monotonic time) has passed"""
+    deadline = invocation_state.get("deadline")
+    return deadline is not None and time.monotonic() >= deadline
+
+
+class DeadlineHookProvider(HookProvider):
+    """Stops the agent's tool loop once the caller's time budget is spent.
+    The deadline is passed per invocation, e.g. agent(prompt, deadline=...)"""
+
+    def _stop(self, invocation_state):
+        logging.warning("deadline exceeded, stopping tool loop")
+        request_state = invocation_state.setdefault("request_state", {})
+        request_state["stop_event_loop"] = True
+        request_state["deadline_exceeded"] = True
+
+    def before_tool_invocation(self, event: BeforeToolInvocationEvent):
+        """skip tool calls that start after the deadline"""
+        if expired(event.invocation_state):
+            self._stop(event.invocation_state)
+            event.selected_tool = None
+
+    def after_tool_invocation(self, event: AfterToolInvocationEvent):
+        """don't start another model cycle after the deadline"""
+        if expired(event.invocation_state):
+            self._stop(event.invocation_state)
+
+    def register_hooks(self, registry: HookRegistry):
+        registry.add_callback(BeforeToolInvocationEvent,
+                              self.before_tool_invocation)
+        registry.add_callback(AfterToolInvocationEvent,
+                              self.after_tool_invocation)
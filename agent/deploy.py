@@ -1,189 +1,211 @@
 import argparse
 import boto3
+import os
 import json
 import time
-from datetime import timedelta
-
-parser = argparse.ArgumentParser(
-    description="Create or update an agent runtime")
-parser.add_argument("--region", default="us-east-1", help="AWS region")
-parser.add_argument("--account", required=True, help="AWS account ID")
-parser.add_argument("--app", required=True, help="Agent runtime name")
-parser.add_argument("--image", required=True, help="Agent runtime image")
-parser.add_argument("--kb", required=True, help="knowledge base")
-args = parser.parse_args()
-account = args.account
-app = args.app
-image = args.image
-region = args.region
-kb = args.kb
-
-# Initialize IAM and Bedrock clients
-iam_client = boto3.client("iam")
-client = boto3.client("bedrock-agentcore-control")
-
-# Check if the IAM role exists
-role_name = f"{app}-AgentRuntimeRole"
-role_arn = f"arn:aws:iam::{account}:role/{role_name}"
-
-
-def create_agent_runtime_role():
-    """Create the IAM role for Bedrock Agent Core Runtime if it doesn't exist"""
+import random
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# errors returned while a newly created role hasn't propagated yet
+ROLE_NOT_READY_ERRORS = ("ValidationException", "AccessDeniedException")
+
+# environment variables copied to the runtime when set
+RUNTIME_SETTINGS = (
+    "FAST_MODEL", "STRONG_MODEL", "ROUTING_POLICY", "ROUTING_THRESHOLD",
+    "ROUTING_RETRIEVAL", "ROUTING_LONG_QUESTION_WORDS",
+    "ROUTING_DEEP_CONVERSATION_TURNS", "ROUTING_MIN_RETRIEVAL_SCORE",
+    "SPECULATIVE_RETRIEVAL", "SPECULATIVE_RETRIEVAL_WAIT", "SPECULATIVE_MATCH",
+    "SPECULATIVE_WORKERS", "SPECULATIVE_SERVE_WAIT",
+)
+
+
+@contextmanager
+def timed(step):
+    """prints how long a deployment step took"""
+    start = time.monotonic()
     try:
-        # Check if role already exists
-        print("checking if role exists\n")
-        response = iam_client.get_role(RoleName=role_name)
-
-    except iam_client.exceptions.NoSuchEntityException:
-
-        # Create trust policy
-        trust_policy = {
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Sid": "AssumeRolePolicy",
-                    "Effect": "Allow",
-                    "Principal": {
-                        "Service": "bedrock-agentcore.amazonaws.com"
+        yield
+    finally:
+        print(f"[{time.monotonic() - start:6.1f}s] {step}\n")
+
+
+def poll(describe, is_done, timeout, what, initial_delay=1, max_delay=15):
+    """calls describe() with exponential backoff (and jitter)
+    until is_done(result) is true or the timeout passes"""
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    while True:
+        result = describe()
+        if is_done(result):
+            return result
+        if time.monotonic() + delay > deadline:
+            raise Exception(f"timed out after {timeout}s waiting for {what}")
+        time.sleep(delay * random.uniform(0.8, 1.2))
+        delay = min(delay * 2, max_delay)
+
+
+def trust_policy(account, region):
+    """trust policy for the agent runtime role"""
+    return {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Sid": "AssumeRolePolicy",
+                "Effect": "Allow",
+                "Principal": {
+                    "Service": "bedrock-agentcore.amazonaws.com"
+                },
+                "Action": "sts:AssumeRole",
+                "Condition": {
+                    "StringEquals": {
+                        "aws:SourceAccount": account
                     },
-                    "Action": "sts:AssumeRole",
-                    "Condition": {
-                        "StringEquals": {
-                            "aws:SourceAccount": account
-                        },
-                        "ArnLike": {
-                            "aws:SourceArn": f"arn:aws:bedrock-agentcore:{region}:{account}:*"
-                        }
+                    "ArnLike": {
+                        "aws:SourceArn": f"arn:aws:bedrock-agentcore:{region}:{account}:*"
                     }
                 }
-            ]
-        }
-
-        # Create permission policy
-        permission_policy = {
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Sid": "ECRImageAccess",
-                    "Effect": "Allow",
-                    "Action": [
-                        "ecr:BatchGetImage",
-                        "ecr:GetDownloadUrlForLayer"
-                    ],
-                    "Resource": [
-                        f"arn:aws:ecr:{region}:{account}:repository/*"
-                    ]
-                },
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "logs:DescribeLogStreams",
-                        "logs:CreateLogGroup"
-                    ],
-                    "Resource": [
-                        f"arn:aws:logs:{region}:{account}:log-group:/aws/bedrock-agentcore/runtimes/*"
-                    ]
-                },
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "logs:DescribeLogGroups"
-                    ],
-                    "Resource": [
-                        f"arn:aws:logs:{region}:{account}:log-group:*"
-                    ]
-                },
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "logs:CreateLogStream",
-                        "logs:PutLogEvents"
-                    ],
-                    "Resource": [
-                        f"arn:aws:logs:{region}:{account}:log-group:/aws/bedrock-agentcore/runtimes/*:log-stream:*"
-                    ]
-                },
-                {
-                    "Sid": "ECRTokenAccess",
-                    "Effect": "Allow",
-                    "Action": [
-                        "ecr:GetAuthorizationToken"
-                    ],
-                    "Resource": "*"
-                },
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "xray:PutTraceSegments",
-                        "xray:PutTelemetryRecords",
-                        "xray:GetSamplingRules",
-                        "xray:GetSamplingTargets"
-                    ],
-                    "Resource": ["*"]
-                },
-                {
-                    "Effect": "Allow",
-                    "Resource": "*",
-                    "Action": "cloudwatch:PutMetricData",
-                    "Condition": {
-                        "StringEquals": {
-                            "cloudwatch:namespace": "bedrock-agentcore"
-                        }
+            }
+        ]
+    }
+
+def permission_policy(account, region):
+    """permissions for the agent runtime role"""
+    return {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Sid": "ECRImageAccess",
+                "Effect": "Allow",
+                "Action": [
+                    "ecr:BatchGetImage",
+                    "ecr:GetDownloadUrlForLayer"
+                ],
+                "Resource": [
+                    f"arn:aws:ecr:{region}:{account}:repository/*"
+                ]
+            },
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "logs:DescribeLogStreams",
+                    "logs:CreateLogGroup"
+                ],
+                "Resource": [
+                    f"arn:aws:logs:{region}:{account}:log-group:/aws/bedrock-agentcore/runtimes/*"
+                ]
+            },
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "logs:DescribeLogGroups"
+                ],
+                "Resource": [
+                    f"arn:aws:logs:{region}:{account}:log-group:*"
+                ]
+            },
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "logs:CreateLogStream",
+                    "logs:PutLogEvents"
+                ],
+                "Resource": [
+                    f"arn:aws:logs:{region}:{account}:log-group:/aws/bedrock-agentcore/runtimes/*:log-stream:*"
+                ]
+            },
+            {
+                "Sid": "ECRTokenAccess",
+                "Effect": "Allow",
+                "Action": [
+                    "ecr:GetAuthorizationToken"
+                ],
+                "Resource": "*"
+            },
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "xray:PutTraceSegments",
+                    "xray:PutTelemetryRecords",
+                    "xray:GetSamplingRules",
+                    "xray:GetSamplingTargets"
+                ],
+                "Resource": ["*"]
+            },
+            {
+                "Effect": "Allow",
+                "Resource": "*",
+                "Action": "cloudwatch:PutMetricData",
+                "Condition": {
+                    "StringEquals": {
+                        "cloudwatch:namespace": "bedrock-agentcore"
                     }
-                },
-                {
-                    "Sid": "GetAgentAccessToken",
-                    "Effect": "Allow",
-                    "Action": [
-                        "bedrock-agentcore:GetWorkloadAccessToken",
-                        "bedrock-agentcore:GetWorkloadAccessTokenForJWT",
-                        "bedrock-agentcore:GetWorkloadAccessTokenForUserId"
-                    ],
-                    "Resource": [
-                        f"arn:aws:bedrock-agentcore:{region}:{account}:workload-identity-directory/default",
-                        f"arn:aws:bedrock-agentcore:{region}:{account}:workload-identity-directory/default/workload-identity/*"
-                    ]
-                },
-                {
-                    "Sid": "BedrockModelInvocation",
-                    "Effect": "Allow",
-                    "Action": [
-                        "bedrock:InvokeModel",
-                        "bedrock:InvokeModelWithResponseStream"
-                    ],
-                    "Resource": [
-                        "arn:aws:bedrock:*::foundation-model/*",
-                        f"arn:aws:bedrock:{region}:{account}:*"
-                    ]
-                },
-                {
-                    "Sid": "CreateMemory",
-                    "Effect": "Allow",
-                    "Action": [
-                        "bedrock-agentcore:CreateMemory",
-                        "bedrock-agentcore:CreateEvent",
-                        "bedrock-agentcore:ListMemories",
-                        "bedrock-agentcore:ListEvents",
-                        "bedrock-agentcore:DeleteMemory",
-                    ],
-                    "Resource": ["*"],
-                },
-                {
-                    "Sid": "RetrieveKB",
-                    "Effect": "Allow",
-                    "Action": [
-                        "bedrock:Retrieve"
-                    ],
-                    "Resource": [f"arn:aws:bedrock:{region}:{account}:knowledge-base/*"]
                 }
-            ]
-        }
+            },
+            {
+                "Sid": "GetAgentAccessToken",
+                "Effect": "Allow",
+                "Action": [
+                    "bedrock-agentcore:GetWorkloadAccessToken",
+                    "bedrock-agentcore:GetWorkloadAccessTokenForJWT",
+                    "bedrock-agentcore:GetWorkloadAccessTokenForUserId"
+                ],
+                "Resource": [
+                    f"arn:aws:bedrock-agentcore:{region}:{account}:workload-identity-directory/default",
+                    f"arn:aws:bedrock-agentcore:{region}:{account}:workload-identity-directory/default/workload-identity/*"
+                ]
+            },
+            {
+                "Sid": "BedrockModelInvocation",
+                "Effect": "Allow",
+                "Action": [
+                    "bedrock:InvokeModel",
+                    "bedrock:InvokeModelWithResponseStream"
+                ],
+                "Resource": [
+                    "arn:aws:bedrock:*::foundation-model/*",
+                    f"arn:aws:bedrock:{region}:{account}:*"
+                ]
+            },
+            {
+                "Sid": "CreateMemory",
+                "Effect": "Allow",
+                "Action": [
+                    "bedrock-agentcore:CreateMemory",
+                    "bedrock-agentcore:CreateEvent",
+                    "bedrock-agentcore:ListMemories",
+                    "bedrock-agentcore:ListEvents",
+                    "bedrock-agentcore:DeleteMemory",
+                ],
+                "Resource": ["*"],
+            },
+            {
+                "Sid": "RetrieveKB",
+                "Effect": "Allow",
+                "Action": [
+                    "bedrock:Retrieve"
+                ],
+                "Resource": [f"arn:aws:bedrock:{region}:{account}:knowledge-base/*"]
+            }
+        ]
+    }
+
+def create_agent_runtime_role(iam_client, role_name, account, region):
+    """Create the IAM role for Bedrock Agent Core Runtime if it doesn't exist.
+    Returns true if the role was created"""
+    try:
+        # Check if role already exists
+        print("checking if role exists\n")
+        iam_client.get_role(RoleName=role_name)
+        return False
+
+    except iam_client.exceptions.NoSuchEntityException:
 
         # Create the role with trust policy
         print("creating runtime role\n")
-        response = iam_client.create_role(
+        iam_client.create_role(
             RoleName=role_name,
-            AssumeRolePolicyDocument=json.dumps(trust_policy),
+            AssumeRolePolicyDocument=json.dumps(trust_policy(account, region)),
             Description="IAM role for Bedrock Agent Core Runtime"
         )
 
@@ -191,124 +213,215 @@ def create_agent_runtime_role():
         iam_client.put_role_policy(
             RoleName=role_name,
             PolicyName="BedrockAgentCoreRuntimePolicy",
-            PolicyDocument=json.dumps(permission_policy)
+            PolicyDocument=json.dumps(permission_policy(account, region))
         )
 
-        # Wait a moment for IAM role to propagate
-        time.sleep(10)
-        return response["Role"]["Arn"]
+        # wait for the role to be visible to IAM. creating/updating the
+        # runtime retries while the role propagates to other services
+        iam_client.get_waiter("role_exists").wait(
+            RoleName=role_name,
+            WaiterConfig={"Delay": 1, "MaxAttempts": 30},
+        )
+        return True
 
     except Exception as e:
         print(f"Error creating IAM role: {e}\n")
         raise
 
 
-def get_agent_runtime_by_name(name):
+def find_first(client, operation, key, matches):
+    """pages through a list operation and returns the first matching item"""
+    paginator = client.get_paginator(operation)
+    for page in paginator.paginate():
+        for item in page.get(key, []):
+            if matches(item):
+                return item
+    return None
+
+
+def get_agent_runtime_by_name(client, name):
     """Check if an agent runtime with the given name exists"""
     try:
         # List all agent runtimes and filter by name
         print("listing agent runtimes\n")
-        response = client.list_agent_runtimes()
-        for runtime in response.get("agentRuntimes", []):
-            if runtime.get("agentRuntimeName") == name:
-                return runtime
-
-        # Handle pagination if there are more results
-        while "nextToken" in response:
-            response = client.list_agent_runtimes(
-                nextToken=response["nextToken"])
-            for runtime in response.get("agentRuntimes", []):
-                if runtime.get("agentRuntimeName") == name:
-                    return runtime
-
-        return None
+        return find_first(client, "list_agent_runtimes", "agentRuntimes",
+                          lambda runtime: runtime.get("agentRuntimeName") == name)
 
     except Exception as e:
         print(f"Error checking for existing agent runtime: {e}")
         return None
 
 
-def get_memory_by_name(name):
+def get_memory_by_name(client, name):
     """Check if a memory with the given name exists"""
     try:
         # List all memories and filter by name
         print("listing memories\n")
-        response = client.list_memories()
-        for memory in response.get("memories", []):
-            if memory.get("id").startswith(name):
-                return memory
-
-        # Handle pagination if there are more results
-        while "nextToken" in response:
-            response = client.list_memories(
-                nextToken=response["nextToken"])
-            for memory in response.get("memories", []):
-                if memory.get("id").startswith(name):
-                    return memory
-        return None
+        return find_first(client, "list_memories", "memories",
+                          lambda memory: memory.get("id").startswith(name))
+
     except Exception as e:
         print(f"Error checking for existing memory: {e}")
         return None
 
 
-# Create the role if it doesn't exist
-create_agent_runtime_role()
-
-# Check if the memory already exists
-existing_memory = get_memory_by_name(app)
-memory_id = None
-if not existing_memory:
-    print(f"creating memory\n")
-    existing_memory = client.create_memory(
-        name=app,
-        description=f"memory for {app}",
-        eventExpiryDuration=30,
-    )
-    memory_id = existing_memory["memory"]["id"]
-else:
-    print("memory found\n")
-    memory_id = existing_memory["id"]
-
-
-# Check if the agent runtime already exists
-existing_runtime = get_agent_runtime_by_name(app)
-
-runtime_params = {
-    "agentRuntimeArtifact": {
-        "containerConfiguration": {
-            "containerUri": image
+def ensure_memory(client, app, existing_memory, timeout):
+    """creates the memory if needed and waits for it to become active.
+    returns the memory id"""
+    if existing_memory:
+        print("memory found\n")
+        memory_id = existing_memory["id"]
+        if existing_memory.get("status", "ACTIVE") == "ACTIVE":
+            return memory_id
+    else:
+        print(f"creating memory\n")
+        response = client.create_memory(
+            name=app,
+            description=f"memory for {app}",
+            eventExpiryDuration=30,
+        )
+        memory_id = response["memory"]["id"]
+
+    memory = poll(
+        lambda: client.get_memory(memoryId=memory_id)["memory"],
+        lambda m: m["status"] in ("ACTIVE", "FAILED"),
+        timeout, f"memory {memory_id}")
+    if memory["status"] != "ACTIVE":
+        raise Exception(f"memory {memory_id} is {memory['status']}")
+    return memory_id
+
+
+def create_or_update_runtime(client, app, existing_runtime, runtime_params, role_timeout):
+    """creates or updates the agent runtime, retrying for up to
+    role_timeout seconds while a newly created role propagates"""
+
+    def call():
+        if existing_runtime:
+
+            # Update the existing agent runtime
+            print(f"Updating existing agent runtime: {app}\n")
+            params = dict(runtime_params,
+                          agentRuntimeId=existing_runtime["agentRuntimeId"])
+            response = client.update_agent_runtime(**params)
+            print(f"Updated agent runtime: {response['agentRuntimeArn']}\n")
+            return response
+
+        # Create a new agent runtime
+        print(f"Creating new agent runtime: {app}\n")
+        return client.create_agent_runtime(agentRuntimeName=app, **runtime_params)
+
+    deadline = time.monotonic() + role_timeout
+    delay = 1
+    while True:
+        try:
+            return call()
+        except client.exceptions.ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code not in ROLE_NOT_READY_ERRORS or time.monotonic() + delay > deadline:
+                raise
+            print(f"{code} (role may still be propagating), retrying in {delay}s\n")
+            time.sleep(delay)
+            delay = min(delay * 2, 15)
+
+
+def wait_for_runtime(client, runtime_id, timeout):
+    """waits for the agent runtime to become READY"""
+    runtime = poll(
+        lambda: client.get_agent_runtime(agentRuntimeId=runtime_id),
+        lambda r: r["status"] not in ("CREATING", "UPDATING"),
+        timeout, f"agent runtime {runtime_id}")
+    if runtime["status"] != "READY":
+        raise Exception(f"agent runtime {runtime_id} is {runtime['status']}")
+    return runtime
+
+
+def deploy(iam_client, client, account, region, app, image, kb, timeout=600):
+    """creates or updates the agent runtime and its dependencies.
+    returns the agent runtime arn and memory id"""
+
+    role_name = f"{app}-AgentRuntimeRole"
+    role_arn = f"arn:aws:iam::{account}:role/{role_name}"
+
+    with timed("total"), ThreadPoolExecutor(max_workers=3) as executor:
+
+        # the role, memory and runtime lookups are independent, so the
+        # role and runtime are looked up in the background
+        with timed("memory lookup"):
+            role_future = executor.submit(
+                create_agent_runtime_role, iam_client, role_name, account, region)
+            runtime_future = executor.submit(
+                get_agent_runtime_by_name, client, app)
+            existing_memory = get_memory_by_name(client, app)
+
+        # the memory is created while the role propagates
+        with timed("memory ready"):
+            memory_id = ensure_memory(client, app, existing_memory, timeout)
+
+        with timed("role ready"):
+            role_created = role_future.result()
+
+        with timed("runtime lookup"):
+            existing_runtime = runtime_future.result()
+
+        runtime_params = {
+            "agentRuntimeArtifact": {
+                "containerConfiguration": {
+                    "containerUri": image
+                }
+            },
+            "environmentVariables": {
+                "APP_NAME": app,
+                "KNOWLEDGE_BASE_ID": kb,
+                "MEMORY_ID": memory_id,
+                # model routing (see router.py) and speculative retrieval
+                # (see speculation.py) settings are passed through
+                **{k: v for k, v in os.environ.items() if k in RUNTIME_SETTINGS},
+                # as are outbound limiter overrides (see limiter.py)
+                **{k: v for k, v in os.environ.items() if k.startswith("LIMITER_")},
+            },
+            "networkConfiguration": {"networkMode": "PUBLIC"},
+            "protocolConfiguration": {"serverProtocol": "HTTP"},
+            "roleArn": role_arn,
         }
-    },
-    "environmentVariables": {
-        "APP_NAME": app,
-        "KNOWLEDGE_BASE_ID": kb,
-        "MEMORY_ID": memory_id,
-    },
-    "networkConfiguration": {"networkMode": "PUBLIC"},
-    "protocolConfiguration": {"serverProtocol": "HTTP"},
-    "roleArn": role_arn,
-}
-
-if existing_runtime:
-
-    # Update the existing agent runtime
-    print(f"Updating existing agent runtime: {app}\n")
-    runtime_id = existing_runtime["agentRuntimeId"]
-    runtime_params["agentRuntimeId"] = runtime_id
-    response = client.update_agent_runtime(**runtime_params)
-    print(f"Updated agent runtime: {response['agentRuntimeArn']}\n")
-
-else:
-
-    # Create a new agent runtime
-    print(f"Creating new agent runtime: {app}\n")
-    runtime_name = runtime_params["agentRuntimeName"] = app
-    response = client.create_agent_runtime(**runtime_params)
-
-
-print(f"export AGENTCORE_RUNTIME_ARN={response['agentRuntimeArn']}\n")
-print(f"export MEMORY_ID={memory_id}\n")
-
-# Write the ARN to a file for reference (used by client.py)
-with open("agent_runtime_arn", "w") as f:
-    f.write(response["agentRuntimeArn"])
+
+        with timed("runtime create/update"):
+            response = create_or_update_runtime(
+                client, app, existing_runtime, runtime_params,
+                role_timeout=60 if role_created else 0)
+
+        with timed("runtime ready"):
+            wait_for_runtime(client, response["agentRuntimeId"], timeout)
+
+    return response["agentRuntimeArn"], memory_id
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Create or update an agent runtime")
+    parser.add_argument("--region", default="us-east-1", help="AWS region")
+    parser.add_argument("--account", required=True, help="AWS account ID")
+    parser.add_argument("--app", required=True, help="Agent runtime name")
+    parser.add_argument("--image", required=True, help="Agent runtime image")
+    parser.add_argument("--kb", required=True, help="knowledge base")
+    parser.add_argument("--timeout", type=int, default=600,
+                        help="seconds to wait for the memory and runtime to be ready")
+    args = parser.parse_args()
+
+    # Initialize IAM and Bedrock clients
+    iam_client = boto3.client("iam")
+    client = boto3.client("bedrock-agentcore-control")
+
+    agent_runtime_arn, memory_id = deploy(
+        iam_client, client, args.account, args.region,
+        args.app, args.image, args.kb, args.timeout)
+
+    print(f"export AGENTCORE_RUNTIME_ARN={agent_runtime_arn}\n")
+    print(f"export MEMORY_ID={memory_id}\n")
+
+    # Write the ARN to a file for reference (used by client.py)
+    with open("agent_runtime_arn", "w") as f:
+        f.write(agent_runtime_arn)
+
+
+if __name__ == "__main__":
+    main()
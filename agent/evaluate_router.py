@@ -0,0 +1,106 @@
+import json
+import argparse
+import router
+
+parser = argparse.ArgumentParser(
+    description="Evaluate the model router against labelled questions")
+parser.add_argument("--data", default="router_eval.jsonl",
+                    help="jsonl file with one question per line: "
+                    '{"question": "...", "depth": 0, "retrieval_score": 0.7, "label": "fast|strong"} '
+                    "(depth and retrieval_score are optional)")
+parser.add_argument("--threshold", type=float, default=router.ROUTING_THRESHOLD,
+                    help="routing threshold to evaluate")
+parser.add_argument("--sweep", action="store_true",
+                    help="also evaluate thresholds from 0.1 to 0.9")
+parser.add_argument("--fast_seconds", type=float, default=2.0,
+                    help="typical answer time for the fast model (for the latency estimate)")
+parser.add_argument("--strong_seconds", type=float, default=6.0,
+                    help="typical answer time for the strong model (for the latency estimate)")
+parser.add_argument("--verbose", action="store_true",
+                    help="print every misrouted question")
+args = parser.parse_args()
+
+
+def load(path):
+    examples = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            example = json.loads(line)
+            if example["label"] not in ("fast", "strong"):
+                raise ValueError(f"label must be fast or strong: {line}")
+            scores = None
+            if example.get("retrieval_score") is not None:
+                scores = [example["retrieval_score"]]
+            example["features"] = router.features(
+                example["question"], example.get("depth", 0), scores)
+            examples.append(example)
+    return examples
+
+
+def evaluate(examples, threshold):
+    """routes every example and compares with its label"""
+    confusion = {(label, name): 0
+                 for label in ("fast", "strong") for name in ("fast", "strong")}
+    misrouted = []
+    for example in examples:
+        route = router.route(example["features"], policy="auto", threshold=threshold)
+        confusion[(example["label"], route.name)] += 1
+        if route.name != example["label"]:
+            misrouted.append((example, route))
+
+    n = len(examples)
+    strong = confusion[("fast", "strong")] + confusion[("strong", "strong")]
+    seconds = (strong * args.strong_seconds + (n - strong) * args.fast_seconds) / n
+    return {
+        "threshold": threshold,
+        "accuracy": (confusion[("fast", "fast")] + confusion[("strong", "strong")]) / n,
+        # hard questions answered by the fast model (hurts quality)
+        "under_routed": confusion[("strong", "fast")] / n,
+        # easy questions answered by the strong model (hurts latency and cost)
+        "over_routed": confusion[("fast", "strong")] / n,
+        "strong_share": strong / n,
+        "est_seconds": seconds,
+        "confusion": confusion,
+        "misrouted": misrouted,
+    }
+
+
+def main():
+    examples = load(args.data)
+    print(f"{len(examples)} questions from {args.data}")
+
+    result = evaluate(examples, args.threshold)
+    c = result["confusion"]
+    print(f"\nthreshold {args.threshold}")
+    print(f"{'':>16} {'routed fast':>12} {'routed strong':>14}")
+    for label in ("fast", "strong"):
+        print(f"{'labelled ' + label:>16} {c[(label, 'fast')]:>12} {c[(label, 'strong')]:>14}")
+    print(f"\naccuracy      {result['accuracy']:.1%}")
+    print(f"under routed  {result['under_routed']:.1%}")
+    print(f"over routed   {result['over_routed']:.1%}")
+    print(f"strong share  {result['strong_share']:.1%}")
+
+    # compared with sending everything to the strong model
+    est = result["est_seconds"]
+    print(f"est. seconds  {est:.2f} per question "
+          f"(vs {args.strong_seconds:.2f} all strong, {1 - est / args.strong_seconds:.0%} faster)")
+
+    if args.verbose:
+        print("\nmisrouted:")
+        for example, route in result["misrouted"]:
+            print(f"  {example['label']:>6} -> {route.name:<6} {route.score:.2f} "
+                  f"[{','.join(route.reasons)}] {example['question']}")
+
+    if args.sweep:
+        print(f"\n{'threshold':>9} {'accuracy':>9} {'under':>7} {'over':>7} {'strong':>7} {'seconds':>8}")
+        for i in range(1, 10):
+            r = evaluate(examples, i / 10)
+            print(f"{r['threshold']:>9.1f} {r['accuracy']:>9.1%} {r['under_routed']:>7.1%} "
+                  f"{r['over_routed']:>7.1%} {r['strong_share']:>7.1%} {r['est_seconds']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
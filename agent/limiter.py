@@ -0,0 +1,283 @@
+import os
+import math
+import time
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import metrics
+except ImportError:
+    # the agent doesn't collect metrics, limiters report through snapshot()
+    metrics = None
+
+# adaptive limits for calls to downstream apis (bedrock, agentcore).
+# each api gets a limiter that adjusts how many calls may be in flight:
+# the limit grows by one per round of successful calls, and shrinks
+# (multiplicatively) when calls are throttled or latency rises well above
+# its long term average (AIMD). calls over the limit wait in a bounded queue
+# and are shed when it's full. an optional token bucket caps the call rate,
+# e.g. at a requests per minute quota.
+#
+# settings can be overridden per limiter with LIMITER_<NAME>_<SETTING>, e.g.
+# LIMITER_MEMORY_MAX=32 or LIMITER_MODEL_FAST_RATE=2
+
+# errors that mean the service is overloaded
+THROTTLE_ERROR_CODES = {
+    "ThrottlingException",
+    "ThrottledException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+}
+
+DEFAULTS = {
+    "initial": 8,        # starting concurrency limit
+    "min": 1,            # lowest concurrency limit
+    "max": 64,           # highest concurrency limit
+    "queue": 64,         # calls that may wait for a slot
+    "max_wait": 10.0,    # longest a call waits for a slot (seconds)
+    "rate": 0.0,         # calls per second (0 disables the token bucket)
+    "burst": 0.0,        # token bucket size (default: one second of calls)
+    "backoff": 0.7,      # limit multiplier when throttled or latency rises
+    "latency_tolerance": 2.0,  # short/long latency ratio that counts as rising (0 disables)
+}
+
+
+class Overloaded(Exception):
+    """raised when a call is shed instead of being sent"""
+
+    def __init__(self, name, reason, retry_after):
+        super().__init__(f"{name} is overloaded ({reason})")
+        self.name = name
+        self.reason = reason
+        self.retry_after = retry_after
+        self.status_code = 503
+
+
+def is_throttle(e):
+    """whether an exception means the downstream service is overloaded"""
+    if type(e).__name__ == "ModelThrottledException":
+        return True
+    response = getattr(e, "response", None)
+    if isinstance(response, dict):
+        return response.get("Error", {}).get("Code") in THROTTLE_ERROR_CODES
+    return False
+
+
+class TokenBucket():
+    """Allows `rate` calls per second, with bursts of up to `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self, max_wait):
+        """takes a token, returning how long to wait until it's valid,
+        or None (taking nothing) if that would be longer than max_wait.
+        not thread safe, called under the limiter's lock"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(0.0, (1 - self.tokens) / self.rate)
+        if wait > max_wait:
+            return None
+        self.tokens -= 1
+        return wait
+
+
+class Limiter():
+    """Adaptive concurrency limit (AIMD) for calls to one downstream api"""
+
+    def __init__(self, name, initial, min, max, queue, max_wait, rate=0, burst=0,
+                 backoff=0.7, latency_tolerance=2.0):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min
+        self.max_limit = max
+        self.max_queue = queue
+        self.max_wait = max_wait
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        # (min and max are settings here, not the builtins)
+        if rate > 0:
+            self.bucket = TokenBucket(rate, burst or (rate if rate > 1 else 1))
+        else:
+            self.bucket = None
+        self.in_flight = 0
+        self.queued = 0
+        self.counts = Counter()
+        self._short_latency = None  # fast moving average
+        self._long_latency = None   # slow moving average
+        self._samples = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+        if metrics is not None:
+            metrics.gauge("limiter_limit", fn=lambda: round(self.limit, 2), limiter=name)
+            metrics.gauge("limiter_in_flight", fn=lambda: self.in_flight, limiter=name)
+            metrics.gauge("limiter_queued", fn=lambda: self.queued, limiter=name)
+            self._wait_time = metrics.histogram("limiter_wait_seconds", limiter=name)
+
+    def _count(self, event):
+        self.counts[event] += 1
+        if metrics is not None:
+            metrics.counter("limiter_events", limiter=self.name, event=event).inc()
+
+    def retry_after(self):
+        """estimates how many seconds until a slot frees up"""
+        latency = self._short_latency or 1
+        return max(1, math.ceil(latency * (self.queued + 1) / max(self.limit, 1)))
+
+    def _reject(self, reason):
+        self._count(f"rejected_{reason}")
+        logging.warning(f"limiter {self.name} shed a call: {reason}")
+        raise Overloaded(self.name, reason, self.retry_after())
+
+    def acquire(self, timeout=None):
+        """blocks until the call may be sent, or raises Overloaded.
+        waits at most max_wait seconds, or timeout if it is shorter.
+        returns the start time to pass to release()"""
+
+        wait = self.max_wait if timeout is None else min(self.max_wait, timeout)
+        start = time.monotonic()
+        deadline = start + wait
+        with self._condition:
+            if self.bucket is not None:
+                delay = self.bucket.reserve(wait)
+                if delay is None:
+                    self._reject("rate")
+            if self.in_flight >= int(self.limit) or self.queued:
+                if self.queued >= self.max_queue:
+                    self._reject("queue_full")
+                self.queued += 1
+                try:
+                    while self.in_flight >= int(self.limit):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject("wait_timeout")
+                        self._condition.wait(remaining)
+                finally:
+                    self.queued -= 1
+            self.in_flight += 1
+        if self.bucket is not None and delay > 0:
+            time.sleep(delay)
+        now = time.monotonic()
+        if metrics is not None:
+            self._wait_time.observe(now - start)
+        return now
+
+    def _decrease(self, reason):
+        """multiplicative decrease, at most once per typical call duration
+        so that a burst of throttled calls only counts once"""
+        now = time.monotonic()
+        if now - self._last_decrease < max(self._short_latency or 0, 0.1):
+            return
+        self._last_decrease = now
+        old = self.limit
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        self._count(f"decrease_{reason}")
+        logging.warning(f"limiter {self.name}: {reason}, limit {old:.1f} -> {self.limit:.1f}")
+
+    def release(self, start, outcome="ok"):
+        """ends a call. outcome is "ok", "throttled" or "error" """
+        latency = time.monotonic() - start
+        with self._condition:
+            busy = self.in_flight >= int(self.limit) or self.queued > 0
+            self.in_flight -= 1
+            self._count(outcome)
+            if outcome == "throttled":
+                self._decrease("throttled")
+            elif outcome == "ok":
+                if self._short_latency is None:
+                    self._short_latency = self._long_latency = latency
+                self._short_latency += 0.2 * (latency - self._short_latency)
+                self._long_latency += 0.02 * (latency - self._long_latency)
+                self._samples += 1
+                if (self.latency_tolerance > 0 and self._samples >= 20 and
+                        self._short_latency > self._long_latency * self.latency_tolerance):
+                    self._decrease("latency")
+                elif busy:
+                    # additive increase: +1 after a full limit's worth of calls,
+                    # only while the limit is actually holding calls back
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, timeout=None):
+        """runs the body as a limited call"""
+        start = self.acquire(timeout)
+        outcome = "ok"
+        try:
+            yield
+        except Exception as e:
+            outcome = "throttled" if is_throttle(e) else "error"
+            raise
+        finally:
+            self.release(start, outcome)
+
+    def snapshot(self):
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "latency": round(self._short_latency or 0, 3),
+            "events": dict(self.counts),
+        }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get(name, **defaults):
+    """returns the limiter for a downstream api, creating it with the
+    given defaults, which LIMITER_<NAME>_<SETTING> variables override"""
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            settings = {**DEFAULTS, **defaults}
+            for key, value in settings.items():
+                env = os.getenv(f"LIMITER_{name.upper()}_{key.upper()}")
+                if env is not None:
+                    settings[key] = type(value)(float(env))
+            limiter = _limiters[name] = Limiter(name, **settings)
+            logging.info(f"limiter {name}: {settings}")
+        return limiter
+
+
+def snapshot():
+    """returns the state of all limiters"""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.snapshot() for limiter in limiters}
+
+
+def instrument(client, limiter, timeout=None):
+    """limits all calls made by a boto3 client, using its event hooks"""
+
+    def before_call(context, **kwargs):
+        context["limiter_start"] = limiter.acquire(timeout)
+
+    def after_call(http_response, parsed, context, **kwargs):
+        start = context.pop("limiter_start", None)
+        if start is None:
+            return
+        if http_response.status_code < 300:
+            limiter.release(start, "ok")
+        elif parsed.get("Error", {}).get("Code") in THROTTLE_ERROR_CODES:
+            limiter.release(start, "throttled")
+        else:
+            limiter.release(start, "error")
+
+    def after_call_error(context, **kwargs):
+        start = context.pop("limiter_start", None)
+        if start is not None:
+            limiter.release(start, "error")
+
+    events = client.meta.events
+    events.register("before-call", before_call)
+    events.register("after-call", after_call)
+    events.register("after-call-error", after_call_error)
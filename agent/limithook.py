@@ -0,0 +1,37 @@
+import logging
+from strands.hooks import HookProvider, HookRegistry
+from strands.experimental.hooks import BeforeModelInvocationEvent, AfterModelInvocationEvent
+from limiter import is_throttle
+
+
+class ModelLimitHookProvider(HookProvider):
+    """Sends each model call through an outbound limiter (see limiter.py).
+    The slot is held for the whole streamed response. limiter_for(agent)
+    returns the limiter for the agent's current model"""
+
+    def __init__(self, limiter_for):
+        self.limiter_for = limiter_for
+        self._call = None  # (limiter, start) of the model call in progress
+
+    def before_model_invocation(self, event: BeforeModelInvocationEvent):
+        """waits for a slot, or raises limiter.Overloaded"""
+        limiter = self.limiter_for(event.agent)
+        self._call = (limiter, limiter.acquire())
+
+    def after_model_invocation(self, event: AfterModelInvocationEvent):
+        if self._call is None:
+            return
+        (limiter, start), self._call = self._call, None
+        if event.exception is None:
+            limiter.release(start, "ok")
+        elif is_throttle(event.exception):
+            logging.warning(f"model call throttled ({limiter.name})")
+            limiter.release(start, "throttled")
+        else:
+            limiter.release(start, "error")
+
+    def register_hooks(self, registry: HookRegistry):
+        registry.add_callback(BeforeModelInvocationEvent,
+                              self.before_model_invocation)
+        registry.add_callback(AfterModelInvocationEvent,
+                              self.after_model_invocation)
@@ -1,13 +1,29 @@
 from os import getenv
+import time
+import asyncio
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
 from typing import Dict, Any
 from datetime import datetime
 from strands import Agent
+from strands.models import BedrockModel
 import boto3
 from strands import tool
-from memoryhook import MemoryHookProvider
+from strands.hooks import MessageAddedEvent
+from memoryhook import MemoryHookProvider, load_recent_turns
+from deadline import DeadlineHookProvider
+from limithook import ModelLimitHookProvider
+import limiter
+from sessions import SessionLocks
+from usage import InvocationUsage
+import router
+import speculation
+import profiler
 from bedrock_agentcore.memory import MemoryClient
 
 
@@ -46,8 +62,46 @@ memory_client = MemoryClient(region_name=region)
 # Initialize Bedrock Agent Runtime client for knowledge base retrieval
 bedrock_agent_runtime = boto3.client('bedrock-agent-runtime', region_name=region)
 
+# outbound limiters (see limiter.py) for the knowledge base and memory apis.
+# model calls are limited per model by ModelLimitHookProvider
+limiter.instrument(bedrock_agent_runtime, limiter.get(
+    "knowledge_base", initial=8, max=32, queue=32))
+limiter.instrument(memory_client.gmdp_client, limiter.get(
+    "memory", initial=8, max=64, queue=64, max_wait=5.0))
+
+def kb_retrieve(query, results=5):
+    """queries the knowledge base and returns the retrieval results"""
+    response = bedrock_agent_runtime.retrieve(
+        knowledgeBaseId=kb_id,
+        retrievalQuery={
+            'text': query
+        },
+        retrievalConfiguration={
+            'vectorSearchConfiguration': {
+                'numberOfResults': results
+            }
+        }
+    )
+    return response.get('retrievalResults', [])
+
+def format_results(results):
+    """combines the retrieved text chunks into the retrieve tool's result"""
+    retrieved_texts = []
+    for result in results:
+        content = result.get('content', {})
+        text = content.get('text', '')
+        if text:
+            retrieved_texts.append(text)
+
+    if retrieved_texts:
+        logging.info(f"Retrieved {len(retrieved_texts)} text chunks")
+        return '\n\n'.join(retrieved_texts)
+    else:
+        logging.warning("No relevant information found in knowledge base")
+        return "No relevant information found in the knowledge base for this query."
+
 @tool
-def retrieve(query: str) -> str:
+def retrieve(query: str, agent=None) -> str:
     """
     Retrieve relevant information from the knowledge base based on the user's query.
     
@@ -59,39 +113,23 @@ def retrieve(query: str) -> str:
     """
     try:
         logging.info(f"Retrieving information for query: {query}")
-        
-        response = bedrock_agent_runtime.retrieve(
-            knowledgeBaseId=kb_id,
-            retrievalQuery={
-                'text': query
-            },
-            retrievalConfiguration={
-                'vectorSearchConfiguration': {
-                    'numberOfResults': 5
-                }
-            }
-        )
-        
-        # Extract and combine the retrieved text chunks
-        retrieved_texts = []
-        for result in response.get('retrievalResults', []):
-            content = result.get('content', {})
-            text = content.get('text', '')
-            if text:
-                retrieved_texts.append(text)
-        
-        if retrieved_texts:
-            combined_text = '\n\n'.join(retrieved_texts)
-            logging.info(f"Retrieved {len(retrieved_texts)} text chunks")
-            return combined_text
-        else:
-            logging.warning("No relevant information found in knowledge base")
-            return "No relevant information found in the knowledge base for this query."
+
+        # the question may already have been retrieved speculatively
+        results = None
+        if speculator is not None and agent is not None:
+            results = speculator.serve(agent, query)
+        if results is None:
+            results = kb_retrieve(query)
+        return format_results(results)
             
     except Exception as e:
         logging.error(f"Error retrieving from knowledge base: {str(e)}")
         return f"Error retrieving information: {str(e)}"
 
+# retrieves for each question as soon as it arrives (see speculation.py)
+speculator = speculation.Speculator(kb_retrieve) if speculation.SPECULATIVE_RETRIEVAL else None
+logging.warning(f"SPECULATIVE_RETRIEVAL = {speculation.SPECULATIVE_RETRIEVAL}")
+
 app = FastAPI(title="AI Chat Accelerator Agent", version="1.0.0")
 
 system_prompt = """
@@ -101,13 +139,211 @@ If the knowledge base does provide information about a question, you should say
 You should try to completely avoid outputting bulleted lists and sub lists, unless it's absolutely necessary.
 """
 
-# we have a single stateful agent per container session id
-strands_agent = None
+# AgentCore runs a container per runtime session, but when sessions
+# share a container (e.g. running locally) each gets its own agent
+agents = OrderedDict()
+agents_lock = threading.Lock()
+max_sessions = int(getenv("MAX_SESSIONS", 100))
+
+# agent invocations block for the whole generation, so they run on
+# a worker pool to keep the event loop (and /ping) responsive
+agent_workers = int(getenv("AGENT_WORKERS", 8))
+executor = ThreadPoolExecutor(max_workers=agent_workers,
+                              thread_name_prefix="agent")
+logging.warning(f"AGENT_WORKERS = {agent_workers}")
+
+# turns within a session run one at a time, in order
+session_locks = SessionLocks()
+
+# each turn is answered by a fast or a strong model (see router.py).
+# models are shared by all sessions
+models = {
+    model_id: BedrockModel(model_id=model_id)
+    for model_id in {router.FAST_MODEL, router.STRONG_MODEL}
+}
+logging.warning(f"ROUTING_POLICY = {router.ROUTING_POLICY}")
+
+# with the auto policy, also score how well the knowledge base
+# covers the question (adds a retrieval call before each turn)
+routing_retrieval = getenv("ROUTING_RETRIEVAL", "false").lower() == "true"
+
+# model calls are limited per route. a slot is held for the whole
+# response and answer times vary, so only throttling lowers the limit
+model_limiters = {
+    router.STRONG_MODEL: limiter.get(
+        "model_strong", initial=4, max=32, queue=32, max_wait=60.0, latency_tolerance=0.0),
+    router.FAST_MODEL: limiter.get(
+        "model_fast", initial=4, max=32, queue=32, max_wait=60.0, latency_tolerance=0.0),
+}
+
+
+def model_limiter(strands_agent):
+    return model_limiters[strands_agent.model.get_config()["model_id"]]
+
+# conversation history for new agents is loaded in the background,
+# in parallel with waiting for the session and creating the agent.
+# if it takes longer than MEMORY_PREFETCH_TIMEOUT the agent starts without it
+memory_executor = ThreadPoolExecutor(
+    max_workers=int(getenv("MEMORY_PREFETCH_WORKERS", 4)),
+    thread_name_prefix="memory")
+memory_prefetch_timeout = float(getenv("MEMORY_PREFETCH_TIMEOUT", 2))
+
+# answer used when the time budget runs out before the agent is done
+OUT_OF_TIME_ANSWER = "Sorry, I ran out of time while researching this question. Please try again."
+
+
+def prefetch_history(user_id, session_id):
+    """starts loading conversation history if the session
+    doesn't have an agent yet. returns a future or None"""
+    with agents_lock:
+        if session_id in agents:
+            return None
+    return memory_executor.submit(
+        load_recent_turns, memory_client, memory_id, user_id, session_id)
+
+
+def get_agent(user_id, session_id, history=None):
+    """returns the agent for a session, creating it if needed.
+    history is an optional future from prefetch_history()"""
+
+    with agents_lock:
+        strands_agent = agents.get(session_id)
+        if strands_agent is not None:
+            agents.move_to_end(session_id)
+            return strands_agent
+
+    # initialize a new agent for each new runtime session
+    # conversation state will be persisted to agentcore memory
+    logging.warning("agent initializing")
+    if history is None:
+        history = prefetch_history(user_id, session_id)
+
+    # for resumed sessions, conversation history from
+    # agentcore memory will be appended to the system prompt
+    # (this will be fixed in the future)
+    # the model is picked for each turn by route_question()
+    strands_agent = Agent(
+        model=models[router.FAST_MODEL],
+        system_prompt=system_prompt,
+        tools=[retrieve],
+        hooks=[
+            MemoryHookProvider(
+                memory_client,
+                memory_id,
+                user_id,
+                session_id,
+                history=history,
+                history_timeout=memory_prefetch_timeout,
+            ),
+            DeadlineHookProvider(),
+            ModelLimitHookProvider(model_limiter),
+        ],
+    )
+
+    with agents_lock:
+        agents[session_id] = strands_agent
+        while len(agents) > max_sessions:
+            agents.popitem(last=False)
+    return strands_agent
+
+
+def route_question(strands_agent, prompt, speculative=None):
+    """picks the model for the next turn"""
+
+    # number of earlier questions in this session
+    depth = sum(1 for m in strands_agent.messages
+                if m["role"] == "user" and any("text" in c for c in m["content"]))
+
+    retrieval_scores = None
+    if router.ROUTING_POLICY == "auto" and routing_retrieval:
+        # a quick look at the knowledge base tells how well
+        # the question is covered by the documents
+        # (reusing the speculative retrieval for the question, if any)
+        results = None
+        if speculative is not None:
+            results = speculative.results(speculation.SPECULATIVE_RETRIEVAL_WAIT)
+        try:
+            if results is None:
+                results = kb_retrieve(prompt, 3)
+            retrieval_scores = [r.get("score", 0) for r in results[:3]]
+        except Exception as e:
+            logging.warning(f"routing retrieval failed: {e}")
+
+    route = router.route(router.features(prompt, depth, retrieval_scores))
+    logging.warning(
+        f"routing to {route.name} model (score {route.score:.2f}, {','.join(route.reasons)})")
+    return route
+
+
+def speculative_prompt(speculative, prompt, deadline):
+    """returns the prompt with the speculative retrieval's results as a
+    retrieve call the model already made, if they are ready in time.
+    otherwise returns the prompt as is"""
+    wait = speculation.SPECULATIVE_RETRIEVAL_WAIT
+    if deadline is not None:
+        wait = min(wait, max(0, deadline - time.monotonic()))
+    results = speculative.results(wait)
+    if results is None:
+        logging.warning("speculative retrieval not ready, the model will retrieve itself")
+        return prompt
+    speculative.injected = True
+    return ([{"role": "user", "content": [{"text": prompt}]}]
+            + speculative.messages(format_results(results)))
+
+
+def run_agent(user_id, session_id, prompt, deadline, history=None, speculative=None,
+              record=True):
+    """invokes the session's agent (blocking). speculative is an optional
+    speculative retrieval for the prompt (see speculation.py). the turn
+    is only stored in memory if record is true.
+    returns the response message, stop reason and usage"""
+
+    strands_agent = get_agent(user_id, session_id, history)
+    # read by the memory hook (the session lock keeps invocations apart)
+    strands_agent.state.set("record", record)
+    route = route_question(strands_agent, prompt, speculative)
+    strands_agent.model = models[route.model_id]
+    usage = InvocationUsage(strands_agent)
+
+    # invoke the agent
+    # conversation history should be persisted in
+    # local memory and agentcore memory
+    agent_input = prompt
+    if speculative is not None:
+        speculator.attach(strands_agent, speculative, deadline)
+        agent_input = speculative_prompt(speculative, prompt, deadline)
+    try:
+        result = strands_agent(prompt=agent_input, deadline=deadline)
+    finally:
+        usage = usage.result()
+        if speculative is not None:
+            # the outcome is counted even if the invocation failed
+            usage["speculation"] = speculator.detach(
+                strands_agent, usage["tools"].get("retrieve", {}).get("calls", 0))
+    message = result.message
+    stop_reason = result.stop_reason
+
+    if result.state.get("deadline_exceeded"):
+        # the tool loop was cut short, so close out the turn
+        # to keep the conversation history well formed
+        stop_reason = "deadline"
+        message = {
+            "role": "assistant",
+            "content": [{"text": OUT_OF_TIME_ANSWER}],
+        }
+        strands_agent.messages.append(message)
+        strands_agent.hooks.invoke_callbacks(
+            MessageAddedEvent(agent=strands_agent, message=message))
+
+    usage.setdefault("speculation", "off")
+    usage["route"] = route.name
+    usage["route_score"] = round(route.score, 3)
+    usage["route_reasons"] = ",".join(route.reasons)
+    return message, stop_reason, usage
 
 
 @app.post("/invocations", response_model=InvocationResponse)
 async def invoke_agent(request: Request):
-    global strands_agent
     try:
         # validate input
         req = await request.json()
@@ -132,41 +368,44 @@ async def invoke_agent(request: Request):
                 detail="Missing header X-Amzn-Bedrock-AgentCore-Runtime-Session-Id"
             )
 
-        # initialize a new agent for each new runtime container session
-        # conversation state will be persisted to agentcore memory
-        if strands_agent is None:
-            logging.warning("agent initializing")
-
-            # for resumed sessions, conversation history from
-            # agentcore memory will be appended to the system prompt
-            # (this will be fixed in the future)
-            strands_agent = Agent(
-                # model="us.anthropic.claude-3-5-sonnet-20241022-v2:0",
-                model="us.anthropic.claude-3-5-haiku-20241022-v1:0",
-                system_prompt=system_prompt,
-                tools=[retrieve],
-                hooks=[MemoryHookProvider(
-                    memory_client,
-                    memory_id,
-                    user_id,
-                    session_id
-                )],
-            )
+        # false when the question may also be sent to another runtime (a
+        # hedged request), in which case the caller records the answer it uses
+        record = invoke_input.get("record", True) is not False
+
+        # the caller's remaining time budget (in seconds), if any. a budget
+        # of 0 (the caller is out of time) stops the tool loop right away
+        deadline = None
+        timeout = invoke_input.get("timeout")
+        if timeout is not None:
+            deadline = time.monotonic() + float(timeout)
 
-        # invoke the agent
-        # conversation history should be persisted in
-        # local memory and agentcore memory
-        result = strands_agent(prompt=prompt)
+        # start loading history for new sessions (and retrieving for the
+        # question, if speculating) before waiting for the session lock
+        # and a worker
+        history = prefetch_history(user_id, session_id)
+        speculative = speculator.start(prompt) if speculator is not None else None
+
+        message, stop_reason, usage = await session_locks.run_in_executor(
+            session_id, executor, run_agent, user_id, session_id, prompt, deadline,
+            history, speculative, record)
 
         # send response to client
         response = {
-            "message": result.message,
+            "message": message,
+            "stop_reason": stop_reason,
+            "usage": usage,
             "timestamp": datetime.utcnow().isoformat(),
-            "model": "strands-agent",
+            "model": usage["model"],
         }
         return InvocationResponse(output=response)
 
     except Exception as e:
+        # a model call shed by its limiter reaches here wrapped by the event loop
+        overloaded = e if isinstance(e, limiter.Overloaded) else e.__cause__
+        if isinstance(overloaded, limiter.Overloaded):
+            raise HTTPException(
+                status_code=503, detail=str(overloaded),
+                headers={"Retry-After": str(overloaded.retry_after)})
         raise HTTPException(
             status_code=500, detail=f"Agent processing failed: {str(e)}")
 
@@ -175,6 +414,37 @@ async def invoke_agent(request: Request):
 async def ping():
     return {"status": "healthy"}
 
+
+@app.get("/limits")
+async def limits():
+    """current state of the outbound limiters"""
+    return limiter.snapshot()
+
+
+@app.get("/speculation")
+async def speculation_stats():
+    """outcomes of speculative retrievals since the agent started"""
+    if speculator is None:
+        return {"enabled": False}
+    return {"enabled": True, **speculator.snapshot()}
+
+
+@app.get("/debug/profile")
+async def debug_profile(request: Request):
+    """samples all thread stacks (including the event loop)
+    and returns them as collapsed stacks or speedscope json"""
+    loop = asyncio.get_running_loop()
+    try:
+        # sample from the default pool so busy agent workers don't block it
+        body, content_type = await loop.run_in_executor(
+            None, profiler.profile, request.query_params,
+            request.headers.get("Authorization"))
+    except profiler.ProfileError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    if content_type == "application/json":
+        return body
+    return PlainTextResponse(body)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8080)
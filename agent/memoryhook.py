@@ -1,48 +1,154 @@
 import logging
 import json
-from strands.hooks import AgentInitializedEvent, HookProvider, HookRegistry, MessageAddedEvent
+from datetime import datetime, timezone
+from concurrent.futures import TimeoutError
+from strands.hooks import AgentInitializedEvent, BeforeInvocationEvent, HookProvider, HookRegistry, MessageAddedEvent
 from bedrock_agentcore.memory import MemoryClient
 
+# each user's session summaries (first question, turn count, last activity)
+# are kept as blob events in this session, so the web app can list a user's
+# conversations with one read. a session's new summary replaces its previous
+# one (which is deleted), so there's one summary event per session
+SUMMARY_SESSION_ID = "session-summaries"
+
+# longest first question stored in a summary
+SUMMARY_QUESTION_LENGTH = 200
+
+# most summary events scanned when looking up a resumed session's summary
+SUMMARY_MAX_EVENTS = 500
+
+
+def load_summary(memory_client: MemoryClient, memory_id: str, actor_id: str, session_id: str):
+    """returns the latest summary of a session and its event id, or
+    (None, None) if it isn't among the newest SUMMARY_MAX_EVENTS summaries"""
+    params = {
+        "memoryId": memory_id,
+        "actorId": actor_id,
+        "sessionId": SUMMARY_SESSION_ID,
+        "includePayloads": True,
+        "maxResults": 100,
+    }
+    scanned = 0
+    while scanned < SUMMARY_MAX_EVENTS:
+        try:
+            response = memory_client.gmdp_client.list_events(**params)
+        except memory_client.gmdp_client.exceptions.ResourceNotFoundException:
+            return None, None
+        for event in response.get("events", []):
+            for item in event.get("payload", []):
+                summary = item.get("blob")
+                if isinstance(summary, dict) and summary.get("sessionId") == session_id:
+                    return summary, event["eventId"]
+        scanned += len(response.get("events", []))
+        if "nextToken" not in response:
+            break
+        params["nextToken"] = response["nextToken"]
+    return None, None
+
+
+def summarize_session(memory_client: MemoryClient, memory_id: str, actor_id: str, session_id: str):
+    """builds a session's summary from all of its events, as the web app's
+    backfill does (see database.summarize)"""
+    params = {
+        "memoryId": memory_id,
+        "actorId": actor_id,
+        "sessionId": session_id,
+        "includePayloads": True,
+        "maxResults": 100,
+    }
+    events = []
+    while True:
+        response = memory_client.gmdp_client.list_events(**params)
+        events.extend(response.get("events", []))
+        if "nextToken" not in response:
+            break
+        params["nextToken"] = response["nextToken"]
+    events.sort(key=lambda e: e["eventTimestamp"])
+    questions = [item["conversational"].get("content", {}).get("text", "")
+                 for event in events for item in event.get("payload", [])
+                 if item.get("conversational", {}).get("role") == "USER"]
+    return {
+        "sessionId": session_id,
+        "firstQuestion": questions[0][:SUMMARY_QUESTION_LENGTH] if questions else "No question found",
+        "turns": len(questions),
+    }
+
+
+def load_recent_turns(memory_client: MemoryClient, memory_id: str, actor_id: str, session_id: str, k=5):
+    """Load the last k conversation turns from memory"""
+    logging.warning("get_last_k_turns()")
+    return memory_client.get_last_k_turns(
+        memory_id=memory_id,
+        actor_id=actor_id,
+        session_id=session_id,
+        k=k
+    )
+
 
 class MemoryHookProvider(HookProvider):
 
-    def __init__(self, memory_client: MemoryClient, memory_id: str, actor_id: str, session_id: str):
+    def __init__(self, memory_client: MemoryClient, memory_id: str, actor_id: str, session_id: str,
+                 history=None, history_timeout=2.0):
+        """history is an optional future for load_recent_turns() that was
+        started ahead of time. it is awaited (for up to history_timeout
+        seconds) before the first invocation, otherwise history is loaded
+        when the agent is initialized"""
         self.memory_client = memory_client
         self.memory_id = memory_id
         self.actor_id = actor_id
         self.session_id = session_id
+        self.history = history
+        self.history_timeout = history_timeout
+        self.summary = None
+        # the summary event the next summary replaces
+        self.summary_event_id = None
+
+    def _add_history(self, agent, recent_turns):
+        """add recent conversation turns to the agent's system prompt"""
+        if recent_turns:
+            # Format conversation history for context
+            context_messages = []
+            for turn in recent_turns:
+                for message in turn:
+                    role = message['role']
+                    content = message['content']['text']
+                    context_messages.append(f"{role}: {content}")
+
+            context = "\n".join(context_messages)
+            # Add context to agent's system prompt?
+            agent.system_prompt += f"\n\nRecent conversation:\n{context}"
+            logging.warning(
+                f"✅ Loaded {len(recent_turns)} conversation turns")
 
     def on_agent_initialized(self, event: AgentInitializedEvent):
-        """Load recent conversation history when agent starts"""
+        """Load recent conversation history when agent starts,
+        unless it is being prefetched"""
 
         logging.warning("on_agent_initialized")
+        if self.history is not None:
+            return
         try:
             # Load the last 5 conversation turns from memory
-            logging.warning("get_last_k_turns()")
-            recent_turns = self.memory_client.get_last_k_turns(
-                memory_id=self.memory_id,
-                actor_id=self.actor_id,
-                session_id=self.session_id,
-                k=5
-            )
-            if recent_turns:
-                # Format conversation history for context
-                context_messages = []
-                for turn in recent_turns:
-                    for message in turn:
-                        role = message['role']
-                        content = message['content']['text']
-                        context_messages.append(f"{role}: {content}")
-
-                context = "\n".join(context_messages)
-                # Add context to agent's system prompt?
-                event.agent.system_prompt += f"\n\nRecent conversation:\n{context}"
-                logging.warning(
-                    f"✅ Loaded {len(recent_turns)} conversation turns")
+            recent_turns = load_recent_turns(
+                self.memory_client, self.memory_id, self.actor_id, self.session_id)
+            self._add_history(event.agent, recent_turns)
 
         except Exception as e:
             logging.error(f"Memory load error: {e}")
 
+    def on_before_invocation(self, event: BeforeInvocationEvent):
+        """wait for prefetched history before the first model call"""
+        if self.history is None:
+            return
+        history, self.history = self.history, None
+        try:
+            self._add_history(event.agent, history.result(timeout=self.history_timeout))
+        except TimeoutError:
+            logging.warning(
+                f"memory took longer than {self.history_timeout}s, continuing without history")
+        except Exception as e:
+            logging.error(f"Memory load error: {e}")
+
     def _is_tool_message(self, content):
         for msg in content:
             if "toolUse" in msg or "toolResult" in msg:
@@ -52,6 +158,9 @@ class MemoryHookProvider(HookProvider):
     def on_message_added(self, event: MessageAddedEvent):
         """Store messages in memory"""
         logging.warning("on_message_added")
+        if event.agent.state.get("record") is False:
+            # a question that may be hedged, the caller records the turn
+            return
 
         # get last message
         last_msg = event.agent.messages[-1]
@@ -64,15 +173,68 @@ class MemoryHookProvider(HookProvider):
         if "text" in content[0]:
             text = content[0]["text"]
             logging.warning(f'memory.create_event("{role}", "{text}")')
-            self.memory_client.create_event(
+            memory_event = self.memory_client.create_event(
                 memory_id=self.memory_id,
                 actor_id=self.actor_id,
                 session_id=self.session_id,
                 messages=[(text, role)]
             )
+            self._update_summary(role, text, memory_event)
         else:
             logging.error("no text")
 
+    def _update_summary(self, role, text, memory_event):
+        """keeps the session's summary up to date. it is written when a
+        session starts and at the end of each turn"""
+        try:
+            if role == "user":
+                if self.summary is None:
+                    # a resumed session's summary is loaded once
+                    self.summary, self.summary_event_id = load_summary(
+                        self.memory_client, self.memory_id, self.actor_id, self.session_id)
+                    if self.summary is None:
+                        # a new session, or one whose summary is older than
+                        # the ones scanned. its events (which include this
+                        # question) tell which, rather than restarting it
+                        self.summary = summarize_session(
+                            self.memory_client, self.memory_id, self.actor_id, self.session_id)
+                        self._record_activity(memory_event)
+                        # so the session is listed right away
+                        self._write_summary()
+                        return
+                self.summary["turns"] += 1
+                self._record_activity(memory_event)
+            elif role == "assistant" and self.summary is not None:
+                self._record_activity(memory_event)
+                self._write_summary()
+        except Exception as e:
+            logging.error(f"session summary error: {e}")
+
+    def _record_activity(self, memory_event):
+        self.summary["lastActivity"] = datetime.now(timezone.utc).isoformat()
+        self.summary["lastEventId"] = memory_event.get("eventId")
+
+    def _write_summary(self):
+        """writes the summary in place of the session's previous one"""
+        response = self.memory_client.gmdp_client.create_event(
+            memoryId=self.memory_id,
+            actorId=self.actor_id,
+            sessionId=SUMMARY_SESSION_ID,
+            eventTimestamp=datetime.now(timezone.utc),
+            payload=[{"blob": dict(self.summary)}],
+        )
+        previous, self.summary_event_id = self.summary_event_id, response["event"]["eventId"]
+        if previous is not None:
+            # deleted after the new one is written, so the session is
+            # always listed. if this fails, listing uses the newer one
+            self.memory_client.gmdp_client.delete_event(
+                memoryId=self.memory_id,
+                actorId=self.actor_id,
+                sessionId=SUMMARY_SESSION_ID,
+                eventId=previous,
+            )
+
     def register_hooks(self, registry: HookRegistry):
         registry.add_callback(MessageAddedEvent, self.on_message_added)
         registry.add_callback(AgentInitializedEvent, self.on_agent_initialized)
+        registry.add_callback(BeforeInvocationEvent, self.on_before_invocation)
@@ -0,0 +1,79 @@
+import argparse
+import asyncio
+import time
+import uuid
+import httpx
+
+parser = argparse.ArgumentParser(
+    description="Measure /ping latency while the agent is busy answering questions")
+parser.add_argument("--url", default="http://localhost:8080", help="agent url")
+parser.add_argument("--concurrency", type=int, default=8,
+                    help="number of concurrent invocations")
+parser.add_argument("--duration", type=float, default=30,
+                    help="seconds to run the load for")
+parser.add_argument("--interval", type=float, default=0.1,
+                    help="seconds between pings")
+parser.add_argument("--prompt", default="Who are you and what can you do?")
+args = parser.parse_args()
+
+
+def summarize(name, latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        print(f"{name}: no samples")
+        return
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000
+
+    print(f"{name}: n={len(latencies)} p50={pct(50):.1f}ms p99={pct(99):.1f}ms max={latencies[-1] * 1000:.1f}ms")
+
+
+async def ping(client, until):
+    """pings until the deadline, returning the latencies"""
+    latencies = []
+    while time.monotonic() < until:
+        start = time.monotonic()
+        response = await client.get(f"{args.url}/ping")
+        response.raise_for_status()
+        latencies.append(time.monotonic() - start)
+        await asyncio.sleep(args.interval)
+    return latencies
+
+
+async def invoke(client, until, results):
+    """sends invocations back to back until the deadline"""
+    session_id = str(uuid.uuid4())
+    while time.monotonic() < until:
+        start = time.monotonic()
+        response = await client.post(
+            f"{args.url}/invocations",
+            headers={"X-Amzn-Bedrock-AgentCore-Runtime-Session-Id": session_id},
+            json={"input": {"user_id": "pingtest", "prompt": args.prompt}},
+            timeout=None,
+        )
+        results.append((response.status_code, time.monotonic() - start))
+
+
+async def main():
+    async with httpx.AsyncClient() as client:
+        print("measuring idle ping latency...")
+        idle = await ping(client, time.monotonic() + 5)
+
+        print(f"measuring ping latency with {args.concurrency} concurrent invocations...")
+        until = time.monotonic() + args.duration
+        results = []
+        invocations = [invoke(client, until, results)
+                       for _ in range(args.concurrency)]
+        _, loaded = await asyncio.gather(
+            asyncio.gather(*invocations), ping(client, until))
+
+    print()
+    summarize("ping (idle)", idle)
+    summarize("ping (under load)", loaded)
+    errors = len([status for status, _ in results if status != 200])
+    summarize(f"invocations ({errors} errors)",
+              [latency for _, latency in results])
+
+
+asyncio.run(main())
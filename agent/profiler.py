@@ -0,0 +1,236 @@
+import os
+import sys
+import time
+import hmac
+import logging
+import threading
+from collections import Counter, deque
+
+# sampling profiler for all threads in the process, based on sys._current_frames().
+# output is either collapsed stacks (one "frame;frame;frame count" line per
+# stack, for flamegraph.pl, speedscope, etc.) or a speedscope json profile
+
+# /debug/profile is disabled unless a token is configured
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+
+# limits for on-demand profiles
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 60))
+PROFILE_DEFAULT_HZ = float(os.getenv("PROFILE_DEFAULT_HZ", 100))
+PROFILE_MAX_HZ = 1000
+
+# always-on low frequency profiling over a rolling window (0 disables it)
+PROFILE_CONTINUOUS_HZ = float(os.getenv("PROFILE_CONTINUOUS_HZ", 0))
+PROFILE_CONTINUOUS_WINDOW = int(os.getenv("PROFILE_CONTINUOUS_WINDOW", 300))
+
+# stacks deeper than this are truncated (keeping the outermost frames)
+MAX_DEPTH = 128
+
+_labels = {}
+
+
+def _label(code):
+    """frame name for a code object (cached, as this is the hot path)"""
+    label = _labels.get(code)
+    if label is None:
+        filename = code.co_filename
+        # keep the last two path components, e.g. "flask/app.py"
+        parts = filename.replace("\\", "/").rsplit("/", 2)
+        short = "/".join(parts[-2:])
+        label = _labels[code] = f"{code.co_name} ({short}:{code.co_firstlineno})"
+    return label
+
+
+def _thread_names():
+    return {t.ident: t.name for t in threading.enumerate()}
+
+
+def _sample_once(counts, names, exclude):
+    """adds the current stack of every thread (except exclude) to counts"""
+    for ident, frame in sys._current_frames().items():
+        if ident in exclude:
+            continue
+        stack = []
+        while frame is not None and len(stack) < MAX_DEPTH:
+            stack.append(_label(frame.f_code))
+            frame = frame.f_back
+        name = names.get(ident)
+        if name is None:
+            names.update(_thread_names())
+            name = names.get(ident, f"thread-{ident}")
+        stack.append(name)
+        stack.reverse()
+        counts[tuple(stack)] += 1
+
+
+def sample(seconds, hz=PROFILE_DEFAULT_HZ):
+    """samples all other threads for the given number of seconds (blocking).
+    returns a Counter of stacks (tuples, outermost frame first)"""
+    counts = Counter()
+    names = _thread_names()
+    exclude = {threading.get_ident()}
+    interval = 1 / hz
+    deadline = time.monotonic() + seconds
+    next_sample = time.monotonic()
+    while next_sample < deadline:
+        _sample_once(counts, names, exclude)
+        next_sample += interval
+        delay = next_sample - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # fell behind (e.g. waiting on the GIL), skip missed samples
+            next_sample = time.monotonic()
+    return counts
+
+
+class RollingProfiler():
+    """Samples all threads at a low rate in a background thread and
+    keeps the last `window` seconds of stacks, in one second buckets"""
+
+    def __init__(self, hz, window):
+        self.hz = hz
+        self.window = window
+        self._buckets = deque()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="rolling-profiler", daemon=True)
+        self._thread.start()
+        logging.info(
+            f"rolling profiler sampling at {self.hz}hz over {self.window}s")
+
+    def _run(self):
+        names = _thread_names()
+        exclude = {threading.get_ident()}
+        interval = 1 / self.hz
+        while True:
+            second = int(time.time())
+            with self._lock:
+                if not self._buckets or self._buckets[-1][0] != second:
+                    self._buckets.append((second, Counter()))
+                while self._buckets and self._buckets[0][0] <= second - self.window:
+                    self._buckets.popleft()
+                counts = self._buckets[-1][1]
+                _sample_once(counts, names, exclude)
+            time.sleep(interval)
+
+    def snapshot(self, seconds=None):
+        """stacks from the last `seconds` (default: the whole window)"""
+        since = int(time.time()) - (seconds or self.window)
+        counts = Counter()
+        with self._lock:
+            for second, bucket in self._buckets:
+                if second > since:
+                    counts.update(bucket)
+        return counts
+
+
+rolling = None
+if PROFILE_CONTINUOUS_HZ > 0:
+    rolling = RollingProfiler(PROFILE_CONTINUOUS_HZ, PROFILE_CONTINUOUS_WINDOW)
+    rolling.start()
+
+# only one on-demand profile runs at a time
+_profile_lock = threading.Lock()
+
+
+class ProfileError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def authorized(authorization):
+    """checks an "Authorization: Bearer <token>" header value"""
+    if not PROFILE_TOKEN or not authorization:
+        return False
+    scheme, _, token = authorization.partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(
+        token.strip().encode(), PROFILE_TOKEN.encode())
+
+
+def profile(args, authorization):
+    """runs a profile for a /debug/profile request.
+    args are the query string parameters:
+        seconds  how long to sample for (default 10)
+        hz       samples per second (default 100)
+        mode     "rolling" returns the always-on profiler's window instead
+        format   "collapsed" (default) or "speedscope"
+    returns (body, content type). raises ProfileError"""
+
+    if not PROFILE_TOKEN:
+        raise ProfileError(404, "profiling is disabled (PROFILE_TOKEN is not set)")
+    if not authorized(authorization):
+        raise ProfileError(401, "unauthorized")
+
+    fmt = args.get("format", "collapsed")
+    if fmt not in ("collapsed", "speedscope"):
+        raise ProfileError(400, "format must be collapsed or speedscope")
+    try:
+        seconds = float(args.get("seconds", 10))
+        hz = float(args.get("hz", PROFILE_DEFAULT_HZ))
+    except ValueError:
+        raise ProfileError(400, "seconds and hz must be numbers")
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise ProfileError(400, f"seconds must be between 0 and {PROFILE_MAX_SECONDS}")
+    if not 0 < hz <= PROFILE_MAX_HZ:
+        raise ProfileError(400, f"hz must be between 0 and {PROFILE_MAX_HZ}")
+
+    if args.get("mode") == "rolling":
+        if rolling is None:
+            raise ProfileError(404, "rolling profiler is disabled (PROFILE_CONTINUOUS_HZ is not set)")
+        counts = rolling.snapshot(seconds if "seconds" in args else None)
+        name = f"rolling {rolling.window}s @ {rolling.hz}hz"
+    else:
+        if not _profile_lock.acquire(blocking=False):
+            raise ProfileError(409, "a profile is already running")
+        try:
+            logging.info(f"profiling for {seconds}s at {hz}hz")
+            counts = sample(seconds, hz)
+        finally:
+            _profile_lock.release()
+        name = f"{seconds}s @ {hz}hz"
+
+    if fmt == "speedscope":
+        return speedscope(counts, name), "application/json"
+    return collapsed(counts), "text/plain"
+
+
+def collapsed(counts):
+    """collapsed stack format: "frame;frame;frame count" per line"""
+    return "".join(f"{';'.join(stack)} {count}\n"
+                   for stack, count in counts.most_common())
+
+
+def speedscope(counts, name):
+    """speedscope sampled profile (https://www.speedscope.app)"""
+    frames = []
+    index = {}
+    samples = []
+    weights = []
+    for stack, count in counts.items():
+        sample = []
+        for frame in stack:
+            i = index.get(frame)
+            if i is None:
+                i = index[frame] = len(frames)
+                frames.append({"name": frame})
+            sample.append(i)
+        samples.append(sample)
+        weights.append(count)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "none",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        }],
+        "exporter": "profiler.py",
+    }
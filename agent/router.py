@@ -0,0 +1,103 @@
+import re
+import logging
+from os import getenv
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+# picks a fast or a strong model for each turn, using cheap signals that are
+# available before the model is called
+
+FAST_MODEL = getenv("FAST_MODEL", "us.anthropic.claude-3-5-haiku-20241022-v1:0")
+STRONG_MODEL = getenv("STRONG_MODEL", "us.anthropic.claude-3-5-sonnet-20241022-v2:0")
+
+# fast: always use the fast model, strong: always use the strong model,
+# auto: score each question and use the strong model for hard ones
+ROUTING_POLICY = getenv("ROUTING_POLICY", "fast")
+
+# questions scoring at least this use the strong model (auto policy)
+ROUTING_THRESHOLD = float(getenv("ROUTING_THRESHOLD", 0.35))
+
+# scale for each signal: a question this long, a conversation this deep,
+# or a top retrieval score this low counts fully towards the strong model
+ROUTING_LONG_QUESTION_WORDS = int(getenv("ROUTING_LONG_QUESTION_WORDS", 40))
+ROUTING_DEEP_CONVERSATION_TURNS = int(getenv("ROUTING_DEEP_CONVERSATION_TURNS", 8))
+ROUTING_MIN_RETRIEVAL_SCORE = float(getenv("ROUTING_MIN_RETRIEVAL_SCORE", 0.4))
+
+# words that suggest multi-step reasoning
+REASONING_WORDS = re.compile(
+    r"\b(why|compare|comparison|difference|differences|versus|vs|tradeoffs?|"
+    r"explain|analy[sz]e|evaluate|pros|cons|step by step|implications?|"
+    r"recommend|should i|plan|strategy)\b", re.IGNORECASE)
+
+# how much each signal contributes to the score
+WEIGHTS = {
+    "length": 0.35,
+    "reasoning": 0.35,
+    "depth": 0.15,
+    "retrieval": 0.35,
+}
+
+
+@dataclass
+class Features():
+    """signals used to route a question"""
+    words: int
+    reasoning_words: int
+    depth: int
+    # relevance of the best knowledge base result (0-1), if known
+    retrieval_score: Optional[float] = None
+
+
+@dataclass
+class Route():
+    name: str
+    model_id: str
+    score: float
+    reasons: List[str] = field(default_factory=list)
+
+
+def features(question, depth, retrieval_scores=None):
+    """extracts routing features from a question, the number of
+    previous turns in the conversation and optional retrieval scores"""
+    return Features(
+        words=len(question.split()),
+        reasoning_words=len(REASONING_WORDS.findall(question)),
+        depth=depth,
+        retrieval_score=max(retrieval_scores) if retrieval_scores else None,
+    )
+
+
+def score(f: Features):
+    """returns a difficulty score between 0 and 1 and the
+    signals that contributed to it"""
+    contributions = {
+        "length": min(f.words / ROUTING_LONG_QUESTION_WORDS, 1),
+        "reasoning": min(f.reasoning_words / 2, 1),
+        "depth": min(f.depth / ROUTING_DEEP_CONVERSATION_TURNS, 1),
+    }
+    if f.retrieval_score is not None:
+        # weak matches mean the answer has to be pieced together
+        contributions["retrieval"] = min(
+            max(ROUTING_MIN_RETRIEVAL_SCORE - f.retrieval_score, 0)
+            / ROUTING_MIN_RETRIEVAL_SCORE * 2, 1)
+    total = sum(WEIGHTS[k] * v for k, v in contributions.items())
+    reasons = [k for k, v in contributions.items() if v >= 0.5]
+    return min(total, 1.0), reasons
+
+
+def route(f: Features, policy=None, threshold=None):
+    """picks the model for a question"""
+    policy = policy or ROUTING_POLICY
+    threshold = ROUTING_THRESHOLD if threshold is None else threshold
+    if policy == "fast":
+        return Route("fast", FAST_MODEL, 0.0, ["policy"])
+    if policy == "strong":
+        return Route("strong", STRONG_MODEL, 1.0, ["policy"])
+    if policy != "auto":
+        logging.warning(f"unknown ROUTING_POLICY {policy}, using fast")
+        return Route("fast", FAST_MODEL, 0.0, ["policy"])
+
+    s, reasons = score(f)
+    if s >= threshold:
+        return Route("strong", STRONG_MODEL, s, reasons)
+    return Route("fast", FAST_MODEL, s, reasons)
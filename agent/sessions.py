@@ -0,0 +1,46 @@
+import asyncio
+
+
+class SessionLocks():
+    """Serializes invocations within a session while letting different
+    sessions run in parallel. asyncio locks are fair, so turns are
+    processed in the order they arrive. Must be used from the event loop."""
+
+    def __init__(self):
+        self._locks = {}
+        self._holders = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    async def run_in_executor(self, session_id, executor, fn, *args):
+        """runs fn(*args) on executor in the session's turn, returning its
+        result. the session stays locked until fn returns, even if the
+        caller is cancelled (e.g. the client disconnected) while it runs,
+        since it can't be stopped on its thread"""
+        lock = self._locks.setdefault(session_id, asyncio.Lock())
+        self._holders[session_id] = self._holders.get(session_id, 0) + 1
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._forget(session_id)
+            raise
+        try:
+            future = asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+        except BaseException:
+            self._release(session_id)
+            raise
+        future.add_done_callback(lambda _: self._release(session_id))
+        # cancelling the caller doesn't cancel (and so release) the future
+        return await asyncio.shield(future)
+
+    def _release(self, session_id):
+        self._locks[session_id].release()
+        self._forget(session_id)
+
+    def _forget(self, session_id):
+        # forget the lock once nobody is using or waiting for it
+        self._holders[session_id] -= 1
+        if self._holders[session_id] == 0:
+            del self._holders[session_id]
+            del self._locks[session_id]
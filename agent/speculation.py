@@ -0,0 +1,179 @@
+import re
+import time
+import uuid
+import logging
+import threading
+from os import getenv
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+# speculative knowledge base retrieval. the system prompt has the model
+# retrieve before answering, so a typical turn is: model call (asks for the
+# retrieve tool), retrieval, model call (answers). with speculation the
+# retrieval for the question is started as soon as the request arrives, in
+# parallel with loading history and setting up the agent, and its results
+# are given to the first model call as if it had already called the tool,
+# which saves a model call. if they aren't ready in time, a later retrieve
+# call for a similar query is served from them instead
+
+# opt in, since answers for follow up questions ("and for lost packages?")
+# may be worse with results for the question as asked
+SPECULATIVE_RETRIEVAL = getenv("SPECULATIVE_RETRIEVAL", "false").lower() == "true"
+
+# how long the first model call waits for the retrieval (seconds)
+SPECULATIVE_RETRIEVAL_WAIT = float(getenv("SPECULATIVE_RETRIEVAL_WAIT", 1.0))
+
+# longest a retrieve tool call waits for the retrieval before retrieving
+# itself (seconds), less if the invocation's deadline is sooner
+SPECULATIVE_SERVE_WAIT = float(getenv("SPECULATIVE_SERVE_WAIT", 5.0))
+
+# share of words a tool query must have in common with the question
+# (jaccard similarity) to be served from the speculative retrieval
+SPECULATIVE_MATCH = float(getenv("SPECULATIVE_MATCH", 0.6))
+
+# retrievals running at once
+SPECULATIVE_WORKERS = int(getenv("SPECULATIVE_WORKERS", 4))
+
+WORD = re.compile(r"\w+")
+
+
+def _words(text):
+    return set(WORD.findall(text.lower()))
+
+
+def similarity(a, b):
+    """share of words two queries have in common"""
+    a, b = _words(a), _words(b)
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class Speculation():
+    """A knowledge base retrieval for a question, started before the
+    agent knows whether it needs it"""
+
+    def __init__(self, query, future):
+        self.query = query
+        self.future = future
+        self.injected = False  # given to the first model call
+        self.served = 0        # retrieve tool calls answered from it
+        self.failed = False
+        self.deadline = None   # the invocation's (monotonic time), if any
+
+    def results(self, timeout):
+        """returns the retrieval results, or None if they aren't ready
+        within timeout seconds or the retrieval failed"""
+        try:
+            return self.future.result(timeout=timeout)
+        except TimeoutError:
+            return None
+        except Exception as e:
+            if not self.failed:
+                logging.warning(f"speculative retrieval failed: {e}")
+            self.failed = True
+            return None
+
+    def matches(self, query):
+        return similarity(self.query, query) >= SPECULATIVE_MATCH
+
+    def messages(self, text):
+        """the retrieve tool call and its result, as conversation messages"""
+        tool_use_id = f"speculative-{uuid.uuid4().hex[:16]}"
+        return [
+            {"role": "assistant", "content": [{"toolUse": {
+                "toolUseId": tool_use_id,
+                "name": "retrieve",
+                "input": {"query": self.query},
+            }}]},
+            {"role": "user", "content": [{"toolResult": {
+                "toolUseId": tool_use_id,
+                "status": "success",
+                "content": [{"text": text}],
+            }}]},
+        ]
+
+    def outcome(self, retrieve_calls):
+        """how the speculation turned out, given the number of retrieve
+        tool calls in the invocation:
+          hit: given to the model, which answered without retrieving again
+          hit_retrieved: given to the model, which also retrieved
+          served: too late for the first model call, but served a tool call
+          late: too late, and not used
+          failed: the retrieval failed"""
+        if self.failed:
+            return "failed"
+        if self.injected:
+            return "hit_retrieved" if retrieve_calls > 0 else "hit"
+        if self.served:
+            return "served"
+        return "late"
+
+
+class Speculator():
+    """Starts speculative retrievals and tracks the one for each agent
+    invocation, so its retrieve tool can be served from it"""
+
+    def __init__(self, retrieve, workers=SPECULATIVE_WORKERS):
+        self.retrieve = retrieve
+        self.counts = Counter()
+        self._active = {}  # id(agent) -> speculation
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="speculate")
+
+    def start(self, query):
+        """starts retrieving for a question. doesn't block"""
+        return Speculation(query, self._executor.submit(self.retrieve, query))
+
+    def attach(self, agent, speculation, deadline=None):
+        """makes a speculation available to an agent's retrieve calls,
+        until the invocation's deadline"""
+        speculation.deadline = deadline
+        with self._lock:
+            self._active[id(agent)] = speculation
+
+    def detach(self, agent, retrieve_calls):
+        """ends an agent's speculation, returning its outcome"""
+        with self._lock:
+            speculation = self._active.pop(id(agent), None)
+            if speculation is None:
+                return None
+            outcome = speculation.outcome(retrieve_calls)
+            self.counts[outcome] += 1
+        return outcome
+
+    def serve(self, agent, query):
+        """returns the results of the agent's speculation if it matches the
+        query and hasn't already been given to the model, otherwise None
+        (including when it isn't ready in time)"""
+        with self._lock:
+            speculation = self._active.get(id(agent))
+        if speculation is None or speculation.injected or not speculation.matches(query):
+            return None
+        start = time.monotonic()
+        # it was started before the model asked, so waiting
+        # for it is usually quicker than retrieving again
+        wait = SPECULATIVE_SERVE_WAIT
+        if speculation.deadline is not None:
+            wait = min(wait, max(0, speculation.deadline - start))
+        results = speculation.results(wait)
+        if results is None:
+            if not speculation.failed:
+                logging.warning(f"speculative retrieval not ready after {wait:.2f}s, retrieving")
+            return None
+        speculation.served += 1
+        logging.info(
+            f"retrieve({query!r}) served from speculation after {time.monotonic() - start:.2f}s")
+        return results
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self.counts)
+        total = sum(counts.values())
+        # speculations that saved the model a retrieval
+        hits = counts.get("hit", 0) + counts.get("served", 0)
+        return {
+            "outcomes": counts,
+            "hit_rate": round(hits / total, 3) if total else None,
+        }
@@ -0,0 +1,210 @@
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from botocore.exceptions import ClientError
+import deploy
+
+# tests for deploy.py against stub iam and bedrock-agentcore-control
+# clients (no aws calls are made). run from agent/ with:
+#
+#   python -m unittest test_deploy
+
+
+def client_error(code, operation):
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+class NoSuchEntity(Exception):
+    pass
+
+
+class FakeClock():
+    """stands in for time.monotonic and time.sleep, so that backoff
+    and timeouts run instantly"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakePaginator():
+
+    def __init__(self, pages, before=None):
+        self.pages = pages
+        self.before = before
+
+    def paginate(self):
+        if self.before:
+            self.before()
+        return iter(self.pages)
+
+
+class FakeIam():
+    """iam client for a role that doesn't exist yet"""
+
+    exceptions = SimpleNamespace(NoSuchEntityException=NoSuchEntity)
+
+    def __init__(self, before_get_role=None):
+        self.before_get_role = before_get_role
+        self.calls = []
+
+    def get_role(self, RoleName):
+        if self.before_get_role:
+            self.before_get_role()
+        self.calls.append("get_role")
+        raise NoSuchEntity(RoleName)
+
+    def create_role(self, **kwargs):
+        self.calls.append("create_role")
+
+    def put_role_policy(self, **kwargs):
+        self.calls.append("put_role_policy")
+
+    def get_waiter(self, name):
+        return SimpleNamespace(wait=lambda **kwargs: self.calls.append(f"wait {name}"))
+
+
+class FakeControl():
+    """bedrock-agentcore-control client with an active memory and
+    no agent runtime yet. runtime_errors are raised by the first
+    create/update calls, memory_statuses are returned by get_memory"""
+
+    exceptions = SimpleNamespace(ClientError=ClientError)
+
+    def __init__(self, memories=(), runtime_errors=(), memory_statuses=(),
+                 before_list=None):
+        self.memories = list(memories)
+        self.runtime_errors = list(runtime_errors)
+        self.memory_statuses = list(memory_statuses)
+        self.before_list = before_list or {}
+        self.runtime_calls = 0
+
+    def get_paginator(self, operation):
+        key = {"list_memories": "memories", "list_agent_runtimes": "agentRuntimes"}[operation]
+        items = self.memories if operation == "list_memories" else []
+        return FakePaginator([{key: items}], self.before_list.get(operation))
+
+    def create_memory(self, name, **kwargs):
+        return {"memory": {"id": f"{name}-abc123"}}
+
+    def get_memory(self, memoryId):
+        status = self.memory_statuses.pop(0) if self.memory_statuses else "ACTIVE"
+        return {"memory": {"id": memoryId, "status": status}}
+
+    def create_agent_runtime(self, agentRuntimeName, **kwargs):
+        self.runtime_calls += 1
+        if self.runtime_errors:
+            raise self.runtime_errors.pop(0)
+        return {"agentRuntimeId": f"{agentRuntimeName}-rt",
+                "agentRuntimeArn": f"arn:aws:bedrock-agentcore:us-east-1:123456789012:runtime/{agentRuntimeName}-rt"}
+
+    def update_agent_runtime(self, agentRuntimeId, **kwargs):
+        self.runtime_calls += 1
+        return {"agentRuntimeId": agentRuntimeId,
+                "agentRuntimeArn": f"arn:aws:bedrock-agentcore:us-east-1:123456789012:runtime/{agentRuntimeId}"}
+
+    def get_agent_runtime(self, agentRuntimeId):
+        return {"agentRuntimeId": agentRuntimeId, "status": "READY"}
+
+
+class DeployTest(unittest.TestCase):
+
+    def setUp(self):
+        # deploy prints its progress
+        patcher = mock.patch("builtins.print")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fake_clock(self):
+        clock = FakeClock()
+        for name in ("monotonic", "sleep"):
+            patcher = mock.patch.object(deploy.time, name, getattr(clock, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return clock
+
+    def test_retries_while_role_propagates(self):
+        clock = self.fake_clock()
+        client = FakeControl(runtime_errors=[
+            client_error("ValidationException", "CreateAgentRuntime"),
+            client_error("AccessDeniedException", "CreateAgentRuntime"),
+        ])
+
+        response = deploy.create_or_update_runtime(client, "app", None, {}, role_timeout=60)
+
+        self.assertEqual(response["agentRuntimeId"], "app-rt")
+        self.assertEqual(client.runtime_calls, 3)
+        self.assertEqual(clock.sleeps, [1, 2])
+
+    def test_role_retries_stop_at_timeout(self):
+        clock = self.fake_clock()
+        client = FakeControl(runtime_errors=[
+            client_error("ValidationException", "CreateAgentRuntime")] * 10)
+
+        with self.assertRaises(ClientError):
+            deploy.create_or_update_runtime(client, "app", None, {}, role_timeout=5)
+        self.assertLessEqual(clock.now, 5)
+        self.assertEqual(clock.sleeps, [1, 2])
+
+    def test_other_errors_are_not_retried(self):
+        self.fake_clock()
+        client = FakeControl(runtime_errors=[
+            client_error("ConflictException", "CreateAgentRuntime")])
+
+        with self.assertRaises(ClientError):
+            deploy.create_or_update_runtime(client, "app", None, {}, role_timeout=60)
+        self.assertEqual(client.runtime_calls, 1)
+
+    def test_poll_times_out(self):
+        clock = self.fake_clock()
+        with mock.patch.object(deploy.random, "uniform", return_value=1.0):
+            with self.assertRaisesRegex(Exception, "timed out after 20s waiting for memory"):
+                deploy.poll(lambda: "CREATING", lambda status: status == "ACTIVE",
+                            20, "memory")
+        # backs off 1, 2, 4, 8 and gives up rather than sleeping past the timeout
+        self.assertEqual(clock.sleeps, [1, 2, 4, 8])
+
+    def test_memory_that_fails_to_activate(self):
+        self.fake_clock()
+        client = FakeControl(memory_statuses=["CREATING", "FAILED"])
+        with self.assertRaisesRegex(Exception, "is FAILED"):
+            deploy.ensure_memory(client, "app", None, timeout=60)
+
+    def test_lookups_run_in_parallel(self):
+        # the role, runtime and memory lookups each wait for the other two
+        # to start, which only finishes if they run at the same time
+        barrier = threading.Barrier(3, timeout=5)
+        met = []
+
+        def meet(name):
+            def wait():
+                barrier.wait()
+                met.append(name)
+            return wait
+
+        iam = FakeIam(before_get_role=meet("role"))
+        client = FakeControl(
+            memories=[{"id": "app-abc123", "status": "ACTIVE"}],
+            before_list={"list_memories": meet("memory"),
+                         "list_agent_runtimes": meet("runtime")})
+
+        arn, memory_id = deploy.deploy(iam, client, "123456789012", "us-east-1",
+                                       "app", "image:latest", "kb-123")
+
+        self.assertEqual(sorted(met), ["memory", "role", "runtime"])
+        self.assertEqual(memory_id, "app-abc123")
+        self.assertTrue(arn.endswith("runtime/app-rt"))
+        self.assertEqual(iam.calls, ["get_role", "create_role", "put_role_policy",
+                                     "wait role_exists"])
+
+
+if __name__ == "__main__":
+    unittest.main()
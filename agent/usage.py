@@ -0,0 +1,54 @@
+import time
+
+# the tool that queries the knowledge base
+KB_TOOL = "retrieve"
+
+
+def _totals(event_loop_metrics):
+    """cumulative counters from an agent's event loop metrics"""
+    usage = event_loop_metrics.accumulated_usage
+    return {
+        "input_tokens": usage.get("inputTokens", 0),
+        "output_tokens": usage.get("outputTokens", 0),
+        "total_tokens": usage.get("totalTokens", 0),
+        "cache_read_input_tokens": usage.get("cacheReadInputTokens", 0),
+        "cache_write_input_tokens": usage.get("cacheWriteInputTokens", 0),
+        "model_cycles": event_loop_metrics.cycle_count,
+        "model_latency_ms": event_loop_metrics.accumulated_metrics.get("latencyMs", 0),
+        "tools": {
+            name: (tool.call_count, tool.error_count, tool.total_time)
+            for name, tool in event_loop_metrics.tool_metrics.items()
+        },
+    }
+
+
+class InvocationUsage():
+    """Token usage and timings for a single invocation. An agent's metrics
+    accumulate over all turns in its session, so this reports the
+    difference between before and after the invocation."""
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.before = _totals(agent.event_loop_metrics)
+        self.start = time.monotonic()
+
+    def result(self):
+        after = _totals(self.agent.event_loop_metrics)
+        usage = {k: v - self.before[k] for k, v in after.items() if k != "tools"}
+
+        tools = {}
+        for name, (calls, errors, seconds) in after["tools"].items():
+            calls0, errors0, seconds0 = self.before["tools"].get(name, (0, 0, 0))
+            if calls > calls0:
+                tools[name] = {
+                    "calls": calls - calls0,
+                    "errors": errors - errors0,
+                    "seconds": round(seconds - seconds0, 3),
+                }
+        usage["tool_calls"] = sum(t["calls"] for t in tools.values())
+        usage["tool_seconds"] = round(sum(t["seconds"] for t in tools.values()), 3)
+        usage["kb_retrieval_seconds"] = tools.get(KB_TOOL, {}).get("seconds", 0)
+        usage["tools"] = tools
+        usage["agent_seconds"] = round(time.monotonic() - self.start, 3)
+        usage["model"] = self.agent.model.get_config().get("model_id")
+        return usage
@@ -0,0 +1,123 @@
+"""
+writes session summaries for conversations that were started before the
+agent kept them (see SUMMARY_SESSION_ID in database.py), so that they are
+listed in the sidebar. sessions that already have a summary are skipped
+unless --force is passed. summaries replaced by a newer one for the same
+session (kept before the agent deleted them) are deleted. each user's summaries are followed by a marker
+that tells the web app the user's sessions are all summarized, so it no
+longer scans their sessions when they have only a few conversations.
+
+    MEMORY_ID=... python backfill_summaries.py                # all users
+    MEMORY_ID=... python backfill_summaries.py --user_id bob  # one user
+"""
+import os
+import argparse
+from datetime import datetime, timezone
+import boto3
+import database
+
+parser = argparse.ArgumentParser(
+    description="Write session summaries for existing conversations",
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    epilog=__doc__)
+parser.add_argument("--memory_id", default=os.getenv("MEMORY_ID"))
+parser.add_argument("--user_id", action="append",
+                    help="user to backfill (repeatable, default: all users)")
+parser.add_argument("--force", action="store_true",
+                    help="rewrite summaries for sessions that already have one")
+parser.add_argument("--dry_run", action="store_true",
+                    help="print the summaries instead of writing them")
+
+
+def paginate(call, key, **params):
+    while True:
+        response = call(**params)
+        yield from response.get(key, [])
+        if "nextToken" not in response:
+            return
+        params["nextToken"] = response["nextToken"]
+
+
+def session_events(client, memory_id, user_id, session_id):
+    return list(paginate(
+        client.list_events, "events", memoryId=memory_id, actorId=user_id,
+        sessionId=session_id, includePayloads=True, maxResults=100))
+
+
+def backfill_user(client, memory_id, user_id, force, dry_run):
+    """writes a summary for each of a user's sessions that doesn't have one,
+    and deletes replaced summaries. returns the number of summaries written
+    and deleted"""
+
+    # each session's summary event ids, newest first
+    summarized = {}
+    for event in session_events(client, memory_id, user_id, database.SUMMARY_SESSION_ID):
+        for item in event.get("payload", []):
+            if isinstance(item.get("blob"), dict) and "sessionId" in item["blob"]:
+                summarized.setdefault(item["blob"]["sessionId"], []).append(event["eventId"])
+    replaced = [event_id for event_ids in summarized.values() for event_id in event_ids[1:]]
+
+    summaries = []
+    sessions = paginate(client.list_sessions, "sessionSummaries",
+                        memoryId=memory_id, actorId=user_id, maxResults=100)
+    for session in sessions:
+        session_id = session["sessionId"]
+        if session_id == database.SUMMARY_SESSION_ID:
+            continue
+        if session_id in summarized and not force:
+            continue
+        events = session_events(client, memory_id, user_id, session_id)
+        if events:
+            summaries.append(database.summarize(session_id, events))
+            replaced.extend(summarized.get(session_id, [])[:1])
+
+    # oldest first, so the newest summaries are listed first
+    summaries.sort(key=lambda s: s["lastActivity"])
+    for summary in summaries:
+        if dry_run:
+            print(f"  {summary}")
+            continue
+        client.create_event(
+            memoryId=memory_id,
+            actorId=user_id,
+            sessionId=database.SUMMARY_SESSION_ID,
+            eventTimestamp=datetime.fromisoformat(summary["lastActivity"]),
+            payload=[{"blob": summary}],
+        )
+    if not dry_run:
+        # after the summaries that replace them are written
+        for event_id in replaced:
+            client.delete_event(memoryId=memory_id, actorId=user_id,
+                                sessionId=database.SUMMARY_SESSION_ID, eventId=event_id)
+        now = datetime.now(timezone.utc)
+        client.create_event(
+            memoryId=memory_id,
+            actorId=user_id,
+            sessionId=database.SUMMARY_SESSION_ID,
+            eventTimestamp=now,
+            payload=[{"blob": {"backfilled": now.isoformat()}}],
+        )
+    return len(summaries), len(replaced)
+
+
+def main():
+    args = parser.parse_args()
+    if not args.memory_id:
+        parser.error("--memory_id or MEMORY_ID is required")
+
+    client = boto3.client("bedrock-agentcore")
+    user_ids = args.user_id or [
+        actor["actorId"] for actor in paginate(
+            client.list_actors, "actorSummaries", memoryId=args.memory_id, maxResults=100)]
+
+    total = 0
+    for user_id in user_ids:
+        count, deleted = backfill_user(client, args.memory_id, user_id, args.force, args.dry_run)
+        print(f"{user_id}: {count} sessions summarized, {deleted} replaced summaries "
+              f"{'to delete' if args.dry_run else 'deleted'}")
+        total += count
+    print(f"{total} summaries {'to write' if args.dry_run else 'written'} for {len(user_ids)} users")
+
+
+if __name__ == "__main__":
+    main()
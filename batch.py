@@ -0,0 +1,99 @@
+import os
+import time
+import queue
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import deadline as deadlines
+
+# limits for POST /api/ask/batch
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", 500))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 4))
+
+
+def parse(body):
+    """validates a batch request body:
+    {
+        "questions": [
+            {"question": "...", "conversationId": "optional", "id": "optional"},
+            ...
+        ],
+        "concurrency": 4,   (optional)
+        "timeout": 60       (optional, seconds per question)
+    }
+    returns (items, concurrency, timeout). raises ValueError"""
+
+    if not isinstance(body, dict) or not isinstance(body.get("questions"), list):
+        raise ValueError("missing field: questions")
+    questions = body["questions"]
+    if not questions:
+        raise ValueError("questions is empty")
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        raise ValueError(f"too many questions (max {BATCH_MAX_QUESTIONS})")
+
+    items = []
+    for index, q in enumerate(questions):
+        if isinstance(q, str):
+            q = {"question": q}
+        if not isinstance(q, dict) or not q.get("question"):
+            raise ValueError(f"questions[{index}]: missing field: question")
+        items.append({
+            "index": index,
+            "id": q.get("id"),
+            "question": q["question"],
+            "conversationId": q.get("conversationId") or None,
+        })
+
+    try:
+        concurrency = int(body.get("concurrency", BATCH_MAX_CONCURRENCY))
+        timeout = float(body["timeout"]) if body.get("timeout") else None
+    except (TypeError, ValueError):
+        raise ValueError("concurrency and timeout must be numbers")
+    concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+    return items, concurrency, timeout
+
+
+def _groups(items):
+    """questions for the same conversation run in order, one at a time.
+    questions without a conversation each start a new one"""
+    groups = OrderedDict()
+    for item in items:
+        key = item["conversationId"] or f"new:{item['index']}"
+        groups.setdefault(key, []).append(item)
+    return list(groups.values())
+
+
+def run(items, ask, concurrency):
+    """runs ask(item) for each item with at most `concurrency` running at
+    once, and yields results in the order they complete. ask returns a dict
+    that is merged into the item's result, or raises (and the result gets
+    an error and an http style status)"""
+
+    results = queue.Queue()
+
+    def run_group(group):
+        for item in group:
+            start = time.monotonic()
+            result = {"index": item["index"], "id": item["id"],
+                      "question": item["question"]}
+            try:
+                result.update(ask(item))
+                result["status"] = 200
+            except Exception as e:
+                logging.error(f"batch question {item['index']} failed: {e}")
+                result["error"] = str(e) or type(e).__name__
+                result["status"] = (504 if isinstance(e, deadlines.DeadlineExceeded)
+                                    else getattr(e, "status_code", 500))
+            result["seconds"] = round(time.monotonic() - start, 3)
+            results.put(result)
+
+    executor = ThreadPoolExecutor(max_workers=concurrency,
+                                  thread_name_prefix="batch")
+    try:
+        for group in _groups(items):
+            executor.submit(run_group, group)
+        for _ in items:
+            yield results.get()
+    finally:
+        # if the client goes away, don't start any more questions
+        executor.shutdown(wait=False, cancel_futures=True)
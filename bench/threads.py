@@ -0,0 +1,164 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Compares fixed gunicorn thread counts with the sizing in gunicorn.conf.py
+# (see tuning.py) under a mixed load: questions (/api/ask), asynchronous
+# questions followed by a long poll for the answer, which hold a thread
+# without being admission controlled, and page loads (/conversations).
+# Requests arrive at random (poisson) at fixed rates, whether or not earlier
+# ones have been answered. The app and a local emulator with a slow agent
+# are started from the repo root, so nothing else needs to be running.
+#
+#   python bench/threads.py --threads 4 16 --duration 60
+
+parser = argparse.ArgumentParser(
+    description="Benchmark fixed gunicorn thread counts against tuned ones")
+parser.add_argument("--threads", type=int, nargs="*", default=[4, 16],
+                    help="fixed thread counts to compare (the tuned settings always run)")
+parser.add_argument("--duration", type=float, default=60)
+parser.add_argument("--ask_rate", type=float, default=3, help="questions per second")
+parser.add_argument("--poll_rate", type=float, default=1.5,
+                    help="asynchronous questions (each long polled) per second")
+parser.add_argument("--page_rate", type=float, default=5, help="page loads per second")
+parser.add_argument("--agent_latency", default="lognormal:2:0.5",
+                    help="emulator latency distribution for the agent")
+parser.add_argument("--agent_concurrency", type=int, default=16,
+                    help="ADMISSION_AGENT_CONCURRENCY, for a deployment sized for more agent traffic than the default 4")
+parser.add_argument("--port", type=int, default=8182)
+parser.add_argument("--emulator_port", type=int, default=9102)
+parser.add_argument("--tune_interval", type=float, default=2,
+                    help="GUNICORN_TUNE_INTERVAL for the tuned run")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def request(url, method="GET", body=None):
+    """returns the status and response of a request, and its latency"""
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, method=method,
+                                 headers={"Content-Type": "application/json"})
+    start = time.monotonic()
+    try:
+        with urllib.request.urlopen(req, timeout=120) as response:
+            return response.status, response.headers, response.read(), time.monotonic() - start
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read(), time.monotonic() - start
+    except Exception:
+        return 0, {}, b"", time.monotonic() - start
+
+
+def ask(url):
+    status, _, _, latency = request(f"{url}/api/ask", "POST", {"question": "what is the refund policy?"})
+    return status, latency
+
+
+def ask_and_poll(url):
+    """an asynchronous question and the long poll for its answer"""
+    start = time.monotonic()
+    status, headers, _, _ = request(f"{url}/api/ask?async=true", "POST",
+                                    {"question": "how long does shipping take?"})
+    if status != 202:
+        return status, time.monotonic() - start
+    while True:
+        status, _, body, _ = request(f"{url}{headers['Location']}?wait=20")
+        if status != 200 or json.loads(body)["status"] in ["succeeded", "failed"]:
+            return status, time.monotonic() - start
+
+
+def page(url):
+    status, _, _, latency = request(f"{url}/conversations")
+    return status, latency
+
+
+def generate(url, kind, fn, rate, duration, results, executor):
+    """sends requests at random intervals averaging rate per second"""
+    until = time.monotonic() + duration
+    next_at = time.monotonic()
+    while True:
+        next_at += random.expovariate(rate)
+        if next_at >= until:
+            return
+        time.sleep(max(0, next_at - time.monotonic()))
+        executor.submit(lambda: results[kind].append(fn(url)))
+
+
+def wait_until_ready(url):
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(url).read()
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise Exception(f"{url} did not start")
+
+
+def benchmark(args, name, env):
+    env = {**os.environ, **env,
+           "ADMISSION_AGENT_CONCURRENCY": str(args.agent_concurrency),
+           "AWS_ENDPOINT_URL_BEDROCK_AGENTCORE": f"http://127.0.0.1:{args.emulator_port}",
+           "MEMORY_ID": "memory-emulator",
+           "AGENT_RUNTIME": "arn:aws:bedrock-agentcore:us-east-1:123456789012:runtime/emulator"}
+    for key, value in [("AWS_ACCESS_KEY_ID", "bench"), ("AWS_SECRET_ACCESS_KEY", "bench"),
+                       ("AWS_REGION", "us-east-1"), ("AWS_DEFAULT_REGION", "us-east-1")]:
+        env.setdefault(key, value)
+    emulator = subprocess.Popen(
+        [sys.executable, "emulator.py", "--port", str(args.emulator_port),
+         "--memory_id", "memory-emulator",
+         "--latency", f"invoke_agent_runtime={args.agent_latency}",
+         "--latency", "list_events=lognormal:0.05:0.3",
+         "--latency", "list_sessions=lognormal:0.05:0.3"],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # gunicorn.conf.py is loaded from the repo root
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{args.port}", "main:app"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{args.port}"
+    results = {"ask": [], "poll": [], "page": []}
+    try:
+        wait_until_ready(f"{url}/health")
+        with ThreadPoolExecutor(1024) as executor:
+            generators = [
+                threading.Thread(target=generate, args=(url, kind, fn, rate, args.duration, results, executor))
+                for kind, fn, rate in [("ask", ask, args.ask_rate),
+                                       ("poll", ask_and_poll, args.poll_rate),
+                                       ("page", page, args.page_rate)] if rate > 0]
+            for generator in generators:
+                generator.start()
+            for generator in generators:
+                generator.join()
+    finally:
+        server.terminate()
+        server.wait()
+        emulator.terminate()
+        emulator.wait()
+
+    def pct(values, p):
+        return values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000 if values else 0
+
+    print(name)
+    for kind, rs in results.items():
+        latencies = sorted(latency for status, latency in rs if status == 200)
+        shed = sum(1 for status, _ in rs if status in (429, 503))
+        errors = len(rs) - len(latencies) - shed
+        print(f"  {kind:<5} {len(rs):>5} requests  ok={len(latencies):<5} shed={shed:<4} errors={errors:<4}"
+              f" p50={pct(latencies, 50):>8.1f}ms  p99={pct(latencies, 99):>8.1f}ms")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    print(f"{args.ask_rate} questions/s, {args.poll_rate} long polled questions/s, "
+          f"{args.page_rate} page loads/s for {args.duration:g}s, agent latency {args.agent_latency}, "
+          f"agent concurrency {args.agent_concurrency}")
+    for threads in args.threads:
+        benchmark(args, f"fixed: {threads} threads", {"GUNICORN_THREADS": str(threads)})
+    benchmark(args, "tuned (gunicorn.conf.py)",
+              {"GUNICORN_TUNE_INTERVAL": str(args.tune_interval)})
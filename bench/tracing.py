@@ -0,0 +1,140 @@
+import argparse
+import os
+import sys
+import time
+import statistics
+
+# Measures the cost of tracing per request at different sampling ratios.
+# Each configuration gets its own Flask app, instrumented the same way as the
+# web app, with a tracer provider from telemetry.py. Requests go through
+# Flask's test client, so the numbers are the app's own overhead
+# (no network). Each request creates SPANS child spans, like the botocore
+# spans of a real request.
+#
+#   python bench/tracing.py --ratios 0 0.01 0.1 1 --requests 5000
+#
+# --exporter encode serializes spans to OTLP protobuf (the exporter's
+# cpu cost, without sending them). --exporter slow simulates a collector
+# that can't keep up, to show spans being dropped instead of queueing up
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+parser = argparse.ArgumentParser(
+    description="Benchmark per request tracing overhead at different sampling ratios")
+parser.add_argument("--ratios", type=float, nargs="+", default=[0, 0.01, 0.1, 1])
+parser.add_argument("--requests", type=int, default=5000)
+parser.add_argument("--spans", type=int, default=3,
+                    help="child spans per request")
+parser.add_argument("--exporter", default="encode", choices=["noop", "encode", "slow"],
+                    help="noop: discard spans, encode: serialize them to OTLP protobuf, "
+                    "slow: take 500ms per batch of spans")
+parser.add_argument("--repeat", type=int, default=3,
+                    help="runs per configuration (the fastest is reported)")
+parser.add_argument("--error_rate", type=float, default=0.01,
+                    help="share of requests that fail (kept when not sampled)")
+
+
+class Exporter():
+    """counts spans instead of sending them anywhere"""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.spans = 0
+
+    def export(self, spans):
+        from opentelemetry.sdk.trace.export import SpanExportResult
+        from opentelemetry.exporter.otlp.proto.common.trace_encoder import encode_spans
+        if self.kind == "encode":
+            encode_spans(spans).SerializeToString()
+        elif self.kind == "slow":
+            time.sleep(0.5)
+        self.spans += len(spans)
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        pass
+
+
+def make_app(provider, spans, error_every):
+    from flask import Flask
+    from opentelemetry.instrumentation.flask import FlaskInstrumentor
+
+    app = Flask(__name__)
+    counter = {"n": 0}
+
+    @app.route("/api/ask")
+    def ask():
+        tracer = provider.get_tracer("bench") if provider else None
+        for i in range(spans):
+            if tracer:
+                with tracer.start_as_current_span(f"call {i}") as span:
+                    span.set_attribute("i", i)
+        counter["n"] += 1
+        if error_every and counter["n"] % error_every == 0:
+            return "error", 500
+        return "ok"
+
+    @app.route("/health")
+    def health():
+        return "ok"
+
+    if provider is not None:
+        FlaskInstrumentor().instrument_app(app, tracer_provider=provider)
+    return app
+
+
+def run(app, requests, repeat, path="/api/ask"):
+    """returns per request latencies in microseconds,
+    from the run with the lowest median"""
+    client = app.test_client()
+    for _ in range(min(500, requests)):
+        client.get(path)
+    runs = []
+    for _ in range(repeat):
+        latencies = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            client.get(path)
+            latencies.append((time.perf_counter() - start) * 1e6)
+        runs.append(latencies)
+    return min(runs, key=statistics.median)
+
+
+def main():
+    args = parser.parse_args()
+    import telemetry
+    import metrics
+
+    error_every = int(1 / args.error_rate) if args.error_rate > 0 else 0
+
+    def dropped():
+        return metrics.counter("trace_spans", result="dropped").value
+
+    baseline = statistics.median(run(make_app(None, 0, error_every), args.requests, args.repeat))
+    print(f"{'config':<28} {'p50 us':>8} {'p99 us':>8} {'overhead':>9} {'exported':>9} {'dropped':>8}")
+    print(f"{'no tracing':<28} {baseline:>8.0f} {'':>8} {'':>9} {'':>9} {'':>8}")
+
+    configs = [("health check (ratio 0)", 1, "/health", True)]
+    for ratio in args.ratios:
+        configs.append((f"ratio {ratio}", ratio, "/api/ask", False))
+        if ratio < 1:
+            configs.append((f"ratio {ratio} + errors/slow", ratio, "/api/ask", True))
+
+    for name, ratio, path, keep in configs:
+        exporter = Exporter(args.exporter)
+        provider = telemetry.tracer_provider(
+            exporter, ratio=ratio, route_ratios="/health=0",
+            keep_errors=keep, slow_seconds=0)
+        app = make_app(provider, args.spans, error_every)
+        dropped_before = dropped()
+        latencies = run(app, args.requests, args.repeat, path)
+        provider.force_flush(10000)
+        p50 = statistics.median(latencies)
+        p99 = statistics.quantiles(latencies, n=100)[98]
+        print(f"{name:<28} {p50:>8.0f} {p99:>8.0f} {p50 - baseline:>+8.0f}us "
+              f"{exporter.spans:>9} {dropped() - dropped_before:>8.0f}")
+        provider.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import os
+import sys
+import time
+import subprocess
+import urllib.request
+from multiprocessing import Pool
+
+# Measures web app throughput with different numbers of gunicorn workers.
+# The app is started from the repo root with the current environment, so
+# set AGENT_RUNTIME, MEMORY_ID, CACHE_URL etc. (or point the app at the
+# local emulator) before running it.
+#
+#   python bench/workers.py --workers 1 2 4 --path /conversation/<id>
+
+parser = argparse.ArgumentParser(
+    description="Benchmark web app throughput across gunicorn worker counts")
+parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+parser.add_argument("--threads", type=int, default=16)
+parser.add_argument("--path", default="/", help="path to request")
+parser.add_argument("--port", type=int, default=8181)
+parser.add_argument("--clients", type=int, default=os.cpu_count(),
+                    help="client processes generating load")
+parser.add_argument("--connections", type=int, default=8,
+                    help="concurrent requests per client process")
+parser.add_argument("--duration", type=float, default=10)
+
+
+def run_client(args):
+    """sends requests until the duration elapses and returns the latencies"""
+    from concurrent.futures import ThreadPoolExecutor
+    url, duration, connections = args
+    until = time.monotonic() + duration
+
+    def loop(_):
+        latencies = []
+        errors = 0
+        while time.monotonic() < until:
+            start = time.monotonic()
+            try:
+                with urllib.request.urlopen(url) as response:
+                    response.read()
+                latencies.append(time.monotonic() - start)
+            except Exception:
+                errors += 1
+        return latencies, errors
+
+    with ThreadPoolExecutor(connections) as executor:
+        results = list(executor.map(loop, range(connections)))
+    return [l for r in results for l in r[0]], sum(r[1] for r in results)
+
+
+def wait_until_ready(url):
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(url).read()
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise Exception("app did not start")
+
+
+def benchmark(args, workers):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn",
+         "--bind", f"127.0.0.1:{args.port}",
+         "--workers", str(workers),
+         "--threads", str(args.threads),
+         "--worker-class", "gthread",
+         "--log-level", "warning",
+         "main:app"],
+        cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        url = f"http://127.0.0.1:{args.port}{args.path}"
+        wait_until_ready(f"http://127.0.0.1:{args.port}/health")
+        # warm up caches
+        urllib.request.urlopen(url).read()
+        with Pool(args.clients) as pool:
+            results = pool.map(
+                run_client, [(url, args.duration, args.connections)] * args.clients)
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = sorted(l for r in results for l in r[0])
+    errors = sum(r[1] for r in results)
+    if not latencies:
+        print(f"workers={workers}: no successful requests ({errors} errors)")
+        return 0
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000
+
+    rps = len(latencies) / args.duration
+    print(f"workers={workers}: {rps:.0f} req/s p50={pct(50):.1f}ms p99={pct(99):.1f}ms errors={errors}")
+    return rps
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    print(f"{os.cpu_count()} cpus, {args.clients} client processes x {args.connections} connections")
+    baseline = None
+    for workers in args.workers:
+        rps = benchmark(args, workers)
+        if baseline is None:
+            baseline = rps
+        elif baseline:
+            print(f"  {rps / baseline:.2f}x vs {args.workers[0]} worker(s)")
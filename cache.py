@@ -0,0 +1,157 @@
+import os
+import time
+import json
+import random
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+import metrics
+
+# CACHE_URL selects where cached data lives:
+#   memory://                  private to each worker process (default)
+#   sqlite:///path/to/cache.db shared by all worker processes on the host
+#                              (put it on a tmpfs, e.g. /app/tmp)
+#   redis://host:6379/0        shared by all hosts (requires the redis package)
+
+
+class MemoryCache():
+    """in-process cache with ttl expiry and lru eviction"""
+
+    def __init__(self, max_items=10000):
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return json.loads(value)
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._items[key] = (json.dumps(value), time.time() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._items.pop(key, None)
+
+
+class SqliteCache():
+    """cache shared between worker processes through a sqlite file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires REAL NOT NULL
+                )""")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires >= ?",
+            (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        conn = self._connection()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+            (key, json.dumps(value), now + ttl))
+        # occasionally clean up expired entries
+        if random.random() < 0.01:
+            conn.execute("DELETE FROM cache WHERE expires < ?", (now,))
+
+    def delete(self, *keys):
+        self._connection().executemany(
+            "DELETE FROM cache WHERE key = ?", [(key,) for key in keys])
+
+
+class RedisCache():
+    """cache shared between hosts through redis (or anything that speaks its protocol)"""
+
+    def __init__(self, url):
+        import redis
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self._client.set(key, json.dumps(value), ex=max(1, int(ttl)))
+
+    def delete(self, *keys):
+        if keys:
+            self._client.delete(*keys)
+
+
+def from_url(url):
+    """returns the cache backend for a CACHE_URL"""
+    if url.startswith("memory://"):
+        return MemoryCache()
+    if url.startswith("sqlite://"):
+        return SqliteCache(url[len("sqlite://"):])
+    if url.startswith(("redis://", "rediss://")):
+        return RedisCache(url)
+    raise Exception(f"unsupported CACHE_URL: {url}")
+
+
+cache_url = os.getenv("CACHE_URL", "memory://")
+logging.info(f"using cache: {cache_url}")
+backend = from_url(cache_url)
+
+# the cache is an optimization, so errors are logged and treated as misses
+
+
+def get(key):
+    """returns the cached value for key, or None"""
+    try:
+        value = backend.get(key)
+    except Exception as e:
+        logging.warning(f"cache get failed: {e}")
+        return None
+    metrics.counter("cache_requests",
+                    result="miss" if value is None else "hit").inc()
+    return value
+
+
+def set(key, value, ttl):
+    """caches a json serializable value for ttl seconds"""
+    try:
+        backend.set(key, value, ttl)
+    except Exception as e:
+        logging.warning(f"cache set failed: {e}")
+
+
+def delete(*keys):
+    """removes keys from the cache"""
+    try:
+        backend.delete(*keys)
+    except Exception as e:
+        logging.warning(f"cache delete failed: {e}")
@@ -0,0 +1,239 @@
+import os
+import re
+import json
+import gzip
+import time
+import atexit
+import logging
+import threading
+from datetime import datetime
+from importlib import import_module
+import metrics
+
+# traffic capture for offline replay (see replay.py). when CAPTURE_DIR is
+# set, each worker process records the requests it serves, the downstream
+# calls made while serving them (with their latency, and the responses of
+# memory calls, i.e. the conversation events the app read) and the agent's
+# answers (log.llm) to a gzipped json lines file in it. replay.py sends the
+# requests to a build of the app, against a stand-in that answers each
+# downstream call with what was recorded, after the recorded latency
+
+CAPTURE_DIR = os.getenv("CAPTURE_DIR", "")
+
+# stop capturing once a process's file reaches this size (MB, compressed)
+CAPTURE_MAX_MB = float(os.getenv("CAPTURE_MAX_MB", 100))
+
+# extra redaction hooks, as comma separated module:function names. each is
+# called with a record (after the built in redaction) and returns it, or
+# None to drop it
+CAPTURE_REDACT = os.getenv("CAPTURE_REDACT", "")
+
+# how often the file is flushed, so it can be read while it's written (seconds)
+FLUSH_SECONDS = 1.0
+
+# requests that aren't captured
+SKIP_PATHS = ("/health", "/metrics", "/debug/", "/static/", "/favicon.ico")
+
+# request headers that change how a request is served
+HEADERS = ("Content-Type", "Accept-Encoding", "HX-Request",
+           "X-Request-Timeout", "Prefer", "If-None-Match")
+
+# fields that hold free text (questions, answers, conversation events),
+# which the built in redaction applies to
+TEXT_FIELDS = {"text", "prompt", "question", "q", "firstQuestion"}
+
+EMAIL = re.compile(r"[\w.+-]+@[\w-]+(\.[\w-]+)+")
+# phone, card and account numbers: runs of digits and separators
+NUMBER = re.compile(r"\+?\d[\d ().-]{7,}\d")
+
+
+def _mask(match):
+    """keeps the shape (and length) of what's masked, so payload sizes
+    don't change and masking twice gives the same result"""
+    text = match.group(0)
+    if match.re is NUMBER and sum(c.isdigit() for c in text) < 9:
+        return text
+    return re.sub(r"\d", "0", re.sub(r"[^\W\d]", "x", text))
+
+
+def redact_text(text):
+    """masks email addresses and long numbers in free text"""
+    return NUMBER.sub(_mask, EMAIL.sub(_mask, text))
+
+
+def redact(value, text=False):
+    """masks personal data in the free text fields of a record"""
+    if isinstance(value, dict):
+        return {k: redact(v, text or k in TEXT_FIELDS) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact(v, text) for v in value]
+    if text and isinstance(value, str):
+        return redact_text(value)
+    return value
+
+
+def _load_redactors(names):
+    redactors = []
+    for name in filter(None, (n.strip() for n in names.split(","))):
+        module, _, function = name.partition(":")
+        redactors.append(getattr(import_module(module), function))
+    return redactors
+
+
+def _json_default(value):
+    # timestamps are sent as epoch seconds, like the apis do
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return str(value)
+
+
+def _plain(response):
+    """a boto3 response without its metadata and streams"""
+    return {k: v for k, v in response.items()
+            if k != "ResponseMetadata" and not hasattr(v, "read")}
+
+
+def _params(params):
+    """a boto3 call's parameters, with json payloads (the agent's input)
+    parsed so that the text in them can be redacted"""
+    params = _plain(params)
+    if isinstance(params.get("payload"), str):
+        try:
+            params["payload"] = json.loads(params["payload"])
+        except ValueError:
+            pass
+    return params
+
+
+class Capture():
+    """Writes capture records to a gzipped json lines file"""
+
+    def __init__(self, directory, max_bytes, redactors):
+        os.makedirs(directory, exist_ok=True)
+        name = f"capture-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.jsonl.gz"
+        self.path = os.path.join(directory, name)
+        self.pid = os.getpid()
+        self.max_bytes = max_bytes
+        self.redactors = redactors
+        self._raw = open(self.path, "wb")
+        self._file = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=6)
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+        logging.warning(f"capturing traffic to {self.path}")
+        self.write({"type": "capture", "version": 1, "pid": self.pid})
+
+    def write(self, record):
+        record.setdefault("t", time.time())
+        record = redact(record)
+        for redactor in self.redactors:
+            record = redactor(record)
+            if record is None:
+                return
+        line = json.dumps(record, default=_json_default, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line.encode())
+            metrics.counter("capture_records", type=record["type"]).inc()
+            now = time.monotonic()
+            if now - self._flushed >= FLUSH_SECONDS:
+                self._flushed = now
+                self._file.flush()
+                if self._raw.tell() >= self.max_bytes:
+                    logging.warning(f"capture {self.path} is full, no longer capturing")
+                    self._close()
+
+    def _close(self):
+        self._file.close()
+        self._raw.close()
+        self._file = None
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._close()
+
+
+_capture = None
+_capture_lock = threading.Lock()
+
+
+def _get():
+    """the current process's capture, opened on first use so that each
+    worker process (including forked ones) gets its own file"""
+    global _capture
+    if _capture is None or _capture.pid != os.getpid():
+        with _capture_lock:
+            if _capture is None or _capture.pid != os.getpid():
+                _capture = Capture(CAPTURE_DIR, CAPTURE_MAX_MB * 1024 * 1024,
+                                   _load_redactors(CAPTURE_REDACT))
+                atexit.register(_capture.close)
+    return _capture
+
+
+def enabled():
+    return bool(CAPTURE_DIR)
+
+
+def request(method, path, args, form, json_body, headers, status, start, location=None):
+    """records a request served by the app. start is the (wall clock,
+    monotonic) time it arrived"""
+    if not CAPTURE_DIR or path.startswith(SKIP_PATHS):
+        return
+    record = {
+        "type": "request",
+        "t": start[0],
+        "method": method,
+        "path": path,
+        "args": args,
+        "form": form,
+        "json": json_body,
+        "headers": {k: v for k, v in headers.items() if k in HEADERS},
+        "status": status,
+        "seconds": round(time.monotonic() - start[1], 4),
+    }
+    if location:
+        # where an asynchronous question's job can be polled, so that
+        # replay.py can poll the job it gets instead
+        record["location"] = location
+    _get().write(record)
+
+
+def call(service, operation, params, start, response=None, error=None):
+    """records a downstream call that started at start (monotonic time),
+    with its response or error code"""
+    if not CAPTURE_DIR:
+        return
+    seconds = time.monotonic() - start
+    record = {
+        "type": "call",
+        "t": time.time() - seconds,
+        "service": service,
+        "operation": operation,
+        "params": _params(params),
+        "seconds": round(seconds, 4),
+    }
+    if error is not None:
+        record["error"] = error
+    elif response is not None:
+        record["response"] = _plain(response)
+    _get().write(record)
+
+
+def llm(input, output):
+    """records an agent invocation's input and output"""
+    if not CAPTURE_DIR:
+        return
+    _get().write({"type": "llm", "input": input, "output": output})
+
+
+def read(path):
+    """yields the records in a capture file. files that are still being
+    written (or were cut short) are read up to their last flush"""
+    with gzip.open(path, "rt") as f:
+        try:
+            for line in f:
+                if line.endswith("\n"):
+                    yield json.loads(line)
+        except EOFError:
+            pass
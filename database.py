@@ -1,30 +1,229 @@
 import os
 import log
+import time
 import uuid
 import logging
 import json
+from datetime import datetime, timezone
 import psycopg
-import boto3
-from bedrock_agentcore.memory import MemoryClient
+import deadline as deadlines
+import cache
 
-memory_client = MemoryClient(region_name=os.getenv("AWS_REGION"))
 memory_id = os.getenv("MEMORY_ID")
-memory_data_client = boto3.client("bedrock-agentcore")
+
+# maximum time for a single memory api call (seconds)
+MEMORY_TIMEOUT = float(os.getenv("MEMORY_TIMEOUT", 5))
+
+# maximum number of events fetched per conversation
+MAX_EVENTS = 100
+
+# how long conversations and conversation lists are cached (seconds).
+# entries are invalidated when a question is asked
+CONVERSATION_CACHE_TTL = int(os.getenv("CONVERSATION_CACHE_TTL", 300))
+LIST_CACHE_TTL = int(os.getenv("LIST_CACHE_TTL", 60))
+
+# session summaries are written by the agent (see agent/memoryhook.py) to
+# this session, newest first, so conversations can be listed with one read.
+# users without summaries fall back to scanning each session's events
+# (backfill_summaries.py writes summaries for existing sessions)
+SUMMARY_SESSION_ID = "session-summaries"
+
+# most summary events read when listing conversations. a session's new
+# summary replaces its previous one, so a listing reads about as many
+# summaries as the conversations it shows. more are only read for users
+# whose summaries were kept before that and haven't been compacted yet
+# (by backfill_summaries.py)
+SUMMARY_MAX_EVENTS = 1000
+
+# longest first question stored in a summary
+SUMMARY_QUESTION_LENGTH = 200
+
+# times a turn the agent didn't store is written before giving up (see
+# record_turn), each write with its own MEMORY_TIMEOUT
+RECORD_ATTEMPTS = 3
+
+
+def _conversation_key(conversation_id, user_id):
+    return f"conversation:{user_id}:{conversation_id}"
+
+
+def _list_key(user_id):
+    return f"conversations:{user_id}"
+
+
+def format_timestamp(dt):
+    """formats a timestamp as M/D/YYYY H:MM AM/PM"""
+    # Manual 12-hour format conversion
+    hour = dt.hour
+    am_pm = "AM" if hour < 12 else "PM"
+    hour_12 = hour if hour == 0 or hour == 12 else hour % 12
+    if hour_12 == 0:
+        hour_12 = 12
+    return f"{dt.month}/{dt.day}/{dt.year} {hour_12}:{dt.minute:02d} {am_pm}"
+
+
+def summarize(session_id, events):
+    """builds a session summary from all of a session's events"""
+    events = sorted(events, key=lambda e: e["eventTimestamp"])
+    questions = []
+    for event in events:
+        for item in event.get("payload", []):
+            conv = item.get("conversational", {})
+            if conv.get("role") == "USER":
+                questions.append(conv.get("content", {}).get("text", ""))
+    return {
+        "sessionId": session_id,
+        "firstQuestion": questions[0][:SUMMARY_QUESTION_LENGTH] if questions else "No question found",
+        "turns": len(questions),
+        "lastActivity": events[-1]["eventTimestamp"].isoformat() if events else None,
+        "lastEventId": events[-1]["eventId"] if events else None,
+    }
+
+
+def _turns(events):
+    """pairs a session's events (listed newest first) into questions and
+    answers, oldest first. each turn has the question ("q"), the answer ("a")
+    and the answer's timestamp ("timestamp")"""
+    turns = []
+    current_question = None
+    current_answer = None
+    answered = None
+
+    # Process events in reverse chronological order (oldest first)
+    for event in reversed(events):
+        if 'payload' in event and event['payload']:
+            for payload_item in event['payload']:
+                if 'conversational' in payload_item:
+                    conv = payload_item['conversational']
+                    role = conv.get('role')
+                    content = conv.get('content', {}).get('text', '')
+
+                    if role == 'USER':
+                        # If we have a complete Q&A pair, save it
+                        if current_question and current_answer:
+                            turns.append({"q": current_question, "a": current_answer,
+                                          "timestamp": answered})
+                        # Start new question
+                        current_question = content
+                        current_answer = None
+
+                    elif role == 'ASSISTANT':
+                        # Set the answer for current question
+                        current_answer = content
+                        answered = event.get('eventTimestamp')
+
+                    # Skip TOOL role messages as they're intermediate
+
+    # Add the last Q&A pair if it exists
+    if current_question and current_answer:
+        turns.append({"q": current_question, "a": current_answer,
+                      "timestamp": answered})
+    return turns
+
+
+def _memory_call(operation, deadline, **kwargs):
+    """calls a bedrock-agentcore memory api within the request deadline"""
+    if deadline is None:
+        deadline = deadlines.Deadline(MEMORY_TIMEOUT)
+    return deadlines.call("bedrock-agentcore", operation,
+                          deadline.within(MEMORY_TIMEOUT), **kwargs)
+
+
+def _record_turn(conversation_id, user_id, question, answer, token):
+    for text, role in [(question, "USER"), (answer, "ASSISTANT")]:
+        _memory_call(
+            "create_event", None,
+            memoryId=memory_id,
+            actorId=user_id,
+            sessionId=conversation_id,
+            eventTimestamp=datetime.now(timezone.utc),
+            payload=[{"conversational": {"content": {"text": text}, "role": role}}],
+            clientToken=f"{token}-{role.lower()}")
+    # the summary is built from the session's events, as the backfill does
+    events = []
+    params = {
+        "memoryId": memory_id,
+        "actorId": user_id,
+        "sessionId": conversation_id,
+        "includePayloads": True,
+        "maxResults": 100,
+    }
+    while True:
+        response = _memory_call("list_events", None, **params)
+        events.extend(response.get("events", []))
+        if "nextToken" not in response:
+            break
+        params["nextToken"] = response["nextToken"]
+    summary = summarize(conversation_id, events)
+    _memory_call("create_event", None,
+                 memoryId=memory_id,
+                 actorId=user_id,
+                 sessionId=SUMMARY_SESSION_ID,
+                 eventTimestamp=datetime.now(timezone.utc),
+                 payload=[{"blob": summary}],
+                 clientToken=f"{token}-summary")
+
+
+def record_turn(conversation_id, user_id, question, answer):
+    """stores a question and answer, and the session's summary, as the
+    agent's memory hook does. used when the agent was asked not to, because
+    the question may be answered by either of two runtimes (see
+    orchestrator.invoke_hedged), so that the answer shown is the one stored.
+    the writes are idempotent (they share a client token), so they are
+    retried on any error, up to RECORD_ATTEMPTS times"""
+    token = uuid.uuid4().hex
+    for attempt in range(1, RECORD_ATTEMPTS + 1):
+        try:
+            return _record_turn(conversation_id, user_id, question, answer, token)
+        except Exception as e:
+            if attempt == RECORD_ATTEMPTS:
+                raise
+            logging.warning(
+                f"failed to record a turn of {conversation_id}, retrying (attempt {attempt}): {e}")
+            time.sleep(0.5 * 2 ** (attempt - 1))
 
 
 class Database():
     """Memory database abstraction"""
 
-    def get(self, conversation_id, user_id):
+    def invalidate(self, conversation_id, user_id):
+        """drop cached data that changes when a question is asked"""
+        cache.delete(_conversation_key(conversation_id, user_id),
+                     _list_key(user_id))
+
+    def cached(self, conversation_id, user_id):
+        """returns a conversation if it is cached, otherwise None"""
+        return cache.get(_conversation_key(conversation_id, user_id))
+
+    def get(self, conversation_id, user_id, deadline=None):
         """fetch a conversation by id and user"""
 
+        key = _conversation_key(conversation_id, user_id)
+        cached = cache.get(key)
+        if cached is not None:
+            logging.info(f"conversation {conversation_id} found in cache")
+            return cached
+
         try:
             logging.info(f"Checking memory_id: {memory_id}")
             if not memory_id:
                 raise Exception("MEMORY_ID environment variable is not set")
                 
             logging.info(f"Fetching events for conversation_id: {conversation_id}, user_id: {user_id}")
-            events = memory_client.list_events(memory_id, user_id, conversation_id)
+            events = []
+            params = {
+                "memoryId": memory_id,
+                "actorId": user_id,
+                "sessionId": conversation_id,
+                "includePayloads": True,
+            }
+            while len(events) < MAX_EVENTS:
+                params["maxResults"] = MAX_EVENTS - len(events)
+                response = _memory_call("list_events", deadline, **params)
+                events.extend(response.get("events", []))
+                if "nextToken" not in response:
+                    break
+                params["nextToken"] = response["nextToken"]
             logging.info(f"found {len(events)} events")
             log.info(events)
         except Exception as e:
@@ -43,43 +242,7 @@ class Database():
                 raise
 
         # translate list of events into a conversation with question/answer groupings
-        # iterate the list of events backwards
-        questions = []
-        current_question = None
-        current_answer = None
-
-        # Process events in reverse chronological order (oldest first)
-        for event in reversed(events):
-            if 'payload' in event and event['payload']:
-                for payload_item in event['payload']:
-                    if 'conversational' in payload_item:
-                        conv = payload_item['conversational']
-                        role = conv.get('role')
-                        content = conv.get('content', {}).get('text', '')
-
-                        if role == 'USER':
-                            # If we have a complete Q&A pair, save it
-                            if current_question and current_answer:
-                                questions.append({
-                                    "q": current_question,
-                                    "a": current_answer
-                                })
-                            # Start new question
-                            current_question = content
-                            current_answer = None
-
-                        elif role == 'ASSISTANT':
-                            # Set the answer for current question
-                            current_answer = content
-
-                        # Skip TOOL role messages as they're intermediate
-
-        # Add the last Q&A pair if it exists
-        if current_question and current_answer:
-            questions.append({
-                "q": current_question,
-                "a": current_answer
-            })
+        questions = [{"q": turn["q"], "a": turn["a"]} for turn in _turns(events)]
 
         # For now, return empty sources array - this could be enhanced
         # to extract source information from tool calls or other metadata
@@ -87,21 +250,147 @@ class Database():
             "conversationId": conversation_id,
             "user_id": user_id,
             "questions": questions,
-            "sources": []
+            "sources": [],
+            # events are listed newest first
+            "latestEventId": events[0].get("eventId") if events else None,
         }
         log.info("translated data...")
         log.info(result)
+        cache.set(key, result, CONVERSATION_CACHE_TTL)
         return result
 
-    def list_by_user(self, user_id, top):
-        """fetch a list of conversations by user, sorted by latest activity"""
+    def history(self, user_id, deadline=None):
+        """yields (conversation id, turns) for every one of a user's
+        sessions, reading all of their events (see _turns). used to
+        build the search index, not to serve requests"""
+
+        sessions = {
+            "memoryId": memory_id,
+            "actorId": user_id,
+            "maxResults": 100,
+        }
+        while True:
+            response = _memory_call("list_sessions", deadline, **sessions)
+            for session in response.get("sessionSummaries", []):
+                session_id = session["sessionId"]
+                if session_id == SUMMARY_SESSION_ID:
+                    continue
+                events = []
+                params = {
+                    "memoryId": memory_id,
+                    "actorId": user_id,
+                    "sessionId": session_id,
+                    "includePayloads": True,
+                    "maxResults": 100,
+                }
+                while True:
+                    page = _memory_call("list_events", deadline, **params)
+                    events.extend(page.get("events", []))
+                    if "nextToken" not in page:
+                        break
+                    params["nextToken"] = page["nextToken"]
+                yield session_id, _turns(events)
+            if "nextToken" not in response:
+                return
+            sessions["nextToken"] = response["nextToken"]
+
+    def list_by_user(self, user_id, top, deadline=None):
+        """fetch a list of conversations by user, sorted by latest activity.
+        if the deadline passes while scanning sessions, the sessions
+        fetched so far are returned"""
+
+        key = _list_key(user_id)
+        cached = cache.get(key)
+        if cached is not None and cached["top"] >= top:
+            logging.info(f"conversation list for {user_id} found in cache")
+            return cached["chat_history"][:top]
+
+        listed = self._list_from_summaries(user_id, top, deadline)
+        if listed is None:
+            return self._list_from_events(user_id, top, deadline)
+        chat_history, complete = listed
+        # don't cache partial results
+        if complete:
+            cache.set(key, {"top": top, "chat_history": chat_history},
+                      LIST_CACHE_TTL)
+        return chat_history
+
+    def _list_from_summaries(self, user_id, top, deadline):
+        """lists conversations from the user's session summaries, reading
+        pages of them only until top different sessions are found.
+        returns (chat history, complete), or None if they may be missing
+        conversations: the user has fewer than top summaries and
+        backfill_summaries.py hasn't run for them, so their sessions from
+        before the agent kept summaries would be left out"""
+
+        params = {
+            "memoryId": memory_id,
+            "actorId": user_id,
+            "sessionId": SUMMARY_SESSION_ID,
+            "includePayloads": True,
+            # one summary per session, with room for ones that
+            # weren't replaced (or the backfill marker)
+            "maxResults": min(100, 2 * top),
+        }
+        summaries = {}
+        backfilled = False
+        scanned = 0
+        complete = True
+        try:
+            # summaries are listed newest first, so the first one
+            # seen for each session is its latest
+            while len(summaries) < top and scanned < SUMMARY_MAX_EVENTS:
+                response = _memory_call("list_events", deadline, **params)
+                for event in response.get("events", []):
+                    for item in event.get("payload", []):
+                        summary = item.get("blob")
+                        if isinstance(summary, dict) and "sessionId" in summary:
+                            summaries.setdefault(summary["sessionId"], summary)
+                        elif isinstance(summary, dict) and summary.get("backfilled"):
+                            # written by backfill_summaries.py once every
+                            # earlier session has a summary
+                            backfilled = True
+                scanned += len(response.get("events", []))
+                if "nextToken" not in response:
+                    break
+                params["nextToken"] = response["nextToken"]
+        except deadlines.DeadlineExceeded:
+            logging.warning(
+                f"deadline exceeded, returning {len(summaries)} sessions from summaries")
+            complete = False
+        except Exception as e:
+            # no summaries yet (or the read failed), scan the sessions instead
+            logging.info(f"no session summaries for {user_id}: {e}")
+            return None
+        if complete and len(summaries) < top and not backfilled:
+            # there may be older sessions without summaries, which
+            # scanning the sessions' events lists as well
+            return None
+
+        logging.info(f"listing {len(summaries)} sessions from summaries ({scanned} events)")
+        ordered = sorted(summaries.values(),
+                         key=lambda s: s.get("lastActivity") or "", reverse=True)
+        chat_history = []
+        for summary in ordered[:top]:
+            last_activity = datetime.fromisoformat(summary["lastActivity"])
+            chat_history.append({
+                "conversationId": summary["sessionId"],
+                "initial_question": summary.get("firstQuestion", "No question found"),
+                "created": format_timestamp(last_activity),
+            })
+        return chat_history, complete
 
+    def _list_from_events(self, user_id, top, deadline):
+        """lists conversations by reading each session's events"""
+
+        key = _list_key(user_id)
         try:
             logging.info(f"Listing sessions for user_id: {user_id}, memory_id: {memory_id}")
             if not memory_id:
                 raise Exception("MEMORY_ID environment variable is not set")
                 
-            response = memory_data_client.list_sessions(
+            response = _memory_call(
+                "list_sessions", deadline,
                 memoryId=memory_id,
                 actorId=user_id,
             )
@@ -119,27 +408,35 @@ class Database():
                 return []
 
         sessions_with_events = []
+        complete = True
         logging.info(
             f"Found {len(response['sessionSummaries'])} total sessions")
 
         for session in response["sessionSummaries"]:
             session_id = session['sessionId']
+            if session_id == SUMMARY_SESSION_ID:
+                continue
             # logging.info(f"Processing session: {session_id}")
 
-            events_response = memory_data_client.list_events(
-                memoryId=memory_id,
-                actorId=user_id,
-                sessionId=session_id,
-                includePayloads=True,
-                maxResults=100,
-            )
+            try:
+                events_response = _memory_call(
+                    "list_events", deadline,
+                    memoryId=memory_id,
+                    actorId=user_id,
+                    sessionId=session_id,
+                    includePayloads=True,
+                    maxResults=100,
+                )
+            except deadlines.DeadlineExceeded:
+                logging.warning(
+                    f"deadline exceeded, returning {len(sessions_with_events)} of {len(response['sessionSummaries'])} sessions")
+                complete = False
+                break
             events = events_response.get('events', [])
             # logging.info(f"Session {session_id} has {len(events)} events")
 
             if events:
                 # Sort events by eventTimestamp (convert to datetime for proper sorting)
-                from datetime import datetime
-
                 def parse_timestamp(event):
                     ts = event['eventTimestamp']
                     if isinstance(ts, str):
@@ -177,17 +474,7 @@ class Database():
                     if 'text' in content:
                         initial_question = content['text']
 
-            # Format timestamp as M/D/YY H:MM AM/PM
-            created_dt = session_data['latest_timestamp']
-
-            # Manual 12-hour format conversion
-            hour = created_dt.hour
-            am_pm = "AM" if hour < 12 else "PM"
-            hour_12 = hour if hour == 0 or hour == 12 else hour % 12
-            if hour_12 == 0:
-                hour_12 = 12
-
-            created = f"{created_dt.month}/{created_dt.day}/{created_dt.year} {hour_12}:{created_dt.minute:02d} {am_pm}"
+            created = format_timestamp(session_data['latest_timestamp'])
 
             chat_history.append({
                 "conversationId": session_data['session']['sessionId'],
@@ -195,4 +482,8 @@ class Database():
                 "created": created
             })
 
+        # don't cache partial results
+        if complete:
+            cache.set(key, {"top": top, "chat_history": chat_history},
+                      LIST_CACHE_TTL)
         return chat_history
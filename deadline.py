@@ -0,0 +1,197 @@
+import os
+import time
+import random
+import logging
+import threading
+import boto3
+import limiter
+import capture
+from botocore.config import Config
+from botocore.exceptions import (
+    ClientError,
+    ConnectTimeoutError,
+    EndpointConnectionError,
+    ReadTimeoutError,
+)
+
+# header that api clients can use to set their own timeout (in seconds)
+HEADER = "X-Request-Timeout"
+
+# default per request budgets (seconds), by admission pool
+DEFAULT_TIMEOUTS = {
+    "agent": 120,
+    "default": 10,
+}
+
+# upper bound for client supplied timeouts
+MAX_TIMEOUT = float(os.getenv("DEADLINE_MAX", 300))
+
+# maximum time to spend establishing a connection
+CONNECT_TIMEOUT = float(os.getenv("DEADLINE_CONNECT_TIMEOUT", 3))
+
+# read timeouts are rounded up to one of these values (0.1s to ~500s, each
+# 10% more than the last) so that a few dozen clients are created per
+# service instead of one per request, and no call gets less time than is
+# left or more than 10% over it
+TIMEOUT_BUCKETS = [round(0.1 * 1.1 ** i, 3) for i in range(90)]
+
+RETRYABLE_ERROR_CODES = {
+    "ThrottlingException",
+    "ThrottledException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "InternalServerException",
+}
+
+
+# outbound limiters (see limiter.py) by operation, and the defaults for each
+LIMITERS = {
+    "invoke_agent_runtime": "agent_runtime",
+}
+LIMITER_DEFAULTS = {
+    "agent_runtime": {"initial": 8, "max": 64, "queue": 64, "max_wait": 30.0,
+                      # answer times vary too much to read anything into them
+                      "latency_tolerance": 0.0},
+    "memory": {"initial": 16, "max": 128, "queue": 128, "max_wait": 5.0},
+}
+
+
+def limiter_for(service, operation):
+    """returns the outbound limiter for an api operation"""
+    name = LIMITERS.get(operation, "memory" if service == "bedrock-agentcore" else service)
+    return limiter.get(name, **LIMITER_DEFAULTS.get(name, {}))
+
+
+class DeadlineExceeded(Exception):
+    """raised when a request runs out of time"""
+
+
+class Deadline():
+    """a point in time by which a request must complete"""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires = time.monotonic() + timeout
+
+    def remaining(self):
+        """seconds left before the deadline"""
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, what):
+        """raises DeadlineExceeded if the deadline has passed"""
+        if self.expired():
+            raise DeadlineExceeded(
+                f"deadline of {self.timeout}s exceeded before {what}")
+
+    def within(self, timeout):
+        """returns a deadline that expires in timeout seconds,
+        or at this deadline, whichever comes first"""
+        d = Deadline(min(timeout, self.remaining()))
+        d.timeout = timeout
+        return d
+
+
+def for_request(pool_name, endpoint, header_value):
+    """returns the deadline for an incoming request.
+    Budgets can be set per endpoint (DEADLINE_<ENDPOINT>), per pool
+    (DEADLINE_AGENT, DEADLINE_DEFAULT) and overridden by the client
+    using the X-Request-Timeout header"""
+
+    timeout = float(os.getenv(f"DEADLINE_{pool_name.upper()}",
+                              DEFAULT_TIMEOUTS.get(pool_name, DEFAULT_TIMEOUTS["default"])))
+    if endpoint:
+        timeout = float(os.getenv(f"DEADLINE_{endpoint.upper()}", timeout))
+    if header_value:
+        try:
+            requested = float(header_value)
+            if requested > 0:
+                timeout = min(requested, MAX_TIMEOUT)
+        except ValueError:
+            logging.warning(f"ignoring invalid {HEADER} header: {header_value}")
+    return Deadline(timeout)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def client(service, deadline, region=None):
+    """returns a boto3 client whose connect and read timeouts fit
+    within the remaining time of the deadline. botocore retries are
+    disabled so that retry decisions can take the deadline into account.
+    region defaults to the app's region"""
+
+    remaining = deadline.remaining()
+    read_timeout = next((bucket for bucket in TIMEOUT_BUCKETS if bucket >= remaining),
+                        TIMEOUT_BUCKETS[-1])
+
+    key = (service, region, read_timeout)
+    with _clients_lock:
+        c = _clients.get(key)
+        if c is None:
+            c = _clients[key] = boto3.client(service, region_name=region, config=Config(
+                connect_timeout=min(CONNECT_TIMEOUT, read_timeout),
+                read_timeout=read_timeout,
+                retries={"total_max_attempts": 1},
+            ))
+        return c
+
+
+def _is_retryable(e):
+    """only retry errors where the request was throttled or never sent"""
+    if isinstance(e, (ConnectTimeoutError, EndpointConnectionError)):
+        return True
+    if isinstance(e, ClientError):
+        return e.response.get("Error", {}).get("Code") in RETRYABLE_ERROR_CODES
+    return False
+
+
+def _error_code(e):
+    if isinstance(e, ClientError):
+        return e.response.get("Error", {}).get("Code", type(e).__name__)
+    return type(e).__name__
+
+
+def call(service, operation, deadline, max_attempts=3, region=None, **kwargs):
+    """calls a boto3 operation (in region, or the app's region) within a deadline.
+    Calls go through the api's outbound limiter, which may queue them or
+    raise limiter.Overloaded. Failed attempts are retried with exponential
+    backoff (and jitter), but only when there is enough time left for
+    another attempt to complete."""
+
+    delay = 0.1
+    outbound = limiter_for(service, operation)
+    for attempt in range(1, max_attempts + 1):
+        deadline.check(f"{service}.{operation}")
+        c = client(service, deadline, region)
+        start = outbound.acquire(deadline.remaining())
+        try:
+            response = getattr(c, operation)(**kwargs)
+            outbound.release(start, "ok")
+            capture.call(service, operation, kwargs, start, response=response)
+            return response
+        except ReadTimeoutError as e:
+            # not retried since the request may have been processed
+            outbound.release(start, "error")
+            capture.call(service, operation, kwargs, start, error="ReadTimeout")
+            raise DeadlineExceeded(
+                f"{service}.{operation} timed out after {time.monotonic() - start:.1f}s") from e
+        except Exception as e:
+            outbound.release(start, "throttled" if limiter.is_throttle(e) else "error")
+            capture.call(service, operation, kwargs, start, error=_error_code(e))
+            elapsed = time.monotonic() - start
+            if attempt == max_attempts or not _is_retryable(e):
+                raise
+            if deadline.remaining() < elapsed + delay:
+                logging.warning(
+                    f"{service}.{operation} failed with {type(e).__name__}, not enough time left to retry")
+                raise
+            # jitter keeps throttled callers from retrying in lockstep
+            sleep = random.uniform(delay / 2, delay)
+            logging.warning(
+                f"{service}.{operation} failed with {type(e).__name__}, retrying in {sleep:.1f}s (attempt {attempt})")
+            time.sleep(sleep)
+            delay *= 2
@@ -0,0 +1,403 @@
+"""
+local stand-in for the bedrock-agentcore data plane apis this project uses
+(invoke_agent_runtime, create_event, delete_event, list_events,
+list_sessions and list_actors, which also covers MemoryClient.get_last_k_turns), backed by
+in-memory state.
+
+point boto3 at it with:
+
+    export AWS_ENDPOINT_URL_BEDROCK_AGENTCORE=http://localhost:9000
+
+latency, throttling and payload sizes can be configured per operation, e.g.
+
+    python emulator.py --latency invoke_agent_runtime=lognormal:3:0.5 \\
+        --latency list_events=lognormal:0.05:0.3 \\
+        --error_rate list_events=0.02 --max_concurrency invoke_agent_runtime=10
+
+and per runtime (the end of its arn), e.g. to emulate a degraded runtime
+when the app routes across several (AGENT_RUNTIMES):
+
+    python emulator.py --runtime_latency app-slow=lognormal:8:0.5
+"""
+import re
+import json
+import math
+import time
+import uuid
+import random
+import argparse
+import threading
+import urllib.request
+from urllib.parse import unquote, urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+OPERATIONS = ["invoke_agent_runtime", "create_event", "delete_event",
+              "list_events", "list_sessions", "list_actors"]
+
+# where the agent's memory hook writes session summaries
+SUMMARY_SESSION_ID = "session-summaries"
+
+# method, path pattern, operation
+ROUTES = [
+    ("POST", re.compile(r"^/runtimes/(?P<agentRuntimeArn>[^/]+)/invocations$"),
+     "invoke_agent_runtime"),
+    ("POST", re.compile(r"^/memories/(?P<memoryId>[^/]+)/events$"),
+     "create_event"),
+    ("DELETE", re.compile(
+        r"^/memories/(?P<memoryId>[^/]+)/actor/(?P<actorId>[^/]+)/sessions/(?P<sessionId>[^/]+)/events/(?P<eventId>[^/]+)$"),
+     "delete_event"),
+    ("POST", re.compile(
+        r"^/memories/(?P<memoryId>[^/]+)/actor/(?P<actorId>[^/]+)/sessions/(?P<sessionId>[^/]+)$"),
+     "list_events"),
+    ("POST", re.compile(
+        r"^/memories/(?P<memoryId>[^/]+)/actor/(?P<actorId>[^/]+)/sessions$"),
+     "list_sessions"),
+    ("POST", re.compile(r"^/memories/(?P<memoryId>[^/]+)/actors$"),
+     "list_actors"),
+]
+
+
+def parse_distribution(spec):
+    """returns a function that samples a latency (in seconds) from a spec:
+    fixed:<s>, uniform:<low>:<high>, exp:<mean> or lognormal:<median>:<sigma>"""
+    name, *params = spec.split(":")
+    params = [float(p) for p in params]
+    if name == "fixed":
+        return lambda: params[0]
+    if name == "uniform":
+        return lambda: random.uniform(params[0], params[1])
+    if name == "exp":
+        return lambda: random.expovariate(1 / params[0])
+    if name == "lognormal":
+        median, sigma = params
+        return lambda: random.lognormvariate(math.log(median), sigma)
+    raise ValueError(f"unknown latency distribution: {spec}")
+
+
+def parse_per_operation(values, convert, default):
+    """parses repeated <operation>=<value> flags"""
+    result = {op: default for op in OPERATIONS}
+    for value in values or []:
+        op, _, setting = value.partition("=")
+        if op not in result:
+            raise ValueError(f"unknown operation {op}, expected one of {OPERATIONS}")
+        result[op] = convert(setting)
+    return result
+
+
+class ServiceError(Exception):
+    def __init__(self, status, code, message):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+
+
+class Memory():
+    """events stored per (memory, actor, session), oldest first"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._client_tokens = {}
+
+    def create_event(self, memory_id, actor_id, session_id, payload, timestamp=None,
+                     client_token=None):
+        """a retried call with the same client token returns the event
+        it created, like the real api"""
+        with self._lock:
+            if client_token in self._client_tokens:
+                return self._client_tokens[client_token]
+        event = {
+            "memoryId": memory_id,
+            "actorId": actor_id,
+            "sessionId": session_id,
+            "eventId": f"{int(time.time() * 1000)}#{uuid.uuid4().hex[:8]}",
+            "eventTimestamp": timestamp or time.time(),
+            "payload": payload,
+        }
+        with self._lock:
+            actor = self._sessions.setdefault((memory_id, actor_id), {})
+            actor.setdefault(session_id, {"createdAt": event["eventTimestamp"],
+                                          "events": []})["events"].append(event)
+            if client_token:
+                self._client_tokens[client_token] = event
+        return event
+
+    def delete_event(self, memory_id, actor_id, session_id, event_id):
+        with self._lock:
+            session = self._sessions.get((memory_id, actor_id), {}).get(session_id)
+            events = session["events"] if session else []
+            for i, event in enumerate(events):
+                if event["eventId"] == event_id:
+                    del events[i]
+                    return
+        raise ServiceError(404, "ResourceNotFoundException", f"Event {event_id} not found")
+
+    def list_events(self, memory_id, actor_id, session_id):
+        """events newest first, like the real api"""
+        with self._lock:
+            session = self._sessions.get((memory_id, actor_id), {}).get(session_id)
+            return list(reversed(session["events"])) if session else []
+
+    def list_sessions(self, memory_id, actor_id):
+        with self._lock:
+            sessions = self._sessions.get((memory_id, actor_id), {})
+            return [{"sessionId": session_id, "actorId": actor_id,
+                     "createdAt": session["createdAt"]}
+                    for session_id, session in sessions.items()]
+
+    def list_actors(self, memory_id):
+        with self._lock:
+            return [{"actorId": actor_id}
+                    for (memory, actor_id) in self._sessions if memory == memory_id]
+
+
+def paginate(items, body, default_page_size=20):
+    page_size = int(body.get("maxResults") or default_page_size)
+    start = int(body.get("nextToken") or 0)
+    page = {"items": items[start:start + page_size]}
+    if start + page_size < len(items):
+        page["nextToken"] = str(start + page_size)
+    return page
+
+
+class Emulator():
+
+    def __init__(self, args):
+        self.memory = Memory()
+        self.latency = parse_per_operation(args.latency, parse_distribution, None)
+        self.error_rate = parse_per_operation(args.error_rate, float, 0)
+        self.max_concurrency = parse_per_operation(args.max_concurrency, int, None)
+        self.runtime_latency = {}
+        for value in args.runtime_latency or []:
+            runtime, _, spec = value.partition("=")
+            self.runtime_latency[runtime] = parse_distribution(spec)
+        self.answer_size = args.answer_size
+        self.agent_url = args.agent_url
+        self.default_memory_id = args.memory_id
+        self._in_flight = {op: 0 for op in OPERATIONS}
+        self._lock = threading.Lock()
+        self.requests = {op: 0 for op in OPERATIONS}
+        self.throttled = {op: 0 for op in OPERATIONS}
+
+    def handle(self, operation, params, query, headers, body):
+        """runs an operation with the configured faults and latency"""
+        with self._lock:
+            self.requests[operation] += 1
+            limit = self.max_concurrency[operation]
+            throttled = ((limit is not None and self._in_flight[operation] >= limit)
+                         or random.random() < self.error_rate[operation])
+            if throttled:
+                self.throttled[operation] += 1
+            else:
+                self._in_flight[operation] += 1
+        if throttled:
+            raise ServiceError(429, "ThrottlingException", "Rate exceeded")
+
+        try:
+            latency = self.latency[operation]
+            if operation == "invoke_agent_runtime":
+                runtime = params["agentRuntimeArn"].rsplit("/", 1)[-1]
+                latency = self.runtime_latency.get(runtime, latency)
+            if latency:
+                time.sleep(latency())
+            return getattr(self, operation)(params, query, headers, body)
+        finally:
+            with self._lock:
+                self._in_flight[operation] -= 1
+
+    def invoke_agent_runtime(self, params, query, headers, body):
+        session_id = headers.get("X-Amzn-Bedrock-AgentCore-Runtime-Session-Id") or str(uuid.uuid4())
+        if self.agent_url:
+            # forward to a locally running agent
+            request = urllib.request.Request(
+                f"{self.agent_url}/invocations", data=body, method="POST",
+                headers={"Content-Type": "application/json",
+                         "X-Amzn-Bedrock-AgentCore-Runtime-Session-Id": session_id})
+            with urllib.request.urlopen(request) as response:
+                return 200, response.read(), {
+                    "X-Amzn-Bedrock-AgentCore-Runtime-Session-Id": session_id}
+
+        # synthetic agent: answers with filler text and stores the
+        # turn in memory, like the agent's memory hook does (unless the
+        # question may be hedged)
+        invoke_input = json.loads(body)["input"]
+        prompt = invoke_input["prompt"]
+        user_id = headers.get("X-Amzn-Bedrock-AgentCore-Runtime-User-Id") or invoke_input["user_id"]
+        filler = "lorem ipsum dolor sit amet "
+        answer = f"You asked: {prompt}\n\n"
+        answer += (filler * (self.answer_size // len(filler) + 1))[:max(0, self.answer_size - len(answer))]
+        if invoke_input.get("record", True) is not False:
+            self._record_turn(user_id, session_id, prompt, answer)
+        response = {
+            "output": {
+                "message": {"role": "assistant", "content": [{"text": answer}]},
+                "stop_reason": "end_turn",
+                # rough estimate of ~4 characters per token
+                "usage": {
+                    "input_tokens": len(prompt) // 4,
+                    "output_tokens": len(answer) // 4,
+                    "total_tokens": (len(prompt) + len(answer)) // 4,
+                    "model_cycles": 1,
+                    "tool_calls": 0,
+                    "model": "emulator",
+                    "route": "fast",
+                    "speculation": "off",
+                },
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "model": "emulator",
+            }
+        }
+        return 200, json.dumps(response).encode(), {
+            "X-Amzn-Bedrock-AgentCore-Runtime-Session-Id": session_id}
+
+    def _record_turn(self, user_id, session_id, prompt, answer):
+        """stores a question and answer, and the session's summary in
+        place of its previous one"""
+        for text, role in [(prompt, "USER"), (answer, "ASSISTANT")]:
+            event = self.memory.create_event(
+                self.default_memory_id, user_id, session_id,
+                [{"conversational": {"content": {"text": text}, "role": role}}])
+        events = self.memory.list_events(self.default_memory_id, user_id, session_id)
+        first = events[-1]["payload"][0]["conversational"]["content"]["text"]
+        summary = {
+            "sessionId": session_id,
+            "firstQuestion": first[:200],
+            "turns": len(events) // 2,
+            "lastActivity": time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime()),
+            "lastEventId": event["eventId"],
+        }
+        previous = [e["eventId"] for e in self.memory.list_events(
+                        self.default_memory_id, user_id, SUMMARY_SESSION_ID)
+                    if e["payload"][0].get("blob", {}).get("sessionId") == session_id]
+        self.memory.create_event(
+            self.default_memory_id, user_id, SUMMARY_SESSION_ID, [{"blob": summary}])
+        for event_id in previous:
+            self.memory.delete_event(self.default_memory_id, user_id, SUMMARY_SESSION_ID, event_id)
+
+    def create_event(self, params, query, headers, body):
+        body = json.loads(body)
+        event = self.memory.create_event(
+            params["memoryId"], body["actorId"], body["sessionId"],
+            body["payload"], body.get("eventTimestamp"), body.get("clientToken"))
+        return 201, json.dumps({"event": event}).encode(), {}
+
+    def delete_event(self, params, query, headers, body):
+        self.memory.delete_event(params["memoryId"], params["actorId"],
+                                 params["sessionId"], params["eventId"])
+        return 200, json.dumps({"eventId": params["eventId"]}).encode(), {}
+
+    def list_events(self, params, query, headers, body):
+        body = json.loads(body or b"{}")
+        events = self.memory.list_events(
+            params["memoryId"], params["actorId"], params["sessionId"])
+        if not body.get("includePayloads", True):
+            events = [{k: v for k, v in e.items() if k != "payload"} for e in events]
+        page = paginate(events, body)
+        response = {"events": page.pop("items"), **page}
+        return 200, json.dumps(response).encode(), {}
+
+    def list_sessions(self, params, query, headers, body):
+        body = json.loads(body or b"{}")
+        sessions = self.memory.list_sessions(params["memoryId"], params["actorId"])
+        page = paginate(sessions, body)
+        response = {"sessionSummaries": page.pop("items"), **page}
+        return 200, json.dumps(response).encode(), {}
+
+    def list_actors(self, params, query, headers, body):
+        body = json.loads(body or b"{}")
+        page = paginate(self.memory.list_actors(params["memoryId"]), body)
+        response = {"actorSummaries": page.pop("items"), **page}
+        return 200, json.dumps(response).encode(), {}
+
+
+def make_handler(emulator):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body, headers):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _route(self, method):
+            url = urlparse(self.path)
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+            if method == "GET" and url.path == "/stats":
+                stats = {"requests": emulator.requests, "throttled": emulator.throttled}
+                return self._send(200, json.dumps(stats).encode(), {})
+
+            for route_method, pattern, operation in ROUTES:
+                match = pattern.match(url.path)
+                if route_method == method and match:
+                    params = {k: unquote(v) for k, v in match.groupdict().items()}
+                    try:
+                        status, response, headers = emulator.handle(
+                            operation, params, parse_qs(url.query), self.headers, body)
+                    except ServiceError as e:
+                        status, headers = e.status, {"X-Amzn-ErrorType": e.code}
+                        response = json.dumps({"message": str(e)}).encode()
+                    except Exception as e:
+                        status, headers = 500, {"X-Amzn-ErrorType": "InternalServerException"}
+                        response = json.dumps({"message": str(e)}).encode()
+                    return self._send(status, response, headers)
+
+            self._send(404, json.dumps({"message": f"unsupported: {method} {url.path}"}).encode(),
+                       {"X-Amzn-ErrorType": "UnknownOperationException"})
+
+        def do_GET(self):
+            self._route("GET")
+
+        def do_POST(self):
+            self._route("POST")
+
+        def do_DELETE(self):
+            self._route("DELETE")
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local bedrock-agentcore emulator",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__)
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", action="append", metavar="OPERATION=DIST",
+                        help="latency distribution for an operation: fixed:<s>, "
+                        "uniform:<low>:<high>, exp:<mean> or lognormal:<median>:<sigma>")
+    parser.add_argument("--runtime_latency", action="append", metavar="RUNTIME=DIST",
+                        help="latency distribution for invoke_agent_runtime on one runtime "
+                        "(the end of its arn), instead of the operation's")
+    parser.add_argument("--error_rate", action="append", metavar="OPERATION=P",
+                        help="fraction of calls that fail with a ThrottlingException")
+    parser.add_argument("--max_concurrency", action="append", metavar="OPERATION=N",
+                        help="calls beyond this many in flight are throttled")
+    parser.add_argument("--answer_size", type=int, default=1000,
+                        help="size (in characters) of synthetic agent answers")
+    parser.add_argument("--agent_url", default=None,
+                        help="forward invoke_agent_runtime to a local agent "
+                        "(e.g. http://localhost:8080) instead of answering synthetically")
+    parser.add_argument("--memory_id", default="memory-emulator",
+                        help="memory that synthetic answers are stored in (MEMORY_ID)")
+    args = parser.parse_args()
+
+    emulator = Emulator(args)
+    server = ThreadingHTTPServer(("0.0.0.0", args.port), make_handler(emulator))
+    server.daemon_threads = True
+    print(f"bedrock-agentcore emulator listening on http://localhost:{args.port}")
+    print(f"export AWS_ENDPOINT_URL_BEDROCK_AGENTCORE=http://localhost:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
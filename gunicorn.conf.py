@@ -0,0 +1,18 @@
+import tuning
+
+# gunicorn settings for the web app, loaded from the working directory.
+# workers and threads are sized from the container's cpus and memory and
+# the admission limits, and each worker resizes its thread pool as it runs
+# (see tuning.py). WEB_CONCURRENCY and GUNICORN_THREADS fix them instead
+
+worker_class = "gthread"
+workers = tuning.workers()
+threads = tuning.threads()
+
+
+def on_starting(server):
+    server.log.info(f"gunicorn: {tuning.describe()}")
+
+
+def post_worker_init(worker):
+    tuning.attach(worker)
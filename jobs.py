@@ -0,0 +1,156 @@
+import os
+import time
+import uuid
+import queue
+import logging
+import threading
+import cache
+import metrics
+
+# questions can be answered asynchronously: the request returns a job id
+# right away and the answer is fetched later from /api/jobs/<id>.
+# job state is kept in the cache, so any worker process can serve it
+
+# number of jobs executed at once
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", 4))
+
+# maximum number of jobs waiting for a worker
+JOBS_MAX_QUEUE = int(os.getenv("JOBS_MAX_QUEUE", 100))
+
+# how long finished jobs can be fetched (seconds)
+JOBS_TTL = int(os.getenv("JOBS_TTL", 3600))
+
+# longest a client can long poll for (seconds)
+JOBS_MAX_WAIT = float(os.getenv("JOBS_MAX_WAIT", 30))
+
+# maximum number of concurrent long polls (per process),
+# polls beyond this return the current state immediately
+JOBS_MAX_WAITERS = int(os.getenv("JOBS_MAX_WAITERS", 32))
+
+# how often long polls check for jobs running in other processes
+POLL_INTERVAL = 0.5
+
+DONE = ("succeeded", "failed")
+
+
+def requested(request):
+    """whether the client asked for an asynchronous response, with
+    ?async=true or a "Prefer: respond-async" header"""
+    if request.args.get("async", "").lower() in ("1", "true"):
+        return True
+    return "respond-async" in request.headers.get("Prefer", "")
+
+
+class QueueFull(Exception):
+    """raised when too many jobs are waiting"""
+
+
+def _key(job_id):
+    return f"job:{job_id}"
+
+
+class JobQueue():
+    """Runs jobs on a fixed pool of worker threads.
+    Jobs wait in a bounded queue and are rejected when it's full."""
+
+    def __init__(self, workers=JOBS_WORKERS, max_queue=JOBS_MAX_QUEUE):
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._events = {}  # job id -> event set when a local job finishes
+        self._lock = threading.Lock()
+        self._waiters = threading.BoundedSemaphore(JOBS_MAX_WAITERS)
+        self.running = 0
+
+        metrics.gauge("jobs_queued", fn=self._queue.qsize)
+        metrics.gauge("jobs_running", fn=lambda: self.running)
+        self._queue_time = metrics.histogram("jobs_queue_seconds")
+        self._run_time = metrics.histogram("jobs_run_seconds")
+
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"job-{i}",
+                             daemon=True).start()
+
+    def _save(self, job):
+        cache.set(_key(job["jobId"]), job, JOBS_TTL)
+
+    def submit(self, user_id, fn):
+        """queues fn() to run in the background and returns the job.
+        fn returns the json serializable result. raises QueueFull"""
+        job = {
+            "jobId": str(uuid.uuid4()),
+            "userId": user_id,
+            "status": "queued",
+            "createdAt": time.time(),
+        }
+        with self._lock:
+            self._events[job["jobId"]] = threading.Event()
+        self._save(job)
+        try:
+            self._queue.put_nowait((job, fn))
+        except queue.Full:
+            with self._lock:
+                del self._events[job["jobId"]]
+            cache.delete(_key(job["jobId"]))
+            metrics.counter("jobs", status="rejected").inc()
+            raise QueueFull(f"too many queued jobs (max {self._queue.maxsize})")
+        metrics.counter("jobs", status="submitted").inc()
+        return job
+
+    def _work(self):
+        while True:
+            job, fn = self._queue.get()
+            job["status"] = "running"
+            job["startedAt"] = time.time()
+            job["queueSeconds"] = round(job["startedAt"] - job["createdAt"], 3)
+            self._queue_time.observe(job["queueSeconds"])
+            self._save(job)
+            with self._lock:
+                self.running += 1
+            try:
+                job["result"] = fn()
+                job["status"] = "succeeded"
+            except Exception as e:
+                logging.error(f"job {job['jobId']} failed: {e}")
+                job["status"] = "failed"
+                job["error"] = str(e) or type(e).__name__
+            finally:
+                with self._lock:
+                    self.running -= 1
+            job["finishedAt"] = time.time()
+            job["runSeconds"] = round(job["finishedAt"] - job["startedAt"], 3)
+            self._run_time.observe(job["runSeconds"])
+            metrics.counter("jobs", status=job["status"]).inc()
+            self._save(job)
+            with self._lock:
+                event = self._events.pop(job["jobId"], None)
+            if event is not None:
+                event.set()
+
+    def get(self, job_id, user_id, wait=0):
+        """returns a job, waiting up to `wait` seconds for it to finish.
+        returns None if the job doesn't exist (or has expired)"""
+        job = cache.get(_key(job_id))
+        if job is None or job["userId"] != user_id:
+            return None
+        wait = min(wait, JOBS_MAX_WAIT)
+        if job["status"] in DONE or wait <= 0:
+            return job
+        if not self._waiters.acquire(blocking=False):
+            metrics.counter("jobs_long_poll_rejected").inc()
+            return job
+        try:
+            with self._lock:
+                event = self._events.get(job_id)
+            deadline = time.monotonic() + wait
+            while job["status"] not in DONE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if event is not None:
+                    # running in this process
+                    event.wait(remaining)
+                else:
+                    time.sleep(min(POLL_INTERVAL, remaining))
+                job = cache.get(_key(job_id)) or job
+        finally:
+            self._waiters.release()
+        return job
@@ -1,5 +1,6 @@
 import logging
 import json
+import capture
 
 # logging.basicConfig(format="%(message)s", level=logging.DEBUG)
 logging.basicConfig(format="%(message)s", level=logging.INFO)
@@ -23,9 +24,11 @@ def info(obj):
 
 
 def llm(input, output):
-    """log llm calls to stdout using specific format"""
+    """log llm calls to stdout using specific format,
+    and to the traffic capture if there is one (see capture.py)"""
     payload = {
         "input": input,
         "output": output
     }
     print(f"LLM: {json.dumps(payload, default=str)}")
+    capture.llm(input, output)
@@ -3,20 +3,34 @@ import log
 import sys
 import os
 import signal
+import time
+import hashlib
+import json
 from datetime import datetime, timezone
-from flask import Flask, request, render_template, abort
-from markupsafe import Markup
+from flask import Flask, Response, request, render_template, abort, g, make_response
+from markupsafe import Markup, escape
 import mistune
 import uuid
 import database
 import orchestrator
+import admission
+import deadline as deadlines
+import limiter
+import metrics
+import profiler
+import responses
+import cache
+import prefetch
+import batch
+import jobs
+import search
+import capture
 
 # otel
 from opentelemetry.instrumentation.flask import FlaskInstrumentor
 from opentelemetry import trace
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import ConsoleSpanExporter, BatchSpanProcessor
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+import telemetry
 from opentelemetry.instrumentation.botocore import BotocoreInstrumentor
 
 
@@ -28,9 +42,8 @@ def signal_handler(signal, frame):
 signal.signal(signal.SIGTERM, signal_handler)
 app = Flask(__name__)
 
-# Setup OpenTelemetry
-tracer_provider = TracerProvider()
-tracer_provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+# Setup OpenTelemetry (sampling and export limits are set in telemetry.py)
+tracer_provider = telemetry.tracer_provider(OTLPSpanExporter())
 trace.set_tracer_provider(tracer_provider)
 FlaskInstrumentor().instrument_app(app)
 BotocoreInstrumentor().instrument()
@@ -52,11 +65,94 @@ def after_request(response):
     return response
 
 
+@app.before_request
+def capture_start():
+    """note when the request arrived, for the traffic capture"""
+    if capture.enabled():
+        g.capture_start = (time.time(), time.monotonic())
+
+
+@app.after_request
+def capture_request(response):
+    """record the request for replay (see capture.py)"""
+    start = g.pop("capture_start", None)
+    if start is not None:
+        try:
+            capture.request(
+                request.method, request.path, request.args.to_dict(),
+                request.form.to_dict() or None, request.get_json(silent=True),
+                request.headers, response.status_code, start,
+                response.headers.get("Location"))
+        except Exception as e:
+            logging.warning(f"failed to capture request: {e}")
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    """cache static assets and compress large responses"""
+    response = responses.cache_static(response)
+    return responses.compress(response)
+
+
+app.jinja_env.globals["static_url"] = responses.static_url
+
+
+admission_controller = admission.AdmissionController()
+
+
+@app.before_request
+def admit_request():
+    """apply admission control before running the route"""
+    pool = admission_controller.pool_for(request.endpoint)
+    if pool is None:
+        return
+    g.deadline = deadlines.for_request(
+        pool.name, request.endpoint, request.headers.get(deadlines.HEADER))
+    try:
+        pool.acquire(get_current_user_id(), g.deadline.remaining())
+    except admission.Rejected as e:
+        response = make_response(
+            f"server busy ({e.reason}), please retry", e.status_code)
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response
+    g.admission_pool = pool
+    g.admission_start = time.monotonic()
+
+
+@app.teardown_request
+def release_admission(exception):
+    """give the admission slot back once the response is done"""
+    pool = g.pop("admission_pool", None)
+    if pool is not None:
+        pool.release(time.monotonic() - g.admission_start)
+
+
+@app.errorhandler(deadlines.DeadlineExceeded)
+def deadline_exceeded(e):
+    """the request ran out of time waiting on a downstream service"""
+    logging.warning(f"deadline exceeded: {e}")
+    if request.path.startswith("/api/"):
+        return {"error": "request timed out", "detail": str(e)}, 504
+    return "Sorry, the request took too long. Please try again.", 504
+
+
+@app.errorhandler(limiter.Overloaded)
+def downstream_overloaded(e):
+    """a downstream service is at its limit and the call was shed"""
+    if request.path.startswith("/api/"):
+        response = make_response({"error": "service busy", "detail": str(e)}, 503)
+    else:
+        response = make_response("Sorry, the service is busy. Please try again.", 503)
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+
 # Validate required environment variables at startup
 def validate_environment():
     """Validate that all required environment variables are set"""
     required_vars = {
-        'AGENT_RUNTIME': os.getenv('AGENT_RUNTIME'),
+        'AGENT_RUNTIME': os.getenv('AGENT_RUNTIME') or os.getenv('AGENT_RUNTIMES'),
         'AWS_REGION': os.getenv('AWS_REGION'),
         'MEMORY_ID': os.getenv('MEMORY_ID')
     }
@@ -81,17 +177,46 @@ validate_environment()
 # initialize database client
 db = database.Database()
 
+# speculatively loads conversations the user is likely to open next
+prefetcher = prefetch.Prefetcher(db, admission_controller.pools["default"])
+
+# answers questions asked with ?async=true in the background
+job_queue = jobs.JobQueue()
+
+# full text search over each user's questions and answers
+search_index = search.SearchIndex()
+
+
+# how long rendered markdown is cached (seconds)
+MARKDOWN_CACHE_TTL = int(os.getenv("MARKDOWN_CACHE_TTL", 3600))
+
 
 @app.template_filter('markdown')
 def render_markdown(text):
     """Render Markdown text to HTML"""
+
+    key = "markdown:" + hashlib.sha1(text.encode()).hexdigest()
+    html = cache.get(key)
+    if html is not None:
+        return Markup(html)
+
     renderer = mistune.create_markdown(
         escape=False,
         plugins=['strikethrough', 'footnotes', 'table']
     )
 
     # Render the markdown as-is - let mistune handle proper formatting
-    return Markup(renderer(text))
+    html = renderer(text)
+    cache.set(key, html, MARKDOWN_CACHE_TTL)
+    return Markup(html)
+
+
+@app.template_filter('highlight')
+def highlight(text, query):
+    """wraps the words of text that match the search query in <mark>"""
+    return Markup("".join(
+        f"<mark>{escape(piece)}</mark>" if matched else str(escape(piece))
+        for piece, matched in search.highlight(text, query)))
 
 
 @app.route("/health")
@@ -99,6 +224,24 @@ def health_check():
     return "healthy"
 
 
+@app.route("/metrics")
+def get_metrics():
+    """GET /metrics returns in-process metrics as json"""
+    return metrics.snapshot()
+
+
+@app.route("/debug/profile")
+def debug_profile():
+    """GET /debug/profile?seconds=N samples all thread stacks
+    and returns them as collapsed stacks or speedscope json"""
+    try:
+        body, content_type = profiler.profile(
+            request.args, request.headers.get("Authorization"))
+    except profiler.ProfileError as e:
+        return str(e), e.status_code
+    return body, 200, {"Content-Type": content_type}
+
+
 def get_current_user_id():
     """get the currently logged in user"""
     # TODO: get current user id from auth
@@ -106,14 +249,14 @@ def get_current_user_id():
     return "user-1"
 
 
-def get_chat_history(user_id):
+def get_chat_history(user_id, deadline=None):
     """
     fetches the user's latest chat history
     """
     logging.info(f"fetching chat history for user {user_id}")
 
     # fetch last 10 questions from db
-    return db.list_by_user(user_id, 10)
+    return db.list_by_user(user_id, 10, deadline)
 
 
 @app.route("/")
@@ -132,7 +275,42 @@ def new():
 def conversations():
     """GET /conversations returns just the conversation history"""
     user_id = get_current_user_id()
-    return render_template("conversations.html", chat_history=get_chat_history(user_id))
+    chat_history = get_chat_history(user_id, g.deadline)
+    prefetcher.prefetch_top(chat_history, user_id)
+    return responses.conditional(
+        responses.etag_for(user_id, chat_history),
+        lambda: render_template("conversations.html", chat_history=chat_history))
+
+
+def search_conversations(user_id, query, limit):
+    """searches a user's conversations. users whose index hasn't been built
+    from their history yet get it built in the background (meanwhile only
+    questions asked since are found)"""
+    if not search_index.built(user_id):
+        search_index.rebuild_in_background(user_id, lambda: db.history(user_id))
+    return search_index.search(user_id, query, limit), search_index.rebuilding(user_id)
+
+
+@app.route("/search")
+def search_page():
+    """GET /search?q= returns the sidebar's conversations that match
+    the query (or the latest conversations when it's empty)"""
+    user_id = get_current_user_id()
+    query = request.args.get("q", "").strip()
+    if not query:
+        return render_template("search_results.html", query="",
+                               results=get_chat_history(user_id, g.deadline))
+
+    matches, indexing = search_conversations(user_id, query, 10)
+    results = [{
+        "conversationId": match["conversationId"],
+        "initial_question": match["question"],
+        "snippet": match["snippet"],
+        "created": database.format_timestamp(
+            datetime.fromtimestamp(match["timestamp"], timezone.utc).astimezone()),
+    } for match in matches]
+    return render_template("search_results.html", query=query,
+                           results=results, indexing=indexing)
 
 
 @app.route("/ask", methods=["POST"])
@@ -172,17 +350,23 @@ def ask():
         }
 
         logging.info("calling ask_internal...")
-        _, conversation, sources = ask_internal(conversation, question)
+        _, conversation, sources, _ = ask_internal(
+            conversation, question, g.deadline, is_new_conversation)
         logging.info("ask_internal completed successfully")
 
-        # Only render the chat content, not the entire body
-        response = render_template("chat.html",
-                                   conversation=conversation,
-                                   sources=sources)
+        # Only render the new Q&A, which gets appended to the chat
+        response = render_template("question.html",
+                                   question=conversation["questions"][-1])
 
         # If this is a new conversation, also update the conversation history
         if is_new_conversation:
 
+            # remember the new conversation id for follow up questions
+            # and remove the empty chat placeholder
+            response += render_template("conversation_id.html",
+                                        conversation=conversation, oob=True)
+            response += '<div id="chat-empty" hx-swap-oob="true"></div>'
+
             utc_datetime = datetime.now(timezone.utc)
             local_datetime = utc_datetime.astimezone()
 
@@ -207,7 +391,10 @@ def ask():
             response += f'<div hx-swap-oob="afterbegin:#conversation-list">{conversation_item}</div>'
 
         return response
-        
+
+    except (deadlines.DeadlineExceeded, limiter.Overloaded):
+        # answered by their error handlers (504, 503 with Retry-After)
+        raise
     except Exception as e:
         logging.error(f"Error in /ask endpoint: {str(e)}")
         logging.error(f"Exception type: {type(e).__name__}")
@@ -216,27 +403,31 @@ def ask():
         abort(500, f"Internal server error: {str(e)}")
 
 
-def ask_internal(conversation, question):
+def ask_internal(conversation, question, deadline=None, new_conversation=False):
     """
     core ask implementation shared by app and api.
+    returns the answer, updated conversation, sources
+    and the agent's token usage and timings.
     """
     
     try:
         logging.info("Starting orchestrator.orchestrate...")
         # RAG orchestration to get answer
-        answer, sources = orchestrator.orchestrate(conversation, question)
+        answer, sources, usage = orchestrator.orchestrate(
+            conversation, question, deadline, new_conversation)
         logging.info(f"Orchestrator completed. Answer length: {len(answer) if answer else 0}")
 
-        conversation_id = conversation["conversationId"]
-        user_id = conversation["userId"]
-        logging.info(f"Fetching conversation from database: {conversation_id}")
-
-        # fetch latest conversation
-        conversation = db.get(conversation_id, user_id)
-        logging.info(f"Database fetch completed. Questions count: {len(conversation.get('questions', []))}")
-        sources = []
-
-        return answer, conversation, sources
+        # the agent persists the new Q&A to memory, so add it locally
+        # rather than fetching the whole conversation again
+        conversation["questions"].append({"q": question, "a": answer})
+        db.invalidate(conversation["conversationId"], conversation["userId"])
+        try:
+            search_index.add(conversation["userId"], conversation["conversationId"],
+                             question, answer)
+        except Exception as e:
+            logging.warning(f"failed to index question for search: {e}")
+
+        return answer, conversation, sources, usage
         
     except Exception as e:
         logging.error(f"Error in ask_internal: {str(e)}")
@@ -246,83 +437,214 @@ def ask_internal(conversation, question):
         raise
 
 
-if __name__ == '__main__':
-    port = 8080
-    print(f"listening on http://localhost:{port}")
-    app.run(host="0.0.0.0", port=port)
-
-
 @app.route("/conversation/<id>", methods=["GET"])
 def get_conversation(id):
     """GET /conversation/<id> fetches a conversation by id"""
 
     user_id = get_current_user_id()
-    conversation = db.get(id, user_id)
-    return render_template("chat.html", conversation=conversation)
+    prefetcher.join(id, user_id, g.deadline.remaining())
+    conversation = db.get(id, user_id, g.deadline)
+    return responses.conditional(
+        responses.etag_for(user_id, id, conversation["latestEventId"]),
+        lambda: render_template("chat.html", conversation=conversation))
 
 
-@app.route("/api/ask", methods=["POST"])
-def ask_api_new():
-    """returns an answer to a question in a new conversation"""
+@app.route("/conversation/<id>/prefetch", methods=["POST"])
+def prefetch_conversation(id):
+    """POST /conversation/<id>/prefetch starts loading a conversation
+    in the background (when it's hovered)"""
+    prefetcher.prefetch(id, get_current_user_id())
+    return "", 204
 
-    # get request json from body
-    body = request.get_json()
-    log.debug(body)
-    if "question" not in body:
-        m = "missing field: question"
-        logging.error(m)
-        abort(400, m)
-    question = body["question"]
 
-    conversation = {
-        "conversationId": str(uuid.uuid4()),
-        "userId": user_id,
-        "questions": [],
-    }
+def answer_question(conversation_id, user_id, question, deadline):
+    """answers a question in a new (conversation_id is None)
+    or existing conversation. returns the api response"""
+
+    if conversation_id is None:
+        conversation = {
+            "conversationId": str(uuid.uuid4()),
+            "userId": user_id,
+            "questions": [],
+        }
+    else:
+        conversation = db.get(conversation_id, user_id, deadline)
+        conversation["userId"] = user_id
+        logging.info("fetched conversation")
+        log.debug(conversation)
 
-    answer, conversation, sources = ask_internal(conversation, question)
+    answer, conversation, sources, usage = ask_internal(
+        conversation, question, deadline, conversation_id is None)
 
     return {
         "conversationId": conversation["conversationId"],
         "answer": answer,
         "sources": sources,
+        "usage": usage,
     }
 
 
+def answer_in_background(conversation_id, user_id, question, deadline):
+    """answers a question outside of a request. it is admitted through
+    the agent pool like a request, so background work shares
+    capacity fairly with interactive users"""
+    pool = admission_controller.pools["agent"]
+    pool.acquire_within(user_id, deadline)
+    start = time.monotonic()
+    try:
+        return answer_question(conversation_id, user_id, question, deadline)
+    finally:
+        pool.release(time.monotonic() - start)
+
+
+def job_response(job):
+    """the public view of a job"""
+    return {k: v for k, v in job.items() if k != "userId"}
+
+
+def submit_job(conversation_id, user_id, question):
+    """answers a question asynchronously, returning a 202 with the job"""
+    header = request.headers.get(deadlines.HEADER)
+    endpoint = request.endpoint
+
+    def run():
+        # the deadline starts when the job starts running
+        deadline = deadlines.for_request("agent", endpoint, header)
+        return answer_in_background(conversation_id, user_id, question, deadline)
+
+    try:
+        job = job_queue.submit(user_id, run)
+    except jobs.QueueFull as e:
+        logging.warning(str(e))
+        return {"error": str(e)}, 503, {"Retry-After": "5"}
+    return job_response(job), 202, {"Location": f"/api/jobs/{job['jobId']}"}
+
+
+def get_question(body):
+    """returns the question from an api request body"""
+    if not body or "question" not in body:
+        m = "missing field: question"
+        logging.error(m)
+        abort(400, m)
+    return body["question"]
+
+
+@app.route("/api/ask", methods=["POST"])
+def ask_api_new():
+    """returns an answer to a question in a new conversation.
+    with ?async=true (or Prefer: respond-async) returns a job instead"""
+
+    # get request json from body
+    body = request.get_json()
+    log.debug(body)
+    question = get_question(body)
+    user_id = get_current_user_id()
+
+    if jobs.requested(request):
+        return submit_job(None, user_id, question)
+    return answer_question(None, user_id, question, g.deadline)
+
+
 @app.route("/api/ask/<id>", methods=["POST"])
 def ask_api(id):
-    """returns an answer to a question in a conversation"""
+    """returns an answer to a question in a conversation.
+    with ?async=true (or Prefer: respond-async) returns a job instead"""
 
     # get request json from body
     body = request.get_json()
     log.debug(body)
-    if "question" not in body:
-        m = "missing field: question"
-        logging.error(m)
-        abort(400, m)
-    question = body["question"]
-
+    question = get_question(body)
     user_id = get_current_user_id()
 
     if id == "":
         m = "conversation id is required"
         logging.error(m)
         abort(400, m)
-    else:
-        conversation = db.get(id, user_id)
-        logging.info("fetched conversation")
-        log.debug(conversation)
 
-    answer, _, sources = ask_internal(conversation, question)
+    if jobs.requested(request):
+        return submit_job(id, user_id, question)
+    return answer_question(id, user_id, question, g.deadline)
 
-    return {
-        "conversationId": id,
-        "answer": answer,
-        "sources": sources,
-    }
+
+@app.route("/api/jobs/<id>")
+def get_job(id):
+    """returns an asynchronous question's job. with ?wait=N,
+    waits up to N seconds for it to finish (long poll)"""
+    try:
+        wait = float(request.args.get("wait", 0))
+    except ValueError:
+        abort(400, "wait must be a number")
+    job = job_queue.get(id, get_current_user_id(), wait)
+    if job is None:
+        abort(404, "job not found")
+    return job_response(job)
+
+
+@app.route("/api/ask/batch", methods=["POST"])
+def ask_api_batch():
+    """answers a list of questions, streaming each result
+    as a line of json (ndjson) as soon as it's ready"""
+
+    try:
+        items, concurrency, timeout = batch.parse(request.get_json(silent=True))
+    except ValueError as e:
+        logging.error(str(e))
+        abort(400, str(e))
+
+    user_id = get_current_user_id()
+    if timeout is None:
+        timeout = deadlines.for_request(
+            "agent", request.endpoint, request.headers.get(deadlines.HEADER)).timeout
+    timeout = min(timeout, deadlines.MAX_TIMEOUT)
+    logging.info(f"batch of {len(items)} questions, concurrency {concurrency}")
+
+    def ask_item(item):
+        return answer_in_background(item["conversationId"], user_id,
+                                    item["question"], deadlines.Deadline(timeout))
+
+    def generate():
+        for result in batch.run(items, ask_item, concurrency):
+            yield json.dumps(result) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+@app.route("/api/search")
+def search_api():
+    """GET /api/search?q=&limit= returns the user's conversations that best
+    match the query, each with its best matching question"""
+    query = request.args.get("q", "").strip()
+    if not query:
+        abort(400, "missing query parameter: q")
+    try:
+        limit = min(int(request.args.get("limit", 10)), 100)
+    except ValueError:
+        abort(400, "limit must be a number")
+    matches, indexing = search_conversations(get_current_user_id(), query, limit)
+    for match in matches:
+        match["timestamp"] = datetime.fromtimestamp(
+            match["timestamp"], timezone.utc).isoformat()
+    return {"query": query, "results": matches, "indexing": indexing}
+
+
+@app.route("/api/search/rebuild", methods=["POST"])
+def search_rebuild_api():
+    """POST /api/search/rebuild rebuilds the user's search index
+    from their history in memory, in the background"""
+    user_id = get_current_user_id()
+    search_index.rebuild_in_background(user_id, lambda: db.history(user_id))
+    return {"indexing": True}, 202
 
 
 @app.route("/api/conversations/users/<user_id>")
 def conversations_get_by_user(user_id):
     """fetch top 10 conversations for a user"""
-    return db.list_by_user(user_id, 10)
+    chat_history = db.list_by_user(user_id, 10, g.deadline)
+    return responses.conditional(
+        responses.etag_for(user_id, chat_history), lambda: chat_history)
+
+
+if __name__ == '__main__':
+    port = 8080
+    print(f"listening on http://localhost:{port}")
+    app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,123 @@
+import threading
+from collections import deque
+
+# in-process metrics registry, exposed as json by GET /metrics
+
+_lock = threading.Lock()
+_metrics = {}
+
+
+class Counter():
+    """monotonically increasing count"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return {"value": self.value}
+
+
+class Gauge():
+    """point in time value, either set directly or read from a callback"""
+
+    def __init__(self, fn=None):
+        self._lock = threading.Lock()
+        self._fn = fn
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    @property
+    def value(self):
+        return self._fn() if self._fn else self._value
+
+    def snapshot(self):
+        return {"value": self.value}
+
+
+class Histogram():
+    """distribution of observed values.
+    percentiles are computed over a window of the most recent samples"""
+
+    def __init__(self, window=1024):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self._samples.append(value)
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """returns the p-th percentile (0-100) of the recent samples"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return 0.0
+        index = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "max": round(self.max, 6),
+            "p50": round(self.percentile(50), 6),
+            "p95": round(self.percentile(95), 6),
+            "p99": round(self.percentile(99), 6),
+        }
+
+
+def _get(cls, name, labels, **kwargs):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        metric = _metrics.get(key)
+        if metric is None:
+            metric = _metrics[key] = cls(**kwargs)
+        return metric
+
+
+def counter(name, **labels):
+    """returns the counter registered under name and labels"""
+    return _get(Counter, name, labels)
+
+
+def gauge(name, fn=None, **labels):
+    """returns the gauge registered under name and labels.
+    if fn is passed, the gauge reports its return value"""
+    return _get(Gauge, name, labels, fn=fn)
+
+
+def histogram(name, **labels):
+    """returns the histogram registered under name and labels"""
+    return _get(Histogram, name, labels)
+
+
+def snapshot():
+    """returns all metrics grouped by name"""
+    with _lock:
+        items = list(_metrics.items())
+    result = {}
+    for (name, labels), metric in sorted(items, key=lambda i: i[0]):
+        entry = dict(labels)
+        entry.update(metric.snapshot())
+        result.setdefault(name, []).append(entry)
+    return result
@@ -1,54 +1,73 @@
 import os
 import json
+import time
 import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait, FIRST_COMPLETED
 import log
-import boto3
+from botocore.exceptions import ReadTimeoutError
+from opentelemetry import trace
+import deadline as deadlines
+import database
+import limiter
+import metrics
+import runtimes
 
-runtime = boto3.client("bedrock-agentcore")
+# time kept in reserve for the agent's response to make it back to us
+AGENT_DEADLINE_MARGIN = float(os.getenv("AGENT_DEADLINE_MARGIN", 2))
 
-agent_runtime_arn = os.getenv("AGENT_RUNTIME")
-if agent_runtime_arn == "":
+# agent calls running at once for questions that may be hedged (the
+# request's thread waits for them, see invoke_hedged())
+AGENT_HEDGE_WORKERS = int(os.getenv("AGENT_HEDGE_WORKERS", 128))
+
+if os.getenv("AGENT_RUNTIME") == "" and not runtimes.AGENT_RUNTIMES:
     raise Exception("AGENT_RUNTIME is required")
 
+router = runtimes.Router(runtimes.AGENT_RUNTIMES)
+hedge_executor = ThreadPoolExecutor(max_workers=AGENT_HEDGE_WORKERS, thread_name_prefix="hedge")
 
-def orchestrate(conversation_history, new_question):
-    """Orchestrates RAG workflow based on conversation history
-    and a new question. Returns an answer and a list of
-    source documents."""
 
-    try:
-        logging.info("Checking environment variables...")
-        if not agent_runtime_arn:
-            raise Exception("AGENT_RUNTIME environment variable is not set or empty")
-        
-        aws_region = os.getenv("AWS_REGION")
-        if not aws_region:
-            raise Exception("AWS_REGION environment variable is not set")
-            
-        logging.info(f"Using agent runtime ARN: {agent_runtime_arn}")
-        logging.info(f"Using AWS region: {aws_region}")
+def record_usage(usage):
+    """adds an invocation's token usage and timings to the current
+    span and to the token metrics"""
+    span = trace.get_current_span()
+    for k, v in usage.items():
+        if isinstance(v, (int, float, str)):
+            span.set_attribute(f"agent.{k}", v)
+    # the model route picked by the agent (fast or strong)
+    route = usage.get("route", "none")
+    metrics.counter("agent_routes", route=route).inc()
+    for k in ["input_tokens", "output_tokens",
+              "cache_read_input_tokens", "cache_write_input_tokens"]:
+        metrics.counter("agent_tokens", type=k[:-len("_tokens")],
+                        model=usage.get("model"), route=route).inc(usage.get(k, 0))
+    metrics.histogram("agent_model_cycles", route=route).observe(usage.get("model_cycles", 0))
+    # how the agent's speculative retrieval turned out (see agent/speculation.py)
+    metrics.counter("agent_speculation", result=usage.get("speculation", "off")).inc()
+    metrics.histogram("agent_invoke_seconds", route=route).observe(usage["invoke_seconds"])
 
-        payload_data = {
-            "input": {
-                "user_id": conversation_history["userId"],
-                "prompt": new_question,
-            }
-        }
-        payload = json.dumps(payload_data)
-        logging.info(f"Payload created: {payload}")
-
-        request = {
-            "agentRuntimeArn": agent_runtime_arn,
-            "payload": payload,
-            "runtimeUserId": conversation_history["userId"],
-            "runtimeSessionId": conversation_history["conversationId"],
-            "contentType": "application/json",
-        }
-        log.info(request)
 
-        logging.info("Calling invoke_agent_runtime...")
-        # Call invoke_agent_runtime
-        response = runtime.invoke_agent_runtime(**request)
+def invoke(runtime, invoke_input, conversation_history, deadline):
+    """invokes the agent on a runtime, returning its parsed response.
+    the runtime's answer times and errors are recorded for routing"""
+
+    request = {
+        "agentRuntimeArn": runtime.arn,
+        "payload": json.dumps({"input": invoke_input}),
+        "runtimeUserId": conversation_history["userId"],
+        "runtimeSessionId": conversation_history["conversationId"],
+        "contentType": "application/json",
+    }
+    log.info(request)
+
+    logging.info(f"Calling invoke_agent_runtime on {runtime.name}...")
+    start = time.monotonic()
+    router.begin(runtime)
+    ok = False
+    try:
+        response = deadlines.call(
+            "bedrock-agentcore", "invoke_agent_runtime", deadline,
+            region=runtime.region, **request)
         logging.info("invoke_agent_runtime call completed")
 
         # Handle the response
@@ -59,18 +78,156 @@ def orchestrate(conversation_history, new_question):
 
         # The response body is a StreamingBody object
         logging.info("Reading response body...")
-        response_body = response["response"].read().decode("utf-8")
+        try:
+            response_body = response["response"].read().decode("utf-8")
+        except ReadTimeoutError as e:
+            raise deadlines.DeadlineExceeded(
+                "timed out reading agent response") from e
         logging.info(f"Response body length: {len(response_body)}")
-        
+
         response = json.loads(response_body)
         logging.info("Response parsed successfully")
-        log.info(response)
+        ok = True
+        return response
+    except limiter.Overloaded:
+        # shed before it was sent, which says nothing about the runtime
+        ok = None
+        raise
+    finally:
+        router.end(runtime, time.monotonic() - start, ok)
+
+
+def invoke_hedged(runtime, invoke_input, conversation_history, deadline):
+    """invokes the agent on a runtime, and on a second runtime as well if
+    the first hasn't answered after its hedge delay (the runtime's p95).
+    returns the runtime that answered first, its response, whether the
+    question was hedged and whether the agent recorded the turn in memory.
+    when a hedge can be sent, neither runtime records the turn, so that
+    the caller can record the answer that's used (see database.record_turn)"""
+
+    delay = router.hedge_delay(runtime)
+    if delay is None or delay >= deadline.remaining() or not router.can_hedge():
+        # no hedge can be sent, so the agent records the turn as usual
+        response = invoke(runtime, invoke_input, conversation_history, deadline)
+        return runtime, response, False, True
+
+    def submit(runtime):
+        # the agent's time budget is what's left when it's called
+        hedge_input = {
+            **invoke_input,
+            "timeout": max(0, deadline.remaining() - AGENT_DEADLINE_MARGIN),
+            "record": False,
+        }
+        # in the request's context, so the call shows up in its trace
+        return hedge_executor.submit(contextvars.copy_context().run, invoke,
+                                     runtime, hedge_input, conversation_history, deadline)
+
+    first = submit(runtime)
+    try:
+        return runtime, first.result(timeout=delay), False, False
+    except TimeoutError:
+        pass
+    if not router.take_hedge():
+        metrics.counter("agent_hedges", result="over_budget").inc()
+        return runtime, first.result(), False, False
+
+    second_runtime = router.pick(exclude=runtime)
+    logging.warning(
+        f"no answer from {runtime.name} after {delay:.1f}s, also asking {second_runtime.name}")
+    second = submit(second_runtime)
+    runtimes_by_future = {first: runtime, second: second_runtime}
+    pending = set(runtimes_by_future)
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    metrics.counter("agent_hedges",
+                                    result="won" if future is second else "lost").inc()
+                    return runtimes_by_future[future], future.result(), True, False
+        metrics.counter("agent_hedges", result="failed").inc()
+        return runtime, first.result(), True, False
+    finally:
+        # a loser that hasn't started (all hedge workers busy) isn't sent.
+        # one that has can't be stopped, it finishes in the background and
+        # only counts towards its runtime's answer times and errors
+        for future in pending:
+            future.cancel()
+
+
+def orchestrate(conversation_history, new_question, deadline=None, new_conversation=False):
+    """Orchestrates RAG workflow based on conversation history
+    and a new question. Returns an answer, a list of
+    source documents and the agent's token usage and timings.
+    Only the first question of a new conversation may be hedged.
+    Raises DeadlineExceeded if the agent does not respond
+    before the deadline."""
+
+    if deadline is None:
+        deadline = deadlines.Deadline(deadlines.DEFAULT_TIMEOUTS["agent"])
+
+    try:
+        logging.info("Checking environment variables...")
+        if not router.runtimes:
+            raise Exception("AGENT_RUNTIME environment variable is not set or empty")
         
-        output = response["output"]["message"]["content"][0]["text"]
+        aws_region = os.getenv("AWS_REGION")
+        if not aws_region:
+            raise Exception("AWS_REGION environment variable is not set")
+
+        conversation_id = conversation_history["conversationId"]
+        runtime = router.route(conversation_id)
+        logging.info(f"Using agent runtime ARN: {runtime.arn}")
+        logging.info(f"Using AWS region: {aws_region}")
+
+        invoke_input = {
+            "user_id": conversation_history["userId"],
+            "prompt": new_question,
+            # time budget for the agent, so it can stop its tool loop
+            "timeout": max(0, deadline.remaining() - AGENT_DEADLINE_MARGIN),
+        }
+        logging.info(f"Payload created: {json.dumps(invoke_input)}")
+
+        start = time.monotonic()
+        if new_conversation:
+            # only a conversation's first question is hedged, since later
+            # ones go to the runtime that may still have its agent session
+            # (and the caller can only record a turn that starts a session)
+            runtime, response, hedged, recorded = invoke_hedged(
+                runtime, invoke_input, conversation_history, deadline)
+        else:
+            response = invoke(runtime, invoke_input, conversation_history, deadline)
+            hedged, recorded = False, True
+        router.stick(conversation_id, runtime)
+
+        log.llm({"session_id": conversation_id, **invoke_input}, response["output"])
+        
+        content = response["output"]["message"]["content"]
+        output = "".join(c["text"] for c in content if "text" in c)
+        if response["output"].get("stop_reason") == "deadline":
+            logging.warning("agent ran out of time, returning partial answer")
         logging.info(f"Extracted output length: {len(output)}")
         sources = []
 
-        return output, sources
+        if not recorded:
+            # the agent didn't store the turn, so an answer that can't be
+            # stored fails the question rather than going missing from the
+            # conversation (it is retried first, with its own time limits)
+            try:
+                database.record_turn(
+                    conversation_id, conversation_history["userId"], new_question, output)
+            except Exception as e:
+                logging.error(f"failed to record the first turn of {conversation_id}: {e}")
+                raise Exception(f"the answer could not be saved, please ask again: {e}") from e
+
+        # includes the time spent getting to and from the agent
+        usage = response["output"].get("usage", {})
+        usage["invoke_seconds"] = round(time.monotonic() - start, 3)
+        usage["runtime"] = runtime.name
+        usage["hedged"] = hedged
+        record_usage(usage)
+
+        return output, sources, usage
         
     except Exception as e:
         logging.error(f"Error in orchestrate: {str(e)}")
@@ -0,0 +1,91 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import deadline as deadlines
+import metrics
+
+# conversations are speculatively loaded into the cache when they
+# are likely to be opened next (hovered or shown in the sidebar)
+
+# number of conversations at the top of the sidebar to prefetch
+PREFETCH_TOP = int(os.getenv("PREFETCH_TOP", 3))
+
+# maximum share of the default admission pool's concurrency
+# that prefetching may use
+PREFETCH_MAX_SHARE = float(os.getenv("PREFETCH_MAX_SHARE", 0.25))
+
+# time limit for a single prefetch (seconds)
+PREFETCH_TIMEOUT = float(os.getenv("PREFETCH_TIMEOUT", 5))
+
+
+class Prefetcher():
+    """Loads conversations in the background. Prefetches never run while
+    requests are queued in the pool, are limited to a share of its
+    concurrency, and are dropped (rather than queued) when over budget"""
+
+    def __init__(self, db, pool, max_share=PREFETCH_MAX_SHARE):
+        self.db = db
+        self.pool = pool
+        self.budget = max(1, int(pool.limit * max_share)) if max_share > 0 else 0
+        self.in_flight = {}  # (conversation id, user id) -> future
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, self.budget), thread_name_prefix="prefetch")
+        metrics.gauge("prefetch_in_flight", fn=lambda: len(self.in_flight))
+        logging.info(f"prefetch budget: {self.budget} concurrent requests")
+
+    def _count(self, result):
+        metrics.counter("prefetch_requests", result=result).inc()
+
+    def prefetch(self, conversation_id, user_id):
+        """starts loading a conversation into the cache, unless it is already
+        cached or loading, or prefetching is over budget. doesn't block"""
+
+        key = (conversation_id, user_id)
+        if self.budget == 0:
+            return
+        if self.pool.queued > 0:
+            self._count("skipped_busy")
+            return
+        if self.db.cached(conversation_id, user_id) is not None:
+            self._count("skipped_cached")
+            return
+        with self._lock:
+            if key in self.in_flight:
+                self._count("skipped_in_flight")
+                return
+            if len(self.in_flight) >= self.budget:
+                self._count("skipped_budget")
+                return
+            self._count("started")
+            self.in_flight[key] = self._executor.submit(self._load, key)
+
+    def join(self, conversation_id, user_id, timeout):
+        """waits for an in-flight prefetch of a conversation, so that
+        opening it doesn't load it a second time"""
+        with self._lock:
+            future = self.in_flight.get((conversation_id, user_id))
+        if future is not None:
+            self._count("joined")
+            try:
+                future.result(timeout)
+            except Exception:
+                pass
+
+    def _load(self, key):
+        conversation_id, user_id = key
+        try:
+            self.db.get(conversation_id, user_id,
+                        deadlines.Deadline(PREFETCH_TIMEOUT))
+        except Exception as e:
+            logging.warning(f"prefetch of conversation {conversation_id} failed: {e}")
+            self._count("failed")
+        finally:
+            with self._lock:
+                self.in_flight.pop(key, None)
+
+    def prefetch_top(self, chat_history, user_id):
+        """prefetches the most recent conversations in a user's history"""
+        for item in chat_history[:PREFETCH_TOP]:
+            self.prefetch(item["conversationId"], user_id)
@@ -0,0 +1,371 @@
+"""
+replays captured traffic (see capture.py) through a build of the web app and
+reports latency percentiles per route. bedrock-agentcore is replaced by a
+stand-in (emulator.py) that answers each call with the recorded response,
+after the recorded latency, so that builds can be compared on real traffic
+without an AWS account. save the results of one build and compare another
+against them:
+
+    git checkout main && python replay.py captures/ --save main.json
+    git checkout my-change && python replay.py captures/ --baseline main.json
+
+the app is started with gunicorn, unless --url is given, in which case it
+must send its bedrock-agentcore calls to the stand-in
+(AWS_ENDPOINT_URL_BEDROCK_AGENTCORE=http://localhost:<port>).
+"""
+import os
+import re
+import sys
+import json
+import glob
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from urllib.parse import urlencode
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+import capture
+import emulator
+
+parser = argparse.ArgumentParser(
+    description="Replay captured traffic and compare latencies between builds",
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    epilog=__doc__)
+parser.add_argument("capture", nargs="+",
+                    help="capture files, or directories of them (CAPTURE_DIR)")
+parser.add_argument("--url", default=None,
+                    help="replay against an app that's already running instead of starting one")
+parser.add_argument("--port", type=int, default=9100, help="port for the stand-in")
+parser.add_argument("--app_port", type=int, default=8181)
+parser.add_argument("--workers", type=int, default=None,
+                    help="gunicorn worker processes (default: sized by gunicorn.conf.py)")
+parser.add_argument("--threads", type=int, default=None,
+                    help="gunicorn threads per worker (default: sized by gunicorn.conf.py)")
+parser.add_argument("--speed", type=float, default=1.0,
+                    help="replay speed, e.g. 2 sends requests twice as fast as they were recorded")
+parser.add_argument("--limit", type=int, default=None, help="replay only the first N requests")
+parser.add_argument("--concurrency", type=int, default=256,
+                    help="most requests in flight (requests beyond it are sent late)")
+parser.add_argument("--save", default=None, help="write the results to a json file")
+parser.add_argument("--baseline", default=None,
+                    help="results of another build (--save) to compare against")
+
+# errors that the stand-in answers with a throttling status
+THROTTLE_ERROR_CODES = {"ThrottlingException", "ThrottledException",
+                        "TooManyRequestsException"}
+
+# path segments that are ids (conversation and job ids), grouped in the report
+ID = re.compile(r"/(?=[^/]*\d)[\w-]{8,}(?=/|$)")
+
+SESSION_HEADER = "X-Amzn-Bedrock-AgentCore-Runtime-Session-Id"
+
+
+def load(paths):
+    """returns the requests, downstream calls and agent answers in
+    capture files (or directories of them), oldest first"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, "capture-*.jsonl.gz")))
+        else:
+            files.append(path)
+    records = defaultdict(list)
+    for path in files:
+        for record in capture.read(path):
+            records[record["type"]].append(record)
+    for kind in records.values():
+        kind.sort(key=lambda r: r["t"])
+    return records["request"], records["call"], records["llm"]
+
+
+def _prompt(payload):
+    """the question in an agent invocation's payload (parsed when captured)"""
+    try:
+        if isinstance(payload, str):
+            payload = json.loads(payload)
+        return payload["input"]["prompt"]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def call_keys(operation, params):
+    """keys that a downstream call is matched on, most specific first.
+    memory ids aren't part of them, so the app can be replayed with any"""
+    if operation == "invoke_agent_runtime":
+        prompt = _prompt(params.get("payload"))
+        return [(operation, params.get("runtimeSessionId"), prompt), (operation, prompt)]
+    return [(operation, params.get("actorId"), params.get("sessionId"),
+             params.get("nextToken"))]
+
+
+class Recorded():
+    """recorded values by key, handed out in the order they were recorded.
+    the last one is kept, for builds that make a call more often"""
+
+    def __init__(self):
+        self._values = defaultdict(deque)
+        self._lock = threading.Lock()
+
+    def add(self, keys, value):
+        for key in keys:
+            self._values[key].append(value)
+
+    def take(self, keys):
+        with self._lock:
+            for key in keys:
+                values = self._values.get(key)
+                if values:
+                    return values.popleft() if len(values) > 1 else values[0]
+        return None
+
+
+class StandIn(emulator.Emulator):
+    """Emulator that answers bedrock-agentcore calls with the recorded
+    responses, after the recorded latency. calls that weren't recorded
+    (e.g. new calls made by the build being replayed) are answered by the
+    emulator, with latencies drawn from the recorded calls of the same
+    operation"""
+
+    def __init__(self, calls, answers):
+        super().__init__(argparse.Namespace(
+            latency=None, runtime_latency=None, error_rate=None, max_concurrency=None,
+            answer_size=1000, agent_url=None, memory_id="memory-replay"))
+        self.calls = Recorded()
+        self.answers = Recorded()
+        self.matched = Counter()
+        self.unmatched = Counter()
+        latencies = defaultdict(list)
+        for call in calls:
+            operation = call["operation"]
+            if call["service"] != "bedrock-agentcore" or operation not in emulator.OPERATIONS:
+                continue
+            latencies[operation].append(call["seconds"])
+            self.calls.add(call_keys(operation, call["params"]), call)
+        for operation, values in latencies.items():
+            self.latency[operation] = lambda values=values: random.choice(values)
+        for answer in answers:
+            prompt = answer["input"].get("prompt")
+            self.answers.add([(answer["input"].get("session_id"), prompt), prompt],
+                             answer["output"])
+
+    def handle(self, operation, params, query, headers, body):
+        if operation == "invoke_agent_runtime":
+            fields = {"runtimeSessionId": headers.get(SESSION_HEADER),
+                      "payload": body.decode()}
+        else:
+            fields = {**params, **json.loads(body or b"{}")}
+        recorded = self.calls.take(call_keys(operation, fields))
+        if recorded is None:
+            self.unmatched[operation] += 1
+            return super().handle(operation, params, query, headers, body)
+
+        self.matched[operation] += 1
+        with self._lock:
+            self.requests[operation] += 1
+        time.sleep(recorded["seconds"])
+        error = recorded.get("error")
+        if error in THROTTLE_ERROR_CODES:
+            raise emulator.ServiceError(429, error, "Rate exceeded (recorded)")
+        if error is not None and error != "ReadTimeout":
+            raise emulator.ServiceError(500, error, "recorded error")
+
+        if operation == "invoke_agent_runtime":
+            session_id, prompt = fields["runtimeSessionId"], _prompt(fields["payload"])
+            output = self.answers.take([(session_id, prompt), prompt])
+            if output is None:
+                return self.invoke_agent_runtime(params, query, headers, body)
+            return 200, json.dumps({"output": output}).encode(), {SESSION_HEADER: session_id}
+        if "response" not in recorded:
+            return getattr(self, operation)(params, query, headers, body)
+        return 200, json.dumps(recorded["response"]).encode(), {}
+
+
+def route(record):
+    return f"{record['method']} {ID.sub('/<id>', record['path'])}"
+
+
+def send(url, record, locations):
+    """sends a recorded request, returning its latency, status and location"""
+    path = record["path"]
+    for old, new in list(locations.items()):
+        if path.startswith(old):
+            path = new + path[len(old):]
+    if record.get("args"):
+        path += "?" + urlencode(record["args"])
+    headers = dict(record.get("headers") or {})
+    data = None
+    if record.get("json") is not None:
+        data = json.dumps(record["json"]).encode()
+        headers["Content-Type"] = "application/json"
+    elif record.get("form"):
+        data = urlencode(record["form"]).encode()
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+    request = urllib.request.Request(
+        url + path, data=data, method=record["method"], headers=headers)
+
+    start = time.monotonic()
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            status, location = response.status, response.headers.get("Location")
+    except urllib.error.HTTPError as e:
+        e.read()
+        status, location = e.code, None
+    except Exception:
+        status, location = 0, None
+    return time.monotonic() - start, status, location
+
+
+def replay(url, requests, speed, concurrency):
+    """sends the requests at the pace they were recorded (open loop).
+    returns the latencies and statuses by route"""
+    results = defaultdict(list)
+    locations = {}  # recorded job locations -> the replayed ones
+    lock = threading.Lock()
+
+    def run(record):
+        latency, status, location = send(url, record, locations)
+        if location and record.get("location"):
+            locations[record["location"]] = location
+        with lock:
+            results[route(record)].append((latency, status))
+
+    first = requests[0]["t"]
+    start = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for record in requests:
+            delay = start + (record["t"] - first) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(run, record)
+    return results
+
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def summarize(results):
+    """latency percentiles (milliseconds) and errors by route"""
+    summary = {}
+    everything = [r for rs in results.values() for r in rs]
+    for name, rs in sorted(results.items()) + [("all", everything)]:
+        latencies = [latency * 1000 for latency, _ in rs]
+        summary[name] = {
+            "count": len(rs),
+            "errors": sum(1 for _, status in rs if status == 0 or status >= 500),
+            **{f"p{p}": round(pct(latencies, p), 1) for p in [50, 90, 99]},
+        }
+    return summary
+
+
+def start_app(args, stand_in_url):
+    """starts the web app from the working tree, pointed at the stand-in,
+    with the settings in its gunicorn.conf.py"""
+    env = {**os.environ,
+           "AWS_ENDPOINT_URL_BEDROCK_AGENTCORE": stand_in_url,
+           "MEMORY_ID": os.getenv("MEMORY_ID", "memory-replay"),
+           "AGENT_RUNTIME": os.getenv(
+               "AGENT_RUNTIME", "arn:aws:bedrock-agentcore:us-east-1:123456789012:runtime/replay"),
+           # start with an empty search index
+           "SEARCH_INDEX_DIR": tempfile.mkdtemp(prefix="replay-search-")}
+    # don't capture the replay
+    env.pop("CAPTURE_DIR", None)
+    for name, default in [("AWS_ACCESS_KEY_ID", "replay"), ("AWS_SECRET_ACCESS_KEY", "replay"),
+                          ("AWS_REGION", "us-east-1"), ("AWS_DEFAULT_REGION", "us-east-1")]:
+        env.setdefault(name, default)
+    command = [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{args.app_port}",
+               "--log-level", "warning", "main:app"]
+    if args.workers:
+        command += ["--workers", str(args.workers)]
+    if args.threads:
+        command += ["--threads", str(args.threads)]
+    app = subprocess.Popen(
+        command,
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{args.app_port}"
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"{url}/health").read()
+            return app, url
+        except Exception:
+            if app.poll() is not None:
+                raise Exception("app exited on startup")
+            time.sleep(0.2)
+    app.terminate()
+    raise Exception("app did not start")
+
+
+def report(summary, recorded, baseline):
+    print(f"{'route':<40} {'count':>6} {'errors':>6} {'p50':>9} {'p90':>9} {'p99':>9}"
+          f" {'rec p50':>9} {'rec p99':>9}" + (f" {'p50 vs base':>12} {'p99 vs base':>12}" if baseline else ""))
+    for name, s in summary.items():
+        r = recorded.get(name, {})
+        line = (f"{name[:40]:<40} {s['count']:>6} {s['errors']:>6} {s['p50']:>9.1f} "
+                f"{s['p90']:>9.1f} {s['p99']:>9.1f} {r.get('p50', 0):>9.1f} {r.get('p99', 0):>9.1f}")
+        b = baseline.get(name) if baseline else None
+        if b:
+            for p in ["p50", "p99"]:
+                change = (s[p] - b[p]) / b[p] * 100 if b[p] else 0
+                line += f" {change:>+11.1f}%"
+        print(line)
+
+
+def main():
+    args = parser.parse_args()
+    requests, calls, answers = load(args.capture)
+    if args.limit:
+        requests = requests[:args.limit]
+    if not requests:
+        parser.error("no requests in the capture")
+    duration = requests[-1]["t"] - requests[0]["t"]
+    print(f"{len(requests)} requests over {duration:.0f}s, {len(calls)} downstream calls, "
+          f"{len(answers)} agent answers (replaying at {args.speed}x)")
+
+    stand_in = StandIn(calls, answers)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), emulator.make_handler(stand_in))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    app, url = None, args.url
+    if url is None:
+        app, url = start_app(args, f"http://127.0.0.1:{args.port}")
+    try:
+        results = replay(url.rstrip("/"), requests, args.speed, args.concurrency)
+    finally:
+        if app is not None:
+            app.terminate()
+            app.wait()
+        server.shutdown()
+
+    summary = summarize(results)
+    # latencies seen when the traffic was captured
+    captured = defaultdict(list)
+    for record in requests:
+        captured[route(record)].append((record["seconds"], record["status"]))
+    recorded = summarize(captured)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["routes"]
+    report(summary, recorded, baseline)
+    print(f"stand-in: {sum(stand_in.matched.values())} calls answered from the capture, "
+          f"{sum(stand_in.unmatched.values())} not recorded {dict(stand_in.unmatched)}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"routes": summary, "matched": stand_in.matched,
+                       "unmatched": stand_in.unmatched}, f, indent=2)
+        print(f"results written to {args.save}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import os
+import gzip
+import hashlib
+import brotli
+from flask import current_app, request, make_response, url_for
+from werkzeug.utils import safe_join
+
+# responses smaller than this aren't worth compressing
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript")
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# compressed static assets by (path, encoding, modification time), so each
+# is compressed once per process, at the highest level since it's kept.
+# None for files too small to compress
+_compressed_static = {}
+
+
+def _hash_files(directory):
+    h = hashlib.sha1()
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+
+# changes whenever the templates change, so that cached pages
+# are invalidated on deployments
+TEMPLATE_VERSION = _hash_files(os.path.join(APP_DIR, "templates"))
+
+_fingerprints = {}
+
+
+def static_url(filename):
+    """returns a fingerprinted url for a static asset
+    that can be cached forever by browsers"""
+    fingerprint = _fingerprints.get(filename)
+    if fingerprint is None:
+        with open(os.path.join(APP_DIR, "static", filename), "rb") as f:
+            fingerprint = hashlib.sha1(f.read()).hexdigest()[:12]
+        _fingerprints[filename] = fingerprint
+    return url_for("static", filename=filename, v=fingerprint)
+
+
+def etag_for(*parts):
+    """returns an etag derived from the data a response is rendered from"""
+    h = hashlib.sha1(TEMPLATE_VERSION.encode())
+    for part in parts:
+        h.update(b"\0" + str(part).encode())
+    return h.hexdigest()
+
+
+def conditional(etag, render):
+    """responds with a 304 if the client already has the current version,
+    otherwise calls render() to build the response"""
+    if request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(render())
+    # weak since the body is compressed differently per client
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def cache_static(response):
+    """fingerprinted static assets never change"""
+    if request.endpoint == "static" and "v" in request.args and response.status_code == 200:
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+def _compress(body, encoding, best=False):
+    if encoding == "br":
+        return brotli.compress(body, quality=11 if best else 5)
+    return gzip.compress(body, compresslevel=9 if best else 6)
+
+
+def _compress_static(response, encoding):
+    """serves a static asset's cached compressed body"""
+    path = safe_join(current_app.static_folder, request.view_args["filename"])
+    key = (path, encoding, os.path.getmtime(path))
+    if key not in _compressed_static:
+        with open(path, "rb") as f:
+            body = f.read()
+        _compressed_static[key] = (_compress(body, encoding, best=True)
+                                   if len(body) >= COMPRESS_MIN_SIZE else None)
+    body = _compressed_static[key]
+    if body is None:
+        return response
+    # instead of the file it would have streamed
+    if hasattr(response.response, "close"):
+        response.response.close()
+    response.direct_passthrough = False
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def compress(response):
+    """compresses the response body with brotli or gzip,
+    based on what the client accepts"""
+
+    if (response.status_code != 200
+            or "Content-Encoding" in response.headers
+            or not (response.mimetype or "").startswith(COMPRESSIBLE_TYPES)):
+        return response
+
+    accept = request.accept_encodings
+    if accept["br"]:
+        encoding = "br"
+    elif accept["gzip"]:
+        encoding = "gzip"
+    else:
+        return response
+
+    if request.endpoint == "static":
+        return _compress_static(response, encoding)
+
+    if response.direct_passthrough or response.is_streamed:
+        return response
+
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+
+    response.set_data(_compress(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
@@ -0,0 +1,188 @@
+import os
+import math
+import time
+import random
+import threading
+import metrics
+import cache
+
+# routing of questions across agent runtimes (AGENT_RUNTIMES), e.g. the same
+# agent deployed in two regions. a new conversation goes to the runtime
+# expected to answer soonest: the moving average (ewma) of its answer times,
+# times the questions it's already answering (plus one), divided by the
+# share of its calls that succeed. later questions in the conversation go
+# to the same runtime (it may still have the agent session), which is kept
+# in the cache. a first question that takes longer than most (the runtime's
+# p95) is sent to a second runtime as well, and the first answer is used.
+# the runtimes must share the agent's memory (MEMORY_ID), so a conversation
+# can move between them
+
+# comma separated runtime arns (AGENT_RUNTIME is the single runtime setting)
+AGENT_RUNTIMES = [arn.strip() for arn in
+                  os.getenv("AGENT_RUNTIMES", os.getenv("AGENT_RUNTIME") or "").split(",")
+                  if arn.strip()]
+
+# how long a conversation sticks to its runtime after its last question (seconds)
+AGENT_STICKY_TTL = int(os.getenv("AGENT_STICKY_TTL", 3600))
+
+# send slow first questions to a second runtime
+AGENT_HEDGE = os.getenv("AGENT_HEDGE", "true").lower() == "true"
+
+# percentile of the runtime's answer times after which a question is hedged
+AGENT_HEDGE_PERCENTILE = float(os.getenv("AGENT_HEDGE_PERCENTILE", 95))
+
+# shortest wait before hedging (seconds)
+AGENT_HEDGE_MIN_DELAY = float(os.getenv("AGENT_HEDGE_MIN_DELAY", 1))
+
+# answers a runtime must have given before its questions are hedged
+AGENT_HEDGE_MIN_SAMPLES = int(os.getenv("AGENT_HEDGE_MIN_SAMPLES", 20))
+
+# most hedges per first question, so that a slow runtime can't double the
+# load on the others. unused budget is kept for bursts of up to HEDGE_BURST
+AGENT_HEDGE_BUDGET = float(os.getenv("AGENT_HEDGE_BUDGET", 0.1))
+HEDGE_BURST = 10
+
+# weight of the latest call in the latency and error averages
+EWMA_WEIGHT = 0.2
+
+# errors count for half as much after this long (seconds), so that a runtime
+# that failed is tried again even though few conversations are sent to it
+ERROR_HALF_LIFE = 30.0
+
+
+def _name(arn):
+    """a short name for a runtime arn: region/runtime id"""
+    parts = arn.split(":")
+    region = parts[3] if len(parts) > 5 else ""
+    return f"{region}/{arn.rsplit('/', 1)[-1]}"
+
+
+class Runtime():
+    """An agent runtime, and the answer times and errors seen calling it"""
+
+    def __init__(self, arn):
+        self.arn = arn
+        self.name = _name(arn)
+        parts = arn.split(":")
+        self.region = parts[3] if len(parts) > 5 and parts[3] else None
+        self.latency = None     # ewma of successful calls (seconds)
+        self.error_rate = 0.0   # ewma of failed calls
+        self.in_flight = 0
+        self._errors_at = time.monotonic()
+        self.seconds = metrics.histogram("agent_runtime_seconds", runtime=self.name)
+        metrics.gauge("agent_runtime_latency", runtime=self.name,
+                      fn=lambda: round(self.latency or 0, 3))
+        metrics.gauge("agent_runtime_error_rate", runtime=self.name,
+                      fn=lambda: round(self.errors(), 3))
+        metrics.gauge("agent_runtime_in_flight", runtime=self.name,
+                      fn=lambda: self.in_flight)
+
+    def errors(self):
+        """the error rate, decayed for the time since the last call"""
+        elapsed = time.monotonic() - self._errors_at
+        return self.error_rate * 0.5 ** (elapsed / ERROR_HALF_LIFE)
+
+    def score(self, default_latency):
+        """how soon a new conversation sent here can expect an answer
+        (lower is better). runtimes that haven't answered yet are
+        expected to be as fast as the fastest one"""
+        latency = self.latency if self.latency is not None else default_latency
+        return latency * (self.in_flight + 1) / max(0.01, 1 - self.errors())
+
+    def record(self, seconds, ok):
+        """updates the averages with a call that took seconds"""
+        self.error_rate = self.errors() + EWMA_WEIGHT * ((0 if ok else 1) - self.errors())
+        self._errors_at = time.monotonic()
+        metrics.counter("agent_runtime_calls", runtime=self.name,
+                        result="ok" if ok else "error").inc()
+        if ok:
+            self.seconds.observe(seconds)
+            self.latency = (seconds if self.latency is None
+                            else self.latency + EWMA_WEIGHT * (seconds - self.latency))
+
+    def hedge_delay(self):
+        """how long to wait for a first question's answer before hedging,
+        or None until enough answers have been seen"""
+        if self.seconds.count < AGENT_HEDGE_MIN_SAMPLES:
+            return None
+        return max(AGENT_HEDGE_MIN_DELAY, self.seconds.percentile(AGENT_HEDGE_PERCENTILE))
+
+
+class Router():
+    """Picks the runtime for each question, keeps conversations on their
+    runtime and decides when a question may be hedged"""
+
+    def __init__(self, arns):
+        self.runtimes = [Runtime(arn) for arn in arns]
+        self._by_arn = {r.arn: r for r in self.runtimes}
+        self._hedge_tokens = float(HEDGE_BURST)
+        self._lock = threading.Lock()
+        for runtime in self.runtimes:
+            metrics.gauge("agent_hedge_delay", runtime=runtime.name,
+                          fn=lambda r=runtime: round(r.hedge_delay() or 0, 3))
+
+    def pick(self, exclude=None):
+        """the runtime expected to answer a new conversation soonest"""
+        candidates = [r for r in self.runtimes if r is not exclude]
+        if not candidates:
+            return None
+        with self._lock:
+            known = [r.latency for r in self.runtimes if r.latency is not None]
+            default_latency = min(known) if known else 1.0
+            best = min(r.score(default_latency) for r in candidates)
+            # ties (e.g. before any answers) are broken at random
+            return random.choice([r for r in candidates
+                                  if math.isclose(r.score(default_latency), best)])
+
+    @staticmethod
+    def _key(conversation_id):
+        return f"runtime:{conversation_id}"
+
+    def route(self, conversation_id):
+        """returns the conversation's runtime, or picks one if it has none
+        (the conversation's first question, or its runtime was forgotten
+        or is no longer configured)"""
+        runtime = self._by_arn.get(cache.get(self._key(conversation_id)))
+        if runtime is not None:
+            metrics.counter("agent_runtime_routes", runtime=runtime.name, reason="sticky").inc()
+            return runtime
+        runtime = self.pick()
+        metrics.counter("agent_runtime_routes", runtime=runtime.name, reason="new").inc()
+        return runtime
+
+    def stick(self, conversation_id, runtime):
+        """keeps the conversation's later questions on runtime"""
+        cache.set(self._key(conversation_id), runtime.arn, AGENT_STICKY_TTL)
+
+    def hedge_delay(self, runtime):
+        """how long to wait for runtime before hedging a first question,
+        or None if it shouldn't be hedged"""
+        if not AGENT_HEDGE or len(self.runtimes) < 2:
+            return None
+        with self._lock:
+            self._hedge_tokens = min(HEDGE_BURST, self._hedge_tokens + AGENT_HEDGE_BUDGET)
+        return runtime.hedge_delay()
+
+    def can_hedge(self):
+        """whether there's hedge budget left, without spending it"""
+        with self._lock:
+            return self._hedge_tokens >= 1
+
+    def take_hedge(self):
+        """spends hedge budget, returning false if there's none left"""
+        with self._lock:
+            if self._hedge_tokens < 1:
+                return False
+            self._hedge_tokens -= 1
+            return True
+
+    def begin(self, runtime):
+        with self._lock:
+            runtime.in_flight += 1
+
+    def end(self, runtime, seconds, ok):
+        """ok is None for calls that were never sent"""
+        with self._lock:
+            runtime.in_flight -= 1
+            if ok is not None:
+                runtime.record(seconds, ok)
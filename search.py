@@ -0,0 +1,457 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import zlib
+import struct
+import operator
+import itertools
+import fcntl
+import heapq
+import hashlib
+import logging
+import tempfile
+import threading
+from array import array
+from functools import lru_cache
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, OrderedDict, defaultdict
+import metrics
+
+# full text search over a user's conversation history. each question and
+# answer is a document in the user's partition of an inverted index, ranked
+# with BM25. partitions are kept on disk (so every worker process shares
+# them) as a compressed snapshot plus a log of questions added since, which
+# is folded into the snapshot once it grows. processes keep the partitions
+# they've searched in memory and only read what was appended since
+
+# directory the index is stored in. point it at a shared volume (e.g. efs)
+# so that all tasks see the same index
+SEARCH_INDEX_DIR = os.getenv(
+    "SEARCH_INDEX_DIR", os.path.join(tempfile.gettempdir(), "search-index"))
+
+# size of a partition's log (bytes) at which it is compacted into the snapshot
+SEARCH_COMPACT_BYTES = int(os.getenv("SEARCH_COMPACT_BYTES", 256 * 1024))
+
+# partitions kept in memory (per process)
+SEARCH_MAX_USERS = int(os.getenv("SEARCH_MAX_USERS", 1000))
+
+# characters of each answer stored for result snippets
+SEARCH_SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", 400))
+
+# BM25 parameters: term frequency saturation and length normalization
+K1 = 1.2
+B = 0.75
+
+FORMAT_VERSION = 1
+
+# highest term frequency stored
+MAX_TF = 0xFFFF
+
+TOKEN = re.compile(r"[^\W_]+")
+
+STOP_WORDS = set("""
+a an and are as at be but by can do does for from had has have how i if in
+is it its me my no not of on or our so than that the their them then there
+these they this to was we were what when where which who why will with you
+your
+""".split())
+
+
+@lru_cache(maxsize=100000)
+def _stem(token):
+    """strips plural endings, so "refunds" matches "refund" """
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 3 and token.endswith("s") and not token.endswith(("ss", "us", "is")):
+        return token[:-1]
+    return token
+
+
+def tokenize(text):
+    """splits text into lowercase terms, without stop words"""
+    return [_stem(t) for t in TOKEN.findall(text.lower()) if t not in STOP_WORDS]
+
+
+def term_counts(text):
+    """counts the terms in text (stemming each distinct word once)"""
+    counts = {}
+    for word, n in Counter(TOKEN.findall(text.lower())).items():
+        if word not in STOP_WORDS:
+            term = _stem(word)
+            counts[term] = counts.get(term, 0) + n
+    return counts
+
+
+def highlight(text, query):
+    """splits text into (text, matched) pairs, where matched
+    pieces are words that match one of the query's terms"""
+    terms = set(tokenize(query))
+    pieces = []
+    last = 0
+    for match in TOKEN.finditer(text):
+        word = match.group().lower()
+        if word not in STOP_WORDS and _stem(word) in terms:
+            pieces.append((text[last:match.start()], False))
+            pieces.append((match.group(), True))
+            last = match.end()
+    pieces.append((text[last:], False))
+    return [p for p in pieces if p[0]]
+
+
+def _doc_key(conversation_id, question, snippet):
+    return (conversation_id, question, hashlib.sha1(snippet.encode()).hexdigest())
+
+
+def _postings():
+    return (array("I"), array("H"))  # documents, term frequencies
+
+
+class Partition():
+    """One user's index. Documents are (conversation id, timestamp, length,
+    question, answer snippet) lists, postings map each term to arrays of
+    documents (in order) and term frequencies"""
+
+    def __init__(self):
+        self.docs = []
+        self.lengths = array("I")
+        self.postings = defaultdict(_postings)
+        self.total_length = 0
+        self.seen = set()  # keys of indexed questions, to skip duplicates
+        self.complete = False  # whether the user's whole history was indexed
+        # the snapshot file and log position the partition was read from
+        self.signature = None
+        self.offset = 0
+        self.lock = threading.Lock()
+
+    def add(self, conversation_id, timestamp, question, answer):
+        """indexes a question and its whole answer, unless it's already indexed"""
+        snippet = answer[:SEARCH_SNIPPET_CHARS]
+        key = _doc_key(conversation_id, question, snippet)
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        terms = term_counts(f"{question}\n{answer}")
+        length = sum(terms.values())
+        doc = len(self.docs)
+        self.docs.append([conversation_id, timestamp, length, question, snippet])
+        self.lengths.append(length)
+        self.total_length += length
+        postings = self.postings
+        for term, tf in terms.items():
+            docs, tfs = postings[term]
+            docs.append(doc)
+            tfs.append(tf if tf < MAX_TF else MAX_TF)
+        return True
+
+    def search(self, query, limit):
+        """returns the best matching question and answer of the top `limit`
+        conversations, as (score, doc) pairs, best first"""
+        n = len(self.docs)
+        if n == 0:
+            return []
+        average = self.total_length / n
+        scores = defaultdict(float)
+        lengths = self.lengths
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            docs, tfs = postings
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc, tf in zip(docs, tfs):
+                norm = K1 * (1 - B + B * lengths[doc] / average)
+                scores[doc] += idf * tf * (K1 + 1) / (tf + norm)
+
+        # one result per conversation, newer questions win ties
+        best = {}
+        for doc, score in scores.items():
+            conversation_id = self.docs[doc][0]
+            if conversation_id not in best or (score, doc) > best[conversation_id]:
+                best[conversation_id] = (score, doc)
+        return heapq.nlargest(limit, best.values())
+
+    def dump(self):
+        """serializes the partition: a json header with the documents and
+        terms, followed by each term's postings as little endian arrays
+        (documents delta encoded), all compressed"""
+        terms = []
+        deltas = array("I")
+        tfs = array("H")
+        for term, (term_docs, term_tfs) in self.postings.items():
+            terms.append([term, len(term_docs)])
+            deltas.extend(map(operator.sub, term_docs, itertools.chain((0,), term_docs)))
+            tfs.extend(term_tfs)
+        if sys.byteorder == "big":
+            deltas.byteswap()
+            tfs.byteswap()
+        header = json.dumps({"version": FORMAT_VERSION, "complete": self.complete,
+                             "docs": self.docs, "terms": terms},
+                            separators=(",", ":")).encode()
+        # fast compression: snapshots are rewritten on every compaction
+        return zlib.compress(
+            struct.pack("<I", len(header)) + header + deltas.tobytes() + tfs.tobytes(), 1)
+
+    @classmethod
+    def load(cls, blob):
+        data = zlib.decompress(blob)
+        (size,) = struct.unpack_from("<I", data)
+        header = json.loads(data[4:4 + size])
+        if header.get("version") != FORMAT_VERSION:
+            raise ValueError(f"unsupported search index version {header.get('version')}")
+        count = sum(n for _, n in header["terms"])
+        deltas = array("I")
+        tfs = array("H")
+        start = 4 + size
+        deltas.frombytes(data[start:start + count * deltas.itemsize])
+        tfs.frombytes(data[start + count * deltas.itemsize:])
+        if sys.byteorder == "big":
+            deltas.byteswap()
+            tfs.byteswap()
+
+        partition = cls()
+        partition.complete = header["complete"]
+        partition.docs = header["docs"]
+        partition.lengths = array("I", (d[2] for d in partition.docs))
+        partition.total_length = sum(partition.lengths)
+        i = 0
+        for term, n in header["terms"]:
+            partition.postings[term] = (
+                array("I", itertools.accumulate(deltas[i:i + n])), tfs[i:i + n])
+            i += n
+        partition.seen = {_doc_key(d[0], d[3], d[4]) for d in partition.docs}
+        return partition
+
+
+class SearchIndex():
+    """Per user search index partitions, stored in `directory` and
+    cached in memory"""
+
+    def __init__(self, directory=SEARCH_INDEX_DIR, compact_bytes=SEARCH_COMPACT_BYTES,
+                 max_users=SEARCH_MAX_USERS):
+        self.directory = directory
+        self.compact_bytes = compact_bytes
+        self.max_users = max_users
+        os.makedirs(directory, exist_ok=True)
+        self._partitions = OrderedDict()  # user id -> partition (lru)
+        self._lock = threading.Lock()
+        self._tasks = set()  # (task, user id) pending in the background
+        self._background = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search-index")
+        self._search_time = metrics.histogram("search_seconds")
+        metrics.gauge("search_partitions", fn=lambda: len(self._partitions))
+
+    def _path(self, user_id, suffix):
+        name = hashlib.sha1(user_id.encode()).hexdigest()[:24]
+        return os.path.join(self.directory, f"{name}.{suffix}")
+
+    @contextmanager
+    def _file_lock(self, user_id, exclusive):
+        """locks a user's partition across processes"""
+        with open(self._path(user_id, "lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _signature(self, user_id):
+        """identifies the current snapshot file, or None if there isn't one"""
+        try:
+            stat = os.stat(self._path(user_id, "idx"))
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _log_size(self, user_id):
+        try:
+            return os.path.getsize(self._path(user_id, "log"))
+        except FileNotFoundError:
+            return 0
+
+    def _read_log(self, user_id, partition, offset):
+        """applies complete log entries after offset, returns the new offset"""
+        try:
+            with open(self._path(user_id, "log"), "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return offset
+        # a writer may be in the middle of appending the last line
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            entry = json.loads(line)
+            partition.add(entry["c"], entry["t"], entry["q"], entry["a"])
+        return offset + end
+
+    def _load_snapshot(self, user_id):
+        """reads a user's snapshot, or returns an empty partition"""
+        try:
+            with open(self._path(user_id, "idx"), "rb") as f:
+                return Partition.load(f.read())
+        except FileNotFoundError:
+            return Partition()
+
+    def _read(self, user_id):
+        """reads a partition from disk"""
+        with self._file_lock(user_id, exclusive=False):
+            partition = self._load_snapshot(user_id)
+            partition.signature = self._signature(user_id)
+            partition.offset = self._read_log(user_id, partition, 0)
+        return partition
+
+    def partition(self, user_id):
+        """returns a user's partition, up to date with the files on disk"""
+        with self._lock:
+            partition = self._partitions.get(user_id)
+            if partition is not None:
+                self._partitions.move_to_end(user_id)
+
+        if partition is not None:
+            with partition.lock:
+                if (partition.signature == self._signature(user_id)
+                        and partition.offset == self._log_size(user_id)):
+                    return partition
+                with self._file_lock(user_id, exclusive=False):
+                    if (partition.signature == self._signature(user_id)
+                            and partition.offset <= self._log_size(user_id)):
+                        # only questions were added since, read them from the log
+                        partition.offset = self._read_log(user_id, partition, partition.offset)
+                        return partition
+
+        # not loaded yet, or compacted/rebuilt since
+        partition = self._read(user_id)
+        with self._lock:
+            self._partitions[user_id] = partition
+            self._partitions.move_to_end(user_id)
+            while len(self._partitions) > self.max_users:
+                self._partitions.popitem(last=False)
+        return partition
+
+    def built(self, user_id):
+        """whether a user's index was built from their history (rather
+        than only having the questions asked since search was added)"""
+        return self.partition(user_id).complete
+
+    def add(self, user_id, conversation_id, question, answer, timestamp=None):
+        """indexes a new question and answer (when it's asked). appended to the
+        partition's log, which is compacted once it reaches SEARCH_COMPACT_BYTES"""
+        entry = {"c": conversation_id, "t": int(timestamp or time.time()),
+                 "q": question, "a": answer}
+        line = (json.dumps(entry, separators=(",", ":")) + "\n").encode()
+        with self._file_lock(user_id, exclusive=True):
+            with open(self._path(user_id, "log"), "ab") as f:
+                f.write(line)
+                size = f.tell()
+        if size >= self.compact_bytes:
+            self._in_background("compact", user_id, lambda: self._compact(user_id))
+        metrics.counter("search_index_updates", kind="add").inc()
+
+    def _write(self, user_id, partition):
+        """replaces a user's snapshot and empties the log. called with the
+        exclusive lock held"""
+        path = self._path(user_id, "idx")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(partition.dump())
+        os.replace(tmp, path)
+        with open(self._path(user_id, "log"), "wb"):
+            pass
+
+    def _compact(self, user_id):
+        """folds the log into the snapshot. the partition is only locked
+        (blocking new questions) while the snapshot is written"""
+        with self._file_lock(user_id, exclusive=False):
+            signature = self._signature(user_id)
+            partition = self._load_snapshot(user_id)
+            offset = self._read_log(user_id, partition, 0)
+        with self._file_lock(user_id, exclusive=True):
+            if self._signature(user_id) != signature or self._log_size(user_id) < offset:
+                # compacted or rebuilt by another process meanwhile
+                return
+            self._read_log(user_id, partition, offset)
+            self._write(user_id, partition)
+        metrics.counter("search_index_updates", kind="compact").inc()
+        logging.info(f"compacted search index for {user_id} ({len(partition.docs)} questions)")
+
+    def rebuild(self, user_id, history):
+        """rebuilds a user's partition from their whole history, an iterable
+        of (conversation id, turns) as returned by Database.history.
+        returns the number of questions indexed"""
+        start = time.monotonic()
+        started = int(time.time())
+        with self._file_lock(user_id, exclusive=False):
+            signature = self._signature(user_id)
+            offset = self._log_size(user_id)
+        partition = Partition()
+        partition.complete = True
+        for conversation_id, turns in history:
+            for turn in turns:
+                timestamp = turn.get("timestamp")
+                partition.add(conversation_id,
+                              int(timestamp.timestamp()) if timestamp else 0,
+                              turn["q"], turn["a"])
+        with self._file_lock(user_id, exclusive=True):
+            # keep questions asked while the history was being read
+            # (ones that were also read are skipped as duplicates)
+            if self._signature(user_id) != signature:
+                # the log was compacted meanwhile
+                for d in self._load_snapshot(user_id).docs:
+                    if d[1] >= started:
+                        partition.add(d[0], d[1], d[3], d[4])
+                offset = 0
+            self._read_log(user_id, partition, offset)
+            self._write(user_id, partition)
+        metrics.counter("search_index_updates", kind="rebuild").inc()
+        logging.info(f"rebuilt search index for {user_id}: {len(partition.docs)} questions "
+                     f"in {time.monotonic() - start:.1f}s")
+        return len(partition.docs)
+
+    def _in_background(self, task, user_id, fn):
+        """runs fn on the index's background thread, unless
+        the same task is already pending for the user"""
+        with self._lock:
+            if (task, user_id) in self._tasks:
+                return
+            self._tasks.add((task, user_id))
+
+        def run():
+            try:
+                fn()
+            except Exception as e:
+                logging.warning(f"search index {task} for {user_id} failed: {e}")
+                metrics.counter("search_index_updates", kind=f"{task}_failed").inc()
+            finally:
+                with self._lock:
+                    self._tasks.discard((task, user_id))
+
+        self._background.submit(run)
+
+    def rebuild_in_background(self, user_id, history):
+        """starts rebuilding a user's partition from history(),
+        a function returning their history"""
+        self._in_background("rebuild", user_id, lambda: self.rebuild(user_id, history()))
+
+    def rebuilding(self, user_id):
+        with self._lock:
+            return ("rebuild", user_id) in self._tasks
+
+    def search(self, user_id, query, limit=10):
+        """returns a user's conversations that best match the query, each
+        with its best matching question, best first"""
+        start = time.monotonic()
+        partition = self.partition(user_id)
+        results = []
+        for score, doc in partition.search(query, limit):
+            conversation_id, timestamp, _, question, answer = partition.docs[doc]
+            results.append({
+                "conversationId": conversation_id,
+                "question": question,
+                "snippet": answer,
+                "timestamp": timestamp,
+                "score": round(score, 3),
+            })
+        self._search_time.observe(time.monotonic() - start)
+        return results
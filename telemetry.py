@@ -0,0 +1,274 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider, SpanProcessor
+from opentelemetry.sdk.trace.export import SpanExportResult
+from opentelemetry.sdk.trace.sampling import Decision, Sampler, SamplingResult
+from opentelemetry.trace import StatusCode
+import metrics
+
+# tracing is sampled per request (head based): a share of requests is traced
+# and exported, the rest are either not traced at all or, to still catch
+# errors and slow requests, recorded and only exported if they turn out to be
+# one of those. spans are exported from a bounded queue so a slow or missing
+# collector drops spans rather than using more and more memory
+
+# share of requests to trace (0-1)
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", 1.0))
+
+# per route overrides, as comma separated "path prefix=ratio" pairs.
+# the longest matching prefix wins. routes with a ratio of 0 are never
+# traced, even when they fail
+TRACE_ROUTE_RATIOS = os.getenv("TRACE_ROUTE_RATIOS", "/health=0,/static/=0")
+
+# export requests that weren't sampled if they fail, or take at least
+# TRACE_SLOW_SECONDS (0 disables). this records every request, which costs
+# more than not tracing them, but much less than exporting them
+TRACE_KEEP_ERRORS = os.getenv("TRACE_KEEP_ERRORS", "true").lower() == "true"
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", 10))
+
+# maximum number of unsampled traces held until their request finishes
+TRACE_PENDING_MAX = int(os.getenv("TRACE_PENDING_MAX", 1000))
+
+# export queue: spans beyond TRACE_EXPORT_QUEUE are dropped
+TRACE_EXPORT_QUEUE = int(os.getenv("TRACE_EXPORT_QUEUE", 2048))
+TRACE_EXPORT_BATCH = int(os.getenv("TRACE_EXPORT_BATCH", 512))
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", 5))
+
+
+def parse_route_ratios(value):
+    """parses "prefix=ratio,prefix=ratio" into a list of
+    (prefix, ratio), longest prefix first"""
+    ratios = []
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        prefix, _, ratio = item.partition("=")
+        ratios.append((prefix.strip(), float(ratio)))
+    return sorted(ratios, key=lambda r: len(r[0]), reverse=True)
+
+
+class RouteSampler(Sampler):
+    """Samples a share of traces, with per route overrides. Spans follow
+    their parent's decision. Unsampled traces are recorded (but not exported)
+    when `record_unsampled` is set, so errors and slow requests can be kept"""
+
+    # same as TraceIdRatioBased, so decisions agree with other services
+    TRACE_ID_LIMIT = (1 << 64) - 1
+
+    def __init__(self, ratio, route_ratios=(), record_unsampled=False):
+        self.ratio = ratio
+        self.route_ratios = list(route_ratios)
+        self.unsampled = Decision.RECORD_ONLY if record_unsampled else Decision.DROP
+
+    def _route_ratio(self, attributes):
+        """the override for the request's path, if any"""
+        path = (attributes or {}).get("http.target") or (attributes or {}).get("url.path")
+        if path:
+            for prefix, ratio in self.route_ratios:
+                if path.startswith(prefix):
+                    return ratio
+        return None
+
+    def should_sample(self, parent_context, trace_id, name, kind=None,
+                      attributes=None, links=None, trace_state=None):
+        parent = trace.get_current_span(parent_context)
+        parent_span_context = parent.get_span_context()
+        if parent_span_context.is_valid:
+            trace_state = parent_span_context.trace_state
+            if parent_span_context.trace_flags.sampled:
+                decision = Decision.RECORD_AND_SAMPLE
+            elif parent.is_recording():
+                # part of a local trace that may still be kept
+                decision = Decision.RECORD_ONLY
+            else:
+                decision = Decision.DROP
+        else:
+            ratio = self._route_ratio(attributes)
+            if ratio is not None and ratio <= 0:
+                # routes with a ratio of 0 are never traced, not even errors
+                decision = Decision.DROP
+            elif trace_id & self.TRACE_ID_LIMIT < round(
+                    (self.ratio if ratio is None else ratio) * (self.TRACE_ID_LIMIT + 1)):
+                decision = Decision.RECORD_AND_SAMPLE
+            else:
+                decision = self.unsampled
+        return SamplingResult(
+            decision,
+            attributes if decision.is_recording() else None,
+            trace_state)
+
+    def get_description(self):
+        return f"RouteSampler{{{self.ratio}, {self.route_ratios}}}"
+
+
+class ExportQueue(SpanProcessor):
+    """Exports spans in batches from a background thread. The queue is
+    bounded: when the exporter can't keep up, new spans are dropped and
+    counted in trace_spans{result="dropped"}"""
+
+    def __init__(self, exporter, max_queue=TRACE_EXPORT_QUEUE,
+                 batch_size=TRACE_EXPORT_BATCH, interval=TRACE_EXPORT_INTERVAL):
+        self.exporter = exporter
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._exporting = 0
+        self._flushing = False
+        self._done = False
+        self._dropped = metrics.counter("trace_spans", result="dropped")
+        self._exported = metrics.counter("trace_spans", result="exported")
+        self._failed = metrics.counter("trace_spans", result="failed")
+        metrics.gauge("trace_export_queue", fn=lambda: len(self._queue))
+        self._export_time = metrics.histogram("trace_export_seconds")
+        self._thread = threading.Thread(
+            target=self._run, name="trace-export", daemon=True)
+        self._thread.start()
+
+    def on_end(self, span):
+        """queues a span for export (the sampled flag isn't checked, the
+        caller decides what gets exported)"""
+        with self._condition:
+            if self._done or len(self._queue) >= self.max_queue:
+                self._dropped.inc()
+                return
+            self._queue.append(span)
+            if len(self._queue) >= self.batch_size:
+                self._condition.notify()
+
+    def _take_batch(self):
+        batch = []
+        while self._queue and len(batch) < self.batch_size:
+            batch.append(self._queue.popleft())
+        self._exporting = len(batch)
+        return batch
+
+    def _export(self, batch):
+        start = time.monotonic()
+        try:
+            result = self.exporter.export(batch)
+        except Exception as e:
+            logging.warning(f"span export failed: {e}")
+            result = SpanExportResult.FAILURE
+        self._export_time.observe(time.monotonic() - start)
+        if result == SpanExportResult.SUCCESS:
+            self._exported.inc(len(batch))
+        else:
+            self._failed.inc(len(batch))
+        with self._condition:
+            self._exporting = 0
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if len(self._queue) < self.batch_size and not (self._done or self._flushing):
+                    self._condition.wait(self.interval)
+                if self._done and not self._queue:
+                    return
+                batch = self._take_batch()
+                if not self._queue:
+                    self._flushing = False
+            if batch:
+                self._export(batch)
+
+    def force_flush(self, timeout_millis=30000):
+        deadline = time.monotonic() + timeout_millis / 1000
+        with self._condition:
+            self._flushing = True
+            self._condition.notify_all()
+            while self._queue or self._exporting:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def shutdown(self):
+        with self._condition:
+            self._done = True
+            self._condition.notify()
+        self._thread.join(self.interval + 1)
+        self.exporter.shutdown()
+
+
+class TailProcessor(SpanProcessor):
+    """Sends sampled spans to the export queue. Spans of unsampled traces are
+    held until the trace's local root span ends, and are then exported if
+    the request failed or was slow, and discarded otherwise"""
+
+    def __init__(self, export, keep_errors=TRACE_KEEP_ERRORS,
+                 slow_seconds=TRACE_SLOW_SECONDS, max_pending=TRACE_PENDING_MAX):
+        self.export = export
+        self.keep_errors = keep_errors
+        self.slow_ns = slow_seconds * 1e9 if slow_seconds > 0 else None
+        self.max_pending = max_pending
+        self._pending = OrderedDict()  # trace id -> spans
+        self._lock = threading.Lock()
+
+    def _count(self, result):
+        metrics.counter("trace_tail", result=result).inc()
+
+    def _keep(self, span):
+        if self.keep_errors and span.status.status_code == StatusCode.ERROR:
+            return "error"
+        if self.slow_ns is not None and span.end_time - span.start_time >= self.slow_ns:
+            return "slow"
+        return None
+
+    def on_end(self, span):
+        if span.context.trace_flags.sampled:
+            self.export.on_end(span)
+            return
+
+        trace_id = span.context.trace_id
+        if span.parent is not None and not span.parent.is_remote:
+            # wait for the rest of the trace
+            with self._lock:
+                spans = self._pending.get(trace_id)
+                if spans is None:
+                    if len(self._pending) >= self.max_pending:
+                        self._pending.popitem(last=False)
+                        self._count("evicted")
+                    spans = self._pending[trace_id] = []
+                spans.append(span)
+            return
+
+        # the local root span ended, so the trace is complete
+        with self._lock:
+            spans = self._pending.pop(trace_id, [])
+        reason = self._keep(span)
+        if reason is None:
+            self._count("discarded")
+            return
+        self._count(f"kept_{reason}")
+        for s in spans:
+            self.export.on_end(s)
+        self.export.on_end(span)
+
+    def force_flush(self, timeout_millis=30000):
+        return self.export.force_flush(timeout_millis)
+
+    def shutdown(self):
+        self.export.shutdown()
+
+
+def tracer_provider(exporter, ratio=TRACE_SAMPLE_RATIO, route_ratios=TRACE_ROUTE_RATIOS,
+                    keep_errors=TRACE_KEEP_ERRORS, slow_seconds=TRACE_SLOW_SECONDS):
+    """returns a tracer provider that samples spans and
+    exports them to exporter, as configured above"""
+    record_unsampled = keep_errors or slow_seconds > 0
+    provider = TracerProvider(sampler=RouteSampler(
+        ratio, parse_route_ratios(route_ratios), record_unsampled))
+    export = ExportQueue(exporter)
+    if record_unsampled:
+        provider.add_span_processor(TailProcessor(export, keep_errors, slow_seconds))
+    else:
+        provider.add_span_processor(export)
+    logging.info(f"tracing {ratio:.0%} of requests ({route_ratios})")
+    return provider
@@ -0,0 +1,267 @@
+import os
+import math
+import time
+import queue
+import threading
+from concurrent.futures import Future
+import admission
+import metrics
+
+# sizing of the web app's gunicorn workers and threads (see gunicorn.conf.py).
+# workers: one per cpu the container may use (its cgroup cpu quota), as many
+# as fit in its cgroup memory limit. threads: at least enough for every
+# request admission control lets in, and more when the requests in flight,
+# estimated with little's law (arrival rate x time in the app), call for it.
+# nearly all of a request's time is spent waiting on bedrock-agentcore, so
+# threads are cheap, but requests that bypass admission control (job long
+# polls, batches) and the default pool's queue hold threads too, and
+# requests that find no free thread wait where nothing can see or shed them
+
+# fixed settings, which turn sizing off for that setting
+WEB_CONCURRENCY = os.getenv("WEB_CONCURRENCY")
+GUNICORN_THREADS = os.getenv("GUNICORN_THREADS")
+
+# memory a worker process needs (MB), which caps the number of workers
+GUNICORN_WORKER_MEMORY_MB = int(os.getenv("GUNICORN_WORKER_MEMORY_MB", 256))
+
+# share of the container's memory the workers may use
+MEMORY_SHARE = 0.75
+
+# most threads per worker
+GUNICORN_MAX_THREADS = int(os.getenv("GUNICORN_MAX_THREADS", 64))
+
+# threads per request in flight (on average), to absorb bursts
+GUNICORN_THREADS_HEADROOM = float(os.getenv("GUNICORN_THREADS_HEADROOM", 2))
+
+# how often each worker resizes its thread pool (seconds)
+GUNICORN_TUNE_INTERVAL = float(os.getenv("GUNICORN_TUNE_INTERVAL", 10))
+
+# intervals that need fewer threads before the pool shrinks
+SHRINK_AFTER = 6
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cpu_limit():
+    """cpus the container may use: its cgroup cpu quota (v2 or v1),
+    or the cpus the process may run on"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    quota, period = None, None
+    cpu_max = _read("/sys/fs/cgroup/cpu.max")
+    if cpu_max:
+        quota, _, period = cpu_max.partition(" ")
+    else:
+        quota = _read("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+        period = _read("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    try:
+        # "max" (v2) or -1 (v1) when there is no quota
+        if quota and quota != "max" and int(quota) > 0:
+            return min(cpus, int(quota) / int(period))
+    except ValueError:
+        pass
+    return cpus
+
+
+def memory_limit():
+    """bytes of memory the container may use: its cgroup memory limit
+    (v2 or v1), or the machine's memory"""
+    physical = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    limit = (_read("/sys/fs/cgroup/memory.max") or
+             _read("/sys/fs/cgroup/memory/memory.limit_in_bytes"))
+    # v1 reports a huge number when there is no limit
+    if limit and limit.isdigit():
+        return min(physical, int(limit))
+    return physical
+
+
+def _private_cache():
+    return os.getenv("CACHE_URL", "memory://").startswith("memory://")
+
+
+def workers():
+    """worker processes: one per cpu, as many as fit in memory"""
+    if WEB_CONCURRENCY:
+        return int(WEB_CONCURRENCY)
+    if _private_cache():
+        # jobs are kept in the cache, so workers need to share it
+        return 1
+    fit = int(memory_limit() * MEMORY_SHARE / (GUNICORN_WORKER_MEMORY_MB * 1024 * 1024))
+    return max(1, min(int(cpu_limit()), fit))
+
+
+def min_threads():
+    return min(admission.threads_needed(), GUNICORN_MAX_THREADS)
+
+
+def threads():
+    """threads per worker to start with"""
+    if GUNICORN_THREADS:
+        return int(GUNICORN_THREADS)
+    return min_threads()
+
+
+def describe():
+    if WEB_CONCURRENCY:
+        sizing = "fixed"
+    elif _private_cache():
+        sizing = "CACHE_URL isn't shared by processes"
+    else:
+        sizing = f"{cpu_limit():g} cpus, {memory_limit() // (1024 * 1024)}MB memory"
+    settings = f"{workers()} workers ({sizing}), {threads()} threads"
+    if GUNICORN_THREADS:
+        return f"{settings} (fixed)"
+    return (f"{settings} (resized between {min_threads()} and {GUNICORN_MAX_THREADS} "
+            f"every {GUNICORN_TUNE_INTERVAL:g}s)")
+
+
+class ThreadPool():
+    """Runs gunicorn's requests on a number of threads that can be changed
+    while it runs (the ThreadPoolExecutor gthread uses can't shrink), and
+    measures how many arrive and how long they take, from the time they're
+    submitted, including any wait for a thread"""
+
+    def __init__(self, size):
+        self.size = 0
+        self.busy = 0
+        self._exiting = 0  # threads asked to exit that haven't yet
+        self._arrivals = 0
+        self._completed = 0
+        self._seconds = 0.0
+        self._since = time.monotonic()
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self.resize(size)
+
+    @property
+    def queued(self):
+        """requests waiting for a thread"""
+        return max(0, self._queue.qsize() - self._exiting)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            self._arrivals += 1
+        self._queue.put((future, time.monotonic(), fn, args, kwargs))
+        return future
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                with self._lock:
+                    self._exiting -= 1
+                return
+            future, submitted, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self._lock:
+                self.busy += 1
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                    self._completed += 1
+                    self._seconds += time.monotonic() - submitted
+
+    def measure(self):
+        """returns the arrival rate (requests per second) and average time
+        per request since the last call"""
+        now = time.monotonic()
+        with self._lock:
+            elapsed = now - self._since
+            arrival_rate = self._arrivals / elapsed if elapsed > 0 else 0
+            time_per_request = self._seconds / self._completed if self._completed else 0
+            self._arrivals, self._completed, self._seconds = 0, 0, 0.0
+            self._since = now
+        return arrival_rate, time_per_request
+
+    def resize(self, size):
+        """adds threads, or asks threads to exit once they're done with
+        the requests queued before the resize"""
+        with self._lock:
+            for _ in range(size - self.size):
+                threading.Thread(target=self._run, name="gthread", daemon=True).start()
+            for _ in range(self.size - size):
+                self._exiting += 1
+                self._queue.put(None)
+            self.size = size
+
+    def shutdown(self, wait=True):
+        self.resize(0)
+
+
+class Tuner():
+    """Resizes a worker's thread pool to the requests in flight. Every
+    interval, the requests in flight on average are estimated with little's
+    law, from the arrival rate and the time requests took. the pool grows
+    right away when they (with headroom, plus requests waiting for a thread)
+    need more threads, and shrinks once they've needed fewer for
+    SHRINK_AFTER intervals"""
+
+    def __init__(self, pool, min_size, max_size, log,
+                 headroom=GUNICORN_THREADS_HEADROOM, interval=GUNICORN_TUNE_INTERVAL):
+        self.pool = pool
+        self.min_size = min_size
+        self.max_size = max_size
+        self.log = log
+        self.headroom = headroom
+        self.interval = interval
+        self.in_flight = 0.0
+        self._low = 0
+
+    def tune(self):
+        arrival_rate, time_per_request = self.pool.measure()
+        # little's law: requests in flight = arrival rate x time per request
+        self.in_flight = arrival_rate * time_per_request
+        needed = math.ceil(self.in_flight * self.headroom) + self.pool.queued
+        target = max(self.min_size, min(self.max_size, needed))
+        size = self.pool.size
+        if target == size:
+            self._low = 0
+            return
+        if target < size:
+            self._low += 1
+            if self._low < SHRINK_AFTER:
+                return
+        self._low = 0
+        self.log.info(
+            f"threads {size} -> {target} ({arrival_rate:.2f} requests/s x "
+            f"{time_per_request:.2f}s = {self.in_flight:.1f} in flight)")
+        self.pool.resize(target)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.tune()
+            except Exception as e:
+                self.log.warning(f"failed to resize threads: {e}")
+
+    def start(self):
+        threading.Thread(target=self.run, name="tuner", daemon=True).start()
+
+
+def attach(worker):
+    """swaps a gthread worker's thread pool for one that's resized as it
+    runs, unless its threads are fixed (GUNICORN_THREADS or --threads)"""
+    if GUNICORN_THREADS or not hasattr(worker, "tpool") or worker.cfg.threads != threads():
+        return None
+    pool = ThreadPool(worker.cfg.threads)
+    worker.tpool.shutdown(False)
+    worker.tpool = pool
+    tuner = Tuner(pool, min_threads(), GUNICORN_MAX_THREADS, worker.log)
+    tuner.start()
+    metrics.gauge("gunicorn_threads", fn=lambda: pool.size)
+    metrics.gauge("gunicorn_threads_busy", fn=lambda: pool.busy)
+    metrics.gauge("gunicorn_queued", fn=lambda: pool.queued)
+    metrics.gauge("gunicorn_in_flight_estimate", fn=lambda: round(tuner.in_flight, 2))
+    return tuner